@@ -1,9 +1,15 @@
 # this Lambda function code takes the S3 file that was uploaded, and sends a command to EC2 to process it
 
 import json
+import os
+import shlex
 import urllib.parse
 import boto3
 import paramiko
+from size_tiers import select_tier, get_arguments
+
+# the host is always running, so only the workers and mode are picked from the size of the file, limited to its cores
+HOSTWORKERS = int(os.environ.get("HOST_WORKERS", 1))
 
 def lambda_handler(event, context):
 	print("Received event: " + json.dumps(event, indent = 2))
@@ -15,14 +21,18 @@ def lambda_handler(event, context):
 	s3file = f"{bucket}/{key}"
 	s3client = boto3.client("s3")
 
-	# quick confirmation that it is a valid accessible file
+	# quick confirmation that it is a valid accessible file, and its size picks the tier it is processed with
 	try:
-		s3client.get_object(Bucket=bucket, Key=key)
+		size = s3client.head_object(Bucket = bucket, Key = key)["ContentLength"]
 	except Exception as ex:
 		print(f"Error getting object {key} from bucket {bucket}. Make sure they exist and your bucket is in the same region as this function.")
 		print(ex)
 		raise ex
 
+	tier = select_tier(size)
+	arguments = get_arguments(tier, HOSTWORKERS)
+	print(f"File is {size} bytes, processing with {arguments}")
+
 	# download key file needed for ssh connection
 	print("Getting Key from S3")
 	try:
@@ -46,7 +56,7 @@ def lambda_handler(event, context):
 		raise ex
 
 	# send EC2 the command to process the file
-	command = f"cd AdobeProject; python3 ProcessFile.py {s3file} &"
+	command = f"cd AdobeProject; python3 ProcessFile.py {shlex.quote(s3file)} {arguments} &"
 	print(f"Sending Command: {command}")
 
 	try:
@@ -1,9 +1,11 @@
 # this Lambda function code takes the S3 file that was uploaded, and sends a command to EC2 to process it
 
 import json
+import shlex
 import urllib.parse
 import boto3
 import paramiko
+from size_tiers import select_tier, get_arguments
 
 def lambda_handler(event, context):
 	print("Received event: " + json.dumps(event, indent = 2))
@@ -15,14 +17,17 @@ def lambda_handler(event, context):
 	s3file = f"{bucket}/{key}"
 	s3client = boto3.client("s3")
 
-	# quick confirmation that it is a valid accessible file
+	# quick confirmation that it is a valid accessible file, and its size picks the tier it is processed with
 	try:
-		s3client.get_object(Bucket=bucket, Key=key)
+		size = s3client.head_object(Bucket = bucket, Key = key)["ContentLength"]
 	except Exception as ex:
 		print(f"Error getting object {key} from bucket {bucket}. Make sure they exist and your bucket is in the same region as this function.")
 		print(ex)
 		raise ex
 
+	tier = select_tier(size)
+	print(f"File is {size} bytes, processing on {tier['InstanceType']} with {tier['Workers']} workers in {tier['Mode']} mode")
+
 	# download key file needed for ssh connection
 	print("Getting Key from S3")
 	try:
@@ -41,8 +46,8 @@ def lambda_handler(event, context):
 		    ImageId = "ami-0233c2d874b811deb",
 		    MinCount = 1,
 		    MaxCount = 1,
-		    # can set an instance type based on the size of the file
-		    InstanceType = "t2.micro",
+		    # the instance type is picked from the size of the file
+		    InstanceType = tier["InstanceType"],
 		    Key = "adobe-ec2",
 		    InstanceInitiatedShutdownBehavior = "terminate"
 		)
@@ -67,7 +72,7 @@ def lambda_handler(event, context):
 		raise ex
 
 	# send EC2 the command to process the file
-	command = f"sudo shutdown -h -P +240; cd AdobeProject; python3 ProcessFile.py {s3file} &"
+	command = f"sudo shutdown -h -P +240; cd AdobeProject; python3 ProcessFile.py {shlex.quote(s3file)} {get_arguments(tier)} &"
 	print(f"Sending Command: {command}")
 
 	try:
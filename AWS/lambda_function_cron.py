@@ -1,20 +1,41 @@
 # This Lambda runs every 4 hours as a scheduled event from Cloud Watch, and will attempt to process any files that failed
 # It uses an S3 Tag to track the retry attempts
+# Only the inbound prefix is listed, a page at a time, and the tag reads, tag writes and resubmits of each file run on a
+# thread pool, so the run time grows with the number of inbound files divided by the threads rather than the bucket size
 
 import json
 import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 MAXATTEMPTS = 3
-S3CLIENT = boto3.client("s3")
+BUCKET = "adobe-project"
+SUBFOLDER = "inbound/"
+# number of inbound files checked at the same time
+THREADS = 32
+# the clients are created once and reused by every thread and by later runs of a warm Lambda
+S3CLIENT = boto3.client("s3", config = Config(max_pool_connections = THREADS))
+LAMBDACLIENT = boto3.client("lambda", config = Config(max_pool_connections = THREADS))
 
-def get_attempts(s3object):
+def list_inbound():
+	'''
+		Lists the files in the inbound directory a page at a time, without listing the rest of the bucket
+	'''
+
+	paginator = S3CLIENT.get_paginator("list_objects_v2")
+	for page in paginator.paginate(Bucket = BUCKET, Prefix = SUBFOLDER):
+		for s3object in page.get('Contents', []):
+			if s3object['Key'] != SUBFOLDER:
+				yield s3object['Key'], s3object['LastModified']
+
+def get_attempts(key):
 	'''
 		Reads the Retry Attempts tag from the s3 object
 	'''
 
 	attempts = 0
-	tags = S3CLIENT.get_object_tagging(Bucket = "adobe-project", Key = s3object.key)
+	tags = S3CLIENT.get_object_tagging(Bucket = BUCKET, Key = key)
 	try:
 		# locate number of attempts
 		for tag in tags['TagSet']:
@@ -25,14 +46,14 @@ def get_attempts(s3object):
 
 	return attempts
 
-def set_attempts(s3object, attempts):
+def set_attempts(key, attempts):
 	'''
 		Sets the Retry Attempts tag from the s3 object
 	'''
 
 	S3CLIENT.put_object_tagging(
-		Bucket = "adobe-project",
-		Key = s3object.key,    
+		Bucket = BUCKET,
+		Key = key,
 		Tagging = {
 			"TagSet": [
 				{
@@ -43,7 +64,7 @@ def set_attempts(s3object, attempts):
 		}
 	)
 
-def resubmit_lambda(s3object):
+def resubmit_lambda(key):
 	"""
 		Resubmits the EC2 file processing lambda
 	"""
@@ -54,10 +75,10 @@ def resubmit_lambda(s3object):
 			{
 				"s3": {
 					"bucket": {
-						"name": "adobe-project",
+						"name": BUCKET,
 					},
 					"object": {
-						"key": s3object.key
+						"key": key
 					}
 				}
 			}
@@ -65,35 +86,52 @@ def resubmit_lambda(s3object):
 	}
 
 	# submit the lambda that processes the file in EC2
-	lambdaclient = boto3.client("lambda")
 	try:
-		lambdaclient.invoke(
+		LAMBDACLIENT.invoke(
 			FunctionName = "adobe-s3-get-function",
 			InvocationType = "Event",
 			Payload = bytes(json.dumps(payload), encoding = "utf8")
 		)
-		print(f"Triggerd lambda for {s3object.key}")
+		print(f"Triggerd lambda for {key}")
+		return True
+	except Exception as ex:
+		print(f"Failed to trigger lambda for {key} {ex}.")
+		return False
+
+def retry_file(key, lastmodified, now):
+	'''
+		Resubmits one inbound file if it is due another attempt, and returns what was done with it
+	'''
+
+	try:
+		# get tags for S3 object
+		attempts = get_attempts(key)
+		if attempts >= MAXATTEMPTS:
+			# TODO: send notification to client letting them know that this file will not process
+			return "exhausted"
+
+		# allow one attempt every 4 hours as long as the last modified date is (attempts * 4) hours in the past
+		age = now - lastmodified
+		if age.total_seconds() / 60 / 60 < (4 * (attempts + 1)):
+			return "waiting"
+
+		print(f"Processing file: {key}, Attempt: {attempts + 1}")
+		if not resubmit_lambda(key):
+			return "failed"
+		set_attempts(key, attempts + 1)
+		return "resubmitted"
 	except Exception as ex:
-		print(f"Failed to trigger lambda for {s3object.key} {ex}.")
+		print(f"Failed to check {key} for a retry {ex}.")
+		return "failed"
 
 def lambda_handler(event, context):
-	s3 = boto3.resource("s3")
-	bucket = s3.Bucket("adobe-project")
-	subfolder = "inbound/"
-	
-	for s3object in bucket.objects.all():
-		if s3object.key.startswith(subfolder) and s3object.key != subfolder:
-			# get tags for S3 object
-			attempts  = get_attempts(s3object)
-			if attempts >= MAXATTEMPTS:
-				# TODO: send notification to client letting them know that this file will not process
-				continue
-			
-			# allow one attempt every 4 hours as long as the last modified date is (attempts * 4) hours in the past
-			difference = s3object.last_modified - datetime.now(timezone.utc)
-			if difference.seconds / 60 / 60 >= (4 * (attempts + 1)):
-				print(f"Processing file: {s3object.key}, Attempt: {attempts + 1}")
-				resubmit_lambda(s3object)
-				set_attempts(s3object, attempts + 1)		
-			
-	return {"Status Code": 200}
+	now = datetime.now(timezone.utc)
+	counts = {"resubmitted": 0, "waiting": 0, "exhausted": 0, "failed": 0}
+
+	with ThreadPoolExecutor(max_workers = THREADS) as executor:
+		futures = [executor.submit(retry_file, key, lastmodified, now) for key, lastmodified in list_inbound()]
+		for future in futures:
+			counts[future.result()] += 1
+
+	print(f"Inbound files: {sum(counts.values())} {counts}")
+	return {"Status Code": 200, "Files": counts}
@@ -0,0 +1,54 @@
+# The size tiers the launcher Lambdas use to pick the EC2 instance type, the number of parse workers and the parse mode
+# for a file from its size in S3. Deploy this file next to lambda_function.py and lambda_function_create_ec2.py
+# The table can be changed without a code change by setting the SIZE_TIERS environment variable of the Lambda to a JSON
+# list of tiers in the same form as DEFAULTTIERS
+
+import json
+import os
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# a file uses the first tier its size fits in, the last tier has no size limit (MaxBytes is None)
+# small files get a small instance that starts quickly, large files get enough cores for the parallel parse and, past
+# what fits in memory as a dictionary, the compact ip address store
+DEFAULTTIERS = [
+	{"MaxBytes": 256 * MB, "InstanceType": "t2.micro", "Workers": 1, "Mode": "onepass", "Store": "dict"},
+	{"MaxBytes": 4 * GB, "InstanceType": "c5.xlarge", "Workers": 4, "Mode": "onepass", "Store": "dict"},
+	{"MaxBytes": 32 * GB, "InstanceType": "c5.4xlarge", "Workers": 16, "Mode": "onepass", "Store": "compact"},
+	{"MaxBytes": None, "InstanceType": "r5.4xlarge", "Workers": 16, "Mode": "onepass", "Store": "compact"},
+]
+
+def load_tiers():
+	'''
+		Loads the size tiers from the SIZE_TIERS environment variable, or the default tiers
+	'''
+
+	tiers = DEFAULTTIERS
+	if os.environ.get("SIZE_TIERS"):
+		tiers = json.loads(os.environ["SIZE_TIERS"])
+
+	# the tiers are checked in order, so a limit lower than the tier before it could never be used
+	limits = [tier["MaxBytes"] for tier in tiers]
+	if not len(tiers) or limits[-1] is not None or None in limits[:-1] or limits[:-1] != sorted(limits[:-1]):
+		raise ValueError("Size tiers must be in order of MaxBytes, and only the last tier has no size limit")
+
+	return tiers
+
+def select_tier(size, tiers = None):
+	'''
+		Returns the first tier a file of size bytes fits in
+	'''
+
+	tiers = load_tiers() if tiers is None else tiers
+	for tier in tiers:
+		if tier["MaxBytes"] is None or size <= tier["MaxBytes"]:
+			return tier
+
+def get_arguments(tier, maxworkers = None):
+	'''
+		Returns the ProcessFile.py arguments for a tier, with the workers limited to maxworkers cores if given
+	'''
+
+	workers = tier["Workers"] if maxworkers is None else min(tier["Workers"], maxworkers)
+	return f"--workers {workers} --mode {tier['Mode']} --store {tier['Store']}"
@@ -0,0 +1,131 @@
+import re
+import sqlite3
+import threading
+
+# a date in a file name, such as 2009_09_27 or 2009-09-27
+FILEDATE = re.compile(r"(\d{4})[-_](\d{2})[-_](\d{2})")
+
+def get_partition_date(name, default):
+	"""
+		Gets the date a file holds hit data for from its name.
+
+		Parameters
+		----------
+		name (string)
+			The name of the file
+		default (string)
+			The date to use when the name has no date in it
+
+		Returns
+		----------
+		date (string)
+			The date as YYYY-MM-DD
+	"""
+
+	match = FILEDATE.search(name)
+	if match is None:
+		return default
+	return "-".join(match.groups())
+
+class AggregateStore(object):
+	"""
+		A sqlite store of revenue by date, source file, search engine domain and keywords, that every run merges its
+		grouped revenue in to. Each date and source file is a partition, and merging a partition that is already stored
+		replaces it, so running a file again never counts its revenue twice while other files of the same date are kept.
+		Rows are keyed by date first, so a rollup over a range of dates only reads that range.
+	"""
+
+	def __init__(self, filename):
+		"""
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the sqlite file, created if it doesn't exist
+		"""
+
+		self.FileName = filename
+		# files of a batch are merged from several threads
+		self.Lock = threading.Lock()
+		self.Connection = sqlite3.connect(self.FileName, check_same_thread = False)
+		self.Connection.execute("PRAGMA journal_mode = WAL")
+		self.Connection.execute("CREATE TABLE IF NOT EXISTS revenue (date TEXT, source TEXT, domain TEXT, keywords TEXT, revenue REAL, PRIMARY KEY (date, source, domain, keywords)) WITHOUT ROWID")
+
+	def replace_partition(self, date, source, resultsdict):
+		"""
+			Replaces the revenue of one date and source file with the grouped revenue of a run, in one transaction.
+
+			Parameters
+			----------
+			date (string)
+				The date of the partition as YYYY-MM-DD
+			source (string)
+				The name of the input file of the run
+			resultsdict (dict)
+				The grouped sum of revenue (Domain|KeyWords: Revenue)
+
+			Returns
+			----------
+			rows (int)
+				The number of rows written
+			othersources (list)
+				The other source files that have revenue stored for the date
+		"""
+
+		rows = list()
+		for domaininfo, revenue in resultsdict.items():
+			domain, _, keywords = domaininfo.partition("|")
+			rows.append((date, source, domain, keywords, revenue))
+
+		with self.Lock, self.Connection:
+			self.Connection.execute("DELETE FROM revenue WHERE date = ? AND source = ?", (date, source))
+			self.Connection.executemany("INSERT OR REPLACE INTO revenue (date, source, domain, keywords, revenue) VALUES (?, ?, ?, ?, ?)", rows)
+			othersources = [row[0] for row in self.Connection.execute("SELECT DISTINCT source FROM revenue WHERE date = ? AND source != ? ORDER BY source", (date, source))]
+
+		return len(rows), othersources
+
+	def rollup(self, start, end, top = None):
+		"""
+			Sums up revenue by search engine domain and keywords over a range of dates.
+
+			Parameters
+			----------
+			start (string)
+				The first date of the range as YYYY-MM-DD
+			end (string)
+				The last date of the range as YYYY-MM-DD, included in the range
+			top (int)
+				Optional number of groups to return, only the top groups by revenue are returned
+
+			Returns
+			----------
+			rows (list)
+				(domain, keywords, revenue) for each group, revenue descending
+		"""
+
+		# the revenue of every source file of a date is summed
+		query = "SELECT domain, keywords, SUM(revenue) AS total FROM revenue WHERE date BETWEEN ? AND ? GROUP BY domain, keywords ORDER BY total DESC, domain, keywords"
+		parameters = (start, end)
+		if top is not None:
+			query += " LIMIT ?"
+			parameters += (top,)
+
+		with self.Lock:
+			return self.Connection.execute(query, parameters).fetchall()
+
+	def get_dates(self):
+		"""
+			Returns
+			----------
+			dates (list)
+				(date, source files, groups, revenue) for each date in the store
+		"""
+
+		with self.Lock:
+			return self.Connection.execute("SELECT date, COUNT(DISTINCT source), COUNT(*), SUM(revenue) FROM revenue GROUP BY date ORDER BY date").fetchall()
+
+	def close(self):
+		"""
+			Closes the sqlite file.
+		"""
+
+		self.Connection.close()
@@ -0,0 +1,714 @@
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from datetime import date
+from hashlib import blake2b
+from itertools import islice
+
+def pack_ip(ip):
+	"""
+		Packs an ip address string in to an integer.
+
+		Parameters
+		----------
+		ip (string)
+			The ip address to pack
+
+		Returns
+		----------
+		packed (tuple)
+			(4, integer) for an IPv4 address, (6, integer) for an IPv6 address, or None if the string is not an ip address
+			in its standard form. Only standard forms are packed so two different strings never pack to the same integer.
+	"""
+
+	for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+		try:
+			packed = socket.inet_pton(family, ip)
+		except (OSError, ValueError):
+			continue
+
+		if socket.inet_ntop(family, packed) == ip:
+			return version, int.from_bytes(packed, "big")
+		return None
+
+	return None
+
+class PairTable(object):
+	"""
+		Interns Domain|Keywords strings, mapping each unique string to a small integer id
+	"""
+
+	def __init__(self):
+		self.Ids = dict()
+		self.Values = list()
+
+	def get_id(self, value):
+		"""
+			Gets the id of a value, adding it to the table if it is new.
+
+			Parameters
+			----------
+			value (string)
+				The value to intern
+
+			Returns
+			----------
+			id (int)
+				The id of the value
+		"""
+
+		pairid = self.Ids.get(value)
+		if pairid is None:
+			pairid = len(self.Values)
+			self.Ids[value] = pairid
+			self.Values.append(value)
+
+		return pairid
+
+class IntTable(object):
+	"""
+		An open addressing hash table from 32 bit integer keys to 32 bit integer values, stored in two flat arrays.
+	"""
+
+	def __init__(self, capacity = 1024):
+		"""
+			Parameters
+			----------
+			capacity (int)
+				The starting number of slots, rounded up to a power of 2
+		"""
+
+		self.Bits = max(4, (capacity - 1).bit_length())
+		self.Count = 0
+		self.allocate()
+
+	def allocate(self):
+		"""
+			Creates empty key and value arrays for the current number of bits.
+		"""
+
+		self.Capacity = 1 << self.Bits
+		self.Mask = self.Capacity - 1
+		self.Shift = 64 - self.Bits
+		# keys are stored plus one so a slot of 0 is empty
+		self.Keys = array("Q", bytes(8 * self.Capacity))
+		self.Values = array("I", bytes(4 * self.Capacity))
+
+	def find(self, key):
+		"""
+			Finds the slot of a key using fibonacci hashing and linear probing.
+
+			Parameters
+			----------
+			key (int)
+				The stored key (key plus one)
+
+			Returns
+			----------
+			slot (int)
+				The slot holding the key, or the empty slot where it belongs
+		"""
+
+		keys = self.Keys
+		mask = self.Mask
+		slot = ((key * 11400714819323198485) & 0xFFFFFFFFFFFFFFFF) >> self.Shift
+
+		while True:
+			stored = keys[slot]
+			if stored == key or stored == 0:
+				return slot
+			slot = (slot + 1) & mask
+
+	def get(self, key, default = None):
+		slot = self.find(key + 1)
+		return self.Values[slot] if self.Keys[slot] else default
+
+	def set(self, key, value):
+		key += 1
+		slot = self.find(key)
+		self.Values[slot] = value
+
+		if not self.Keys[slot]:
+			self.Keys[slot] = key
+			self.Count += 1
+			# keep the load factor under 0.7 so probes stay short
+			if self.Count * 10 > self.Capacity * 7:
+				self.resize()
+
+	def reserve(self, count):
+		"""
+			Grows the table to hold count keys without resizing. Copying keys from a larger table in slot order in to a
+			smaller one piles them up in long probe runs, so reserve before copying from another table.
+
+			Parameters
+			----------
+			count (int)
+				The number of keys the table will hold
+		"""
+
+		bits = self.Bits
+		while count * 10 > (1 << bits) * 7:
+			bits += 1
+
+		if bits > self.Bits:
+			self.resize(bits)
+
+	def resize(self, bits = None):
+		"""
+			Grows the number of slots, doubling it by default, and re-inserts every key.
+
+			Parameters
+			----------
+			bits (int)
+				Optional number of bits of the new number of slots
+		"""
+
+		keys = self.Keys
+		values = self.Values
+		self.Bits = self.Bits + 1 if bits is None else bits
+		self.allocate()
+
+		for slot in range(len(keys)):
+			if keys[slot]:
+				newslot = self.find(keys[slot])
+				self.Keys[newslot] = keys[slot]
+				self.Values[newslot] = values[slot]
+
+	def items(self):
+		for slot in range(self.Capacity):
+			if self.Keys[slot]:
+				yield self.Keys[slot] - 1, self.Values[slot]
+
+	def get_size(self):
+		"""
+			Returns
+			----------
+			size (int)
+				The memory used by the table in bytes
+		"""
+
+		return sys.getsizeof(self.Keys) + sys.getsizeof(self.Values)
+
+class AttributionTable(object):
+	"""
+		A compact replacement for the ip address dictionary (IP: DomainInfo). IPv4 addresses are packed in to integers and
+		stored in an open addressing table, and each Domain|Keywords string is stored once with only its id kept per ip.
+		IPv6 addresses are packed in to integer keys of a dictionary, and anything that is not an ip address is kept as is.
+	"""
+
+	def __init__(self, capacity = 1024):
+		self.Pairs = PairTable()
+		self.IPv4 = IntTable(capacity)
+		self.IPv6 = dict()
+		self.Other = dict()
+
+	def __setitem__(self, ip, domaininfo):
+		pairid = self.Pairs.get_id(domaininfo)
+		packed = pack_ip(ip)
+
+		if packed is None:
+			self.Other[ip] = pairid
+		elif packed[0] == 4:
+			self.IPv4.set(packed[1], pairid)
+		else:
+			self.IPv6[packed[1]] = pairid
+
+	def get(self, ip, default = None):
+		packed = pack_ip(ip)
+
+		if packed is None:
+			pairid = self.Other.get(ip)
+		elif packed[0] == 4:
+			pairid = self.IPv4.get(packed[1])
+		else:
+			pairid = self.IPv6.get(packed[1])
+
+		return default if pairid is None else self.Pairs.Values[pairid]
+
+	def __getitem__(self, ip):
+		domaininfo = self.get(ip)
+		if domaininfo is None:
+			raise KeyError(ip)
+		return domaininfo
+
+	def __contains__(self, ip):
+		return self.get(ip) is not None
+
+	def __len__(self):
+		return self.IPv4.Count + len(self.IPv6) + len(self.Other)
+
+	def update(self, other):
+		# another table iterates in slot order, see IntTable.reserve
+		if isinstance(other, AttributionTable):
+			self.IPv4.reserve(len(self) + len(other))
+		for ip, domaininfo in other.items():
+			self[ip] = domaininfo
+
+	def items(self):
+		values = self.Pairs.Values
+		for key, pairid in self.IPv4.items():
+			yield socket.inet_ntop(socket.AF_INET, key.to_bytes(4, "big")), values[pairid]
+		for key, pairid in self.IPv6.items():
+			yield socket.inet_ntop(socket.AF_INET6, key.to_bytes(16, "big")), values[pairid]
+		for ip, pairid in self.Other.items():
+			yield ip, values[pairid]
+
+	def get_size(self):
+		"""
+			Returns
+			----------
+			size (int)
+				An estimate of the memory used by the table in bytes, not including the interned strings
+		"""
+
+		size = self.IPv4.get_size() + sys.getsizeof(self.IPv6) + sys.getsizeof(self.Other)
+		size += sum(sys.getsizeof(key) for key in self.IPv6) + sum(sys.getsizeof(key) for key in self.Other)
+		return size
+
+class SpillStore(object):
+	"""
+		An ip address store (IP: DomainInfo) with a memory budget. Recently written ip addresses are kept in a dictionary,
+		and when the dictionary grows past the budget the least recently written ip addresses are spilled to a sqlite
+		file on disk. Lookups check the dictionary first, so results are the same as keeping every ip address in memory.
+	"""
+
+	# rough memory used by each entry of the dictionary, ip string plus dictionary slot
+	ENTRYSIZE = 128
+
+	def __init__(self, filename, budget = 1024 * 1024 * 1024, spillfraction = 0.25):
+		"""
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the sqlite file, removed when the store is closed
+			budget (int)
+				The memory budget of the dictionary in bytes
+			spillfraction (float)
+				The fraction of the dictionary to spill each time the budget is exceeded
+		"""
+
+		self.FileName = filename
+		self.MaxEntries = max(1, budget // self.ENTRYSIZE)
+		self.SpillSize = max(1, int(self.MaxEntries * spillfraction))
+		self.Hot = dict()
+		self.Pairs = PairTable()
+		self.SpillCount = 0
+		self.SpilledEntries = 0
+		self.DiskLookups = 0
+		self.DiskHits = 0
+		self.DiskTime = 0
+
+		if os.path.exists(self.FileName):
+			os.remove(self.FileName)
+
+		# the file only lives for one run, so don't pay for a journal or syncing
+		self.Connection = sqlite3.connect(self.FileName)
+		self.Connection.execute("PRAGMA journal_mode = OFF")
+		self.Connection.execute("PRAGMA synchronous = OFF")
+		self.Connection.execute("CREATE TABLE attribution (ip TEXT PRIMARY KEY, pairid INTEGER) WITHOUT ROWID")
+
+	def __setitem__(self, ip, domaininfo):
+		hot = self.Hot
+
+		# move the ip address to the end of the dictionary so the least recently written are spilled first
+		if hot.pop(ip, None) is None and len(hot) >= self.MaxEntries:
+			self.spill()
+		hot[ip] = domaininfo
+
+	def spill(self):
+		"""
+			Moves the least recently written ip addresses from the dictionary to disk.
+		"""
+
+		hot = self.Hot
+		pairs = self.Pairs
+		ips = list(islice(hot, self.SpillSize))
+		rows = [(ip, pairs.get_id(hot.pop(ip))) for ip in ips]
+
+		with self.Connection:
+			self.Connection.executemany("INSERT OR REPLACE INTO attribution (ip, pairid) VALUES (?, ?)", rows)
+
+		self.SpillCount += 1
+		self.SpilledEntries += len(rows)
+
+	def get(self, ip, default = None):
+		domaininfo = self.Hot.get(ip)
+		if domaininfo is not None:
+			return domaininfo
+
+		if not self.SpilledEntries:
+			return default
+
+		starttime = time.perf_counter()
+		row = self.Connection.execute("SELECT pairid FROM attribution WHERE ip = ?", (ip,)).fetchone()
+		self.DiskTime += time.perf_counter() - starttime
+		self.DiskLookups += 1
+
+		if row is None:
+			return default
+
+		self.DiskHits += 1
+		return self.Pairs.Values[row[0]]
+
+	def __getitem__(self, ip):
+		domaininfo = self.get(ip)
+		if domaininfo is None:
+			raise KeyError(ip)
+		return domaininfo
+
+	def __contains__(self, ip):
+		return self.get(ip) is not None
+
+	def __len__(self):
+		count = self.Connection.execute("SELECT COUNT(*) FROM attribution").fetchone()[0]
+
+		# ip addresses written again after being spilled are in both the dictionary and the file
+		ips = list(self.Hot)
+		for pos in range(0, len(ips), 500):
+			batch = ips[pos:pos + 500]
+			query = f"SELECT COUNT(*) FROM attribution WHERE ip IN ({','.join('?' * len(batch))})"
+			count -= self.Connection.execute(query, batch).fetchone()[0]
+
+		return count + len(ips)
+
+	def update(self, other):
+		for ip, domaininfo in other.items():
+			self[ip] = domaininfo
+
+	def items(self):
+		yield from self.Hot.items()
+
+		values = self.Pairs.Values
+		for ip, pairid in self.Connection.execute("SELECT ip, pairid FROM attribution"):
+			if ip not in self.Hot:
+				yield ip, values[pairid]
+
+	def get_stats(self):
+		"""
+			Returns
+			----------
+			stats (string)
+				The spill counts and disk lookup latency of the store
+		"""
+
+		latency = self.DiskTime / self.DiskLookups * 1000000 if self.DiskLookups else 0
+		return f"{self.SpillCount} spills, {self.SpilledEntries} ip addresses spilled, {self.DiskLookups} disk lookups ({self.DiskHits} found), {latency:.1f} microseconds per disk lookup"
+
+	def close(self):
+		"""
+			Closes and removes the sqlite file.
+		"""
+
+		self.Connection.close()
+		if os.path.exists(self.FileName):
+			os.remove(self.FileName)
+
+class WindowStore(object):
+	"""
+		An ip address store (IP: DomainInfo) that forgets referrers older than an attribution window. The store keeps a
+		clock of the latest hit_time_gmt seen, and each ip address is stamped with the clock when its referrer is written.
+		Entries are kept in the order they were last written, which is time order for a file in chronological order, so
+		stale entries are always at the front and each is evicted once as the clock moves past it. Memory is bounded by
+		the visitors active within the window rather than every visitor in the file.
+	"""
+
+	def __init__(self, window):
+		"""
+			Parameters
+			----------
+			window (int)
+				The most seconds between a search engine referrer and a purchase it is attributed to
+		"""
+
+		self.Window = window
+		self.Now = 0
+		# ip address: (time written, domain info), oldest first
+		self.Entries = OrderedDict()
+		self.HighWater = 0
+		self.Evictions = 0
+
+	def advance(self, hittime):
+		"""
+			Moves the clock forward to the time of a hit and evicts the entries that are now outside the window. A hit
+			earlier than the clock, from a file that is slightly out of order, doesn't move the clock back.
+
+			Parameters
+			----------
+			hittime (string | bytes)
+				The hit_time_gmt column of the hit, in seconds since the epoch
+		"""
+
+		hittime = int(hittime)
+		if hittime <= self.Now:
+			return
+		self.Now = hittime
+
+		entries = self.Entries
+		cutoff = hittime - self.Window
+		while entries:
+			ip = next(iter(entries))
+			if entries[ip][0] >= cutoff:
+				break
+			del entries[ip]
+			self.Evictions += 1
+
+	def __setitem__(self, ip, domaininfo):
+		entries = self.Entries
+
+		# move the ip address to the end so the entries stay in the order they were written
+		entries[ip] = (self.Now, domaininfo)
+		entries.move_to_end(ip)
+		if len(entries) > self.HighWater:
+			self.HighWater = len(entries)
+
+	def get(self, ip, default = None):
+		entry = self.Entries.get(ip)
+		return default if entry is None else entry[1]
+
+	def __getitem__(self, ip):
+		return self.Entries[ip][1]
+
+	def __contains__(self, ip):
+		return ip in self.Entries
+
+	def __len__(self):
+		return len(self.Entries)
+
+	def update(self, other):
+		for ip, domaininfo in other.items():
+			self[ip] = domaininfo
+
+	def items(self):
+		for ip, entry in self.Entries.items():
+			yield ip, entry[1]
+
+	def get_stats(self):
+		"""
+			Returns
+			----------
+			stats (string)
+				The window, the most ip addresses held at one time and the number of ip addresses evicted
+		"""
+
+		return f"{self.Window} second window, {self.HighWater} ip addresses at most, {self.Evictions} ip addresses evicted"
+
+class AttributionSnapshot(object):
+	"""
+		The ip address attribution carried from one daily run to the next, so a visitor who searched late on one day and
+		bought early the next is still attributed. Each ip address keeps the day its referrer was last seen, stored as
+		"day<tab>Domain|Keywords" in an AttributionTable, and ip addresses not seen for more than ttl days are dropped.
+		The snapshot file keeps the table from before and after the last day saved, so running that day again starts
+		from the same referrers as the first run of it. A day older than the last day saved can't be run with the
+		snapshot, because its table already holds referrers from after that day, and the saved day never moves back.
+	"""
+
+	def __init__(self, day, ttl = 1):
+		"""
+			Parameters
+			----------
+			day (int)
+				The ordinal of the day being run, only referrers from earlier days are looked up
+			ttl (int)
+				The most days a referrer is carried forward
+		"""
+
+		self.Day = day
+		self.TTL = ttl
+		self.Table = AttributionTable()
+
+	def is_live(self, day):
+		"""
+			Checks if a referrer from a day can be used by the day being run.
+		"""
+
+		return day < self.Day and self.Day - day <= self.TTL
+
+	def get(self, ip, default = None):
+		value = self.Table.get(ip)
+		if value is None:
+			return default
+
+		day, _, domaininfo = value.partition("\t")
+		return domaininfo if self.is_live(int(day)) else default
+
+	def __len__(self):
+		return len(self.Table)
+
+	def load(self, filename):
+		"""
+			Loads the snapshot saved by an earlier run, if there is one.
+
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the snapshot
+
+			Raises
+			----------
+			ValueError
+				When the snapshot was saved by a later day
+		"""
+
+		if not os.path.exists(filename):
+			return
+
+		with open(filename, "rb") as snapshotfile:
+			day = self.read_day(snapshotfile)
+			if day > self.Day:
+				raise ValueError(f"The attribution snapshot was saved by {date.fromordinal(day)}, a later day than {date.fromordinal(self.Day)}")
+			before, after = pickle.load(snapshotfile)
+
+		# a later day carries on from the last day saved, the same day starts from before it
+		self.Table = after if self.Day > day else before
+
+	def read_day(self, snapshotfile):
+		"""
+			Reads the day a snapshot was saved by, which is written ahead of its tables so it can be read on its own.
+
+			Parameters
+			----------
+			snapshotfile (file)
+				The snapshot file, open for reading at its start
+
+			Returns
+			----------
+			day (int)
+				The ordinal of the day saved
+		"""
+
+		return pickle.load(snapshotfile)
+
+	def save(self, filename, addressdict):
+		"""
+			Saves the referrers of the day being run and the referrers of earlier days that are still within the ttl.
+			The snapshot is written to a temporary file and renamed, so a run that dies while writing leaves the last
+			snapshot in place.
+
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the snapshot
+			addressdict (dict | AttributionTable | SpillStore)
+				The referrer of each ip address seen by the day being run
+
+			Returns
+			----------
+			count (int)
+				The number of ip addresses in the snapshot
+
+			Raises
+			----------
+			ValueError
+				When a later day has saved the snapshot since it was loaded
+		"""
+
+		if os.path.exists(filename):
+			with open(filename, "rb") as snapshotfile:
+				day = self.read_day(snapshotfile)
+			if day > self.Day:
+				raise ValueError(f"The attribution snapshot was saved by {date.fromordinal(day)} while {date.fromordinal(self.Day)} was running, it is not replaced")
+
+		table = AttributionTable()
+		table.IPv4.reserve(len(self.Table) + len(addressdict))
+
+		for ip, value in self.Table.items():
+			if self.is_live(int(value.partition("\t")[0])):
+				table[ip] = value
+
+		# referrers seen by this run replace the older ones
+		for ip, domaininfo in addressdict.items():
+			table[ip] = f"{self.Day}\t{domaininfo}"
+
+		with open(f"{filename}.tmp", "wb") as snapshotfile:
+			pickle.dump(self.Day, snapshotfile, protocol = pickle.HIGHEST_PROTOCOL)
+			pickle.dump((self.Table, table), snapshotfile, protocol = pickle.HIGHEST_PROTOCOL)
+		os.replace(f"{filename}.tmp", filename)
+
+		return len(table)
+
+class PackedSet(object):
+	"""
+		A compact set of ip addresses. IPv4 addresses are packed in to integers and stored in an open addressing table.
+	"""
+
+	def __init__(self, capacity = 1024):
+		self.IPv4 = IntTable(capacity)
+		self.Other = set()
+
+	def add(self, ip):
+		packed = pack_ip(ip)
+		if packed is not None and packed[0] == 4:
+			self.IPv4.set(packed[1], 1)
+		else:
+			self.Other.add(ip)
+
+	def __contains__(self, ip):
+		packed = pack_ip(ip)
+		if packed is not None and packed[0] == 4:
+			return self.IPv4.get(packed[1]) is not None
+		return ip in self.Other
+
+	def __len__(self):
+		return self.IPv4.Count + len(self.Other)
+
+class BloomFilter(object):
+	"""
+		A fixed size set of ip addresses that can return false positives but never false negatives.
+	"""
+
+	def __init__(self, size = 16 * 1024 * 1024, hashes = 4):
+		"""
+			Parameters
+			----------
+			size (int)
+				The size of the filter in bytes
+			hashes (int)
+				The number of bits set for each ip address
+		"""
+
+		self.Bits = bytearray(size)
+		self.BitCount = size * 8
+		self.Hashes = hashes
+		self.Count = 0
+
+	def get_positions(self, ip):
+		"""
+			Gets the bit positions of an ip address, using double hashing of one blake2b digest.
+
+			Parameters
+			----------
+			ip (string)
+				The ip address to hash
+
+			Returns
+			----------
+			positions (list)
+				The bit positions for the ip address
+		"""
+
+		digest = blake2b(ip.encode("utf8"), digest_size = 16).digest()
+		first = int.from_bytes(digest[:8], "little")
+		second = int.from_bytes(digest[8:], "little") | 1
+
+		return [(first + i * second) % self.BitCount for i in range(self.Hashes)]
+
+	def add(self, ip):
+		if ip not in self:
+			self.Count += 1
+		for position in self.get_positions(ip):
+			self.Bits[position >> 3] |= 1 << (position & 7)
+
+	def __contains__(self, ip):
+		bits = self.Bits
+		for position in self.get_positions(ip):
+			if not bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+	def __len__(self):
+		return self.Count
@@ -0,0 +1,434 @@
+from HitParser import HitParser
+from Helpers import LogLevel
+from Metrics import METRICS
+import time
+
+# numpy is only needed by the columnar engine
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+TAB = ord("\t")
+NEWLINE = ord("\n")
+COMMA = ord(",")
+ONE = ord("1")
+ESSHOPZILLA = numpy.frombuffer(b"esshopzilla", dtype = numpy.uint8) if numpy is not None else None
+# where esshopzilla starts in http://, https://, http://www. and https://www. referrers
+HOSTOFFSETS = [7, 8, 11, 12]
+
+def is_available():
+	"""
+		Returns
+		----------
+		available (bool)
+			True if numpy is installed, which the columnar engine needs
+	"""
+
+	return numpy is not None
+
+def match_at(data, starts, pattern):
+	"""
+		Checks which positions of an array of bytes a byte pattern starts at.
+
+		Parameters
+		----------
+		data (numpy.ndarray)
+			The bytes to check, as uint8
+		starts (numpy.ndarray)
+			The positions to check
+		pattern (numpy.ndarray)
+			The bytes to look for, as uint8
+
+		Returns
+		----------
+		matches (numpy.ndarray)
+			True for each position the pattern starts at
+	"""
+
+	last = len(data) - 1
+	matches = numpy.ones(len(starts), dtype = bool)
+	for offset, byte in enumerate(pattern.tolist()):
+		matches &= data[numpy.minimum(starts + offset, last)] == byte
+	return matches
+
+def factorize(block, data, starts, ends):
+	"""
+		Numbers each distinct value of a column, comparing the values as fixed width byte strings. Each value is
+		prefixed with its length, so values that only differ by trailing zero bytes stay distinct.
+
+		Parameters
+		----------
+		block (bytes)
+			The lines of the block
+		data (numpy.ndarray)
+			The same bytes as uint8
+		starts (numpy.ndarray)
+			The start of the value of each row
+		ends (numpy.ndarray)
+			The end of the value of each row
+
+		Returns
+		----------
+		ids (numpy.ndarray)
+			The id of the value of each row
+		values (list)
+			The bytes of each distinct value, indexed by id
+	"""
+
+	if not len(starts):
+		return numpy.zeros(0, dtype = numpy.int64), list()
+
+	lengths = ends - starts
+	width = int(lengths.max())
+	offsets = numpy.arange(width)
+	keys = numpy.zeros((len(starts), width + 4), dtype = numpy.uint8)
+	keys[:, :4] = lengths.astype(">u4").view(numpy.uint8).reshape(-1, 4)
+	keys[:, 4:] = numpy.where(offsets < lengths[:, None], data[numpy.minimum(starts[:, None] + offsets, len(data) - 1)], 0)
+
+	_, first, ids = numpy.unique(keys.view(f"S{width + 4}").ravel(), return_index = True, return_inverse = True)
+	values = [block[start:end] for start, end in zip(starts[first].tolist(), ends[first].tolist())]
+	return ids.ravel(), values
+
+class ColumnarParser(HitParser):
+	"""
+		A HitParser that parses large blocks of the file at a time as columns of numpy arrays instead of line by line.
+		Column boundaries, the esshopzilla filter and event 1 detection are found with array operations over the whole
+		block, so python only runs for referrer and purchase rows. Purchases are attributed with a forward fill of the
+		last referrer of each ip address within the block, and the ip address store is updated once per block with the
+		last referrer of each ip address. The results, line numbers and log messages are the same as the row engine.
+	"""
+
+	def __init__(self, log, addressdict = None, resultsdict = None, referrercache = None, carryover = None):
+		"""
+			Parameters
+			----------
+			log (Logger)
+				The log to write errors and purchases to
+			addressdict (dict)
+				Optional dictionary of relevant ip addresses to start from (IP: DomainInfo)
+			resultsdict (dict)
+				Optional dictionary of grouped revenue to start from (Domain|KeyWords: Revenue)
+			referrercache (ReferrerCache)
+				Optional cache of parsed referrer urls, which can be shared between parsers
+			carryover (AttributionSnapshot)
+				Optional referrers of ip addresses from earlier days, used for purchases from ip addresses with no referrer yet
+		"""
+
+		if numpy is None:
+			raise ImportError("The numpy package is needed by the columnar engine")
+
+		super().__init__(log, addressdict, resultsdict, referrercache, carryover = carryover)
+
+	def parse(self, blocks, skipheader = True):
+		"""
+			Iterate through the input stream one block at a time.
+
+			Parameters
+			----------
+			blocks (Stream)
+				The stream of bytes blocks to read, each ending on a line break
+			skipheader (bool)
+				Skip the first line of the stream as a header record
+
+			Returns
+			----------
+			linecount (int)
+				The number of lines parsed, not including the header
+		"""
+
+		linecount = self.LineCount
+
+		for block in blocks:
+			# a part of the input shorter than a line holds no whole lines
+			if not block:
+				continue
+
+			if b"\r" in block:
+				# carriage returns also end lines for the row engine, so these rare blocks are parsed line by line
+				super().parse(iter(block.splitlines()), skipheader)
+			else:
+				if skipheader:
+					newline = block.find(b"\n")
+					block = block[newline + 1:] if newline >= 0 else b""
+				self.parse_block(block)
+			skipheader = False
+
+		return self.LineCount - linecount
+
+	def parse_block(self, block):
+		"""
+			Parses one block of whole lines.
+
+			Parameters
+			----------
+			block (bytes)
+				The lines of the block, without carriage returns
+		"""
+
+		if not block:
+			return
+
+		starttime = time.perf_counter()
+		if block[-1] != NEWLINE:
+			block += b"\n"
+
+		data = numpy.frombuffer(block, dtype = numpy.uint8)
+
+		# every tab and line break in order, a record has 12 columns when its line has exactly 11 tabs
+		separators = numpy.flatnonzero((data == TAB) | (data == NEWLINE))
+		lineends = numpy.flatnonzero(data[separators] == NEWLINE)
+		newlines = separators[lineends]
+		rowcount = len(newlines)
+		valid = numpy.diff(lineends, prepend = -1) == 12
+		rows = numpy.flatnonzero(valid)
+		columns = separators[lineends[rows, None] + numpy.arange(-11, 0)]
+
+		# start and end of the columns of each row, invalid rows get empty columns
+		ipstart = numpy.zeros(rowcount, dtype = numpy.int64)
+		ipend = numpy.zeros(rowcount, dtype = numpy.int64)
+		eventstart = numpy.zeros(rowcount, dtype = numpy.int64)
+		eventend = numpy.zeros(rowcount, dtype = numpy.int64)
+		productstart = numpy.zeros(rowcount, dtype = numpy.int64)
+		productend = numpy.zeros(rowcount, dtype = numpy.int64)
+		urlstart = numpy.zeros(rowcount, dtype = numpy.int64)
+		ipstart[rows] = columns[:, 2] + 1
+		ipend[rows] = columns[:, 3]
+		eventstart[rows] = columns[:, 3] + 1
+		eventend[rows] = columns[:, 4]
+		productstart[rows] = columns[:, 9] + 1
+		productend[rows] = columns[:, 10]
+		urlstart[rows] = columns[:, 10] + 1
+
+		# rows with an event of exactly 1, as the first or last event of the list, or as the only event
+		eventlength = eventend - eventstart
+		firstone = (data[eventstart] == ONE) & ((eventlength == 1) | (data[numpy.minimum(eventstart + 1, len(data) - 1)] == COMMA))
+		lastone = (data[eventend - 1] == ONE) & (data[numpy.maximum(eventend - 2, 0)] == COMMA)
+		purchase = (eventlength > 0) & (firstone | lastone)
+		# a 1 in the middle of a longer list is rare enough to check row by row
+		for row in numpy.flatnonzero((eventlength > 2) & ~purchase).tolist():
+			if b",1," in block[eventstart[row]:eventend[row]]:
+				purchase[row] = True
+
+		# internal referrers almost always start with the esshopzilla host, any others are caught by the referrer lookup
+		internal = numpy.zeros(rowcount, dtype = bool)
+		for offset in HOSTOFFSETS:
+			internal |= match_at(data, urlstart + offset, ESSHOPZILLA)
+
+		# row: error message, for rows that hit an exception, which stops the rest of the row as in the row engine
+		errors = dict()
+		referrers = self.lookup_referrers(block, numpy.flatnonzero(valid & ~internal), urlstart, newlines, errors)
+
+		purchaserows = [row for row in numpy.flatnonzero(purchase).tolist() if row not in errors]
+		referrerrows = [row for row in referrers if row not in errors]
+		attribution = self.attribute(block, data, referrerrows, referrers, purchaserows, ipstart, ipend, errors)
+
+		self.finish_block(block, numpy.flatnonzero(~valid).tolist(), errors, purchaserows, attribution, productstart, productend)
+
+		self.LineCount += rowcount
+		METRICS.observe("columnar_block", time.perf_counter() - starttime)
+
+	def lookup_referrers(self, block, rows, urlstart, newlines, errors):
+		"""
+			Parses the referrer of each row that isn't from esshopzilla.
+
+			Parameters
+			----------
+			block (bytes)
+				The lines of the block
+			rows (numpy.ndarray)
+				The rows to parse the referrer of, in order
+			urlstart (numpy.ndarray)
+				The start of the referrer column of each row
+			newlines (numpy.ndarray)
+				The end of each row
+			errors (dict)
+				The error message of each row that hits an exception, added to
+
+			Returns
+			----------
+			referrers (dict)
+				The domain info of each row with a search engine referrer, in row order (row: DomainInfo)
+		"""
+
+		lookup = self.ReferrerCache.lookup
+		referrers = dict()
+
+		for row, start, end in zip(rows.tolist(), urlstart[rows].tolist(), newlines[rows].tolist()):
+			url = block[start:end]
+			if b"esshopzilla" in url:
+				continue
+
+			try:
+				domaininfo = lookup(url)
+			except Exception as ex:
+				errors[row] = f"unhandled exception processing line: {ex}"
+				continue
+
+			if domaininfo is not None:
+				referrers[row] = domaininfo
+
+		return referrers
+
+	def attribute(self, block, data, referrerrows, referrers, purchaserows, ipstart, ipend, errors):
+		"""
+			Finds the referrer of each purchase row and stores the last referrer of each ip address in the block.
+			Referrer and purchase rows are sorted by ip address and then by row, so a running maximum of the position of the
+			last referrer row forward fills each purchase with the referrer before it from the same ip address. Purchases
+			from ip addresses with no referrer earlier in the block fall back to the ip address store as it was before the
+			block.
+
+			Parameters
+			----------
+			block (bytes)
+				The lines of the block
+			data (numpy.ndarray)
+				The same bytes as uint8
+			referrerrows (list)
+				The rows with a search engine referrer, in order
+			referrers (dict)
+				The domain info of each referrer row (row: DomainInfo)
+			purchaserows (list)
+				The rows with a purchase event, in order
+			ipstart (numpy.ndarray)
+				The start of the ip column of each row
+			ipend (numpy.ndarray)
+				The end of the ip column of each row
+			errors (dict)
+				The error message of each row that hits an exception, added to
+
+			Returns
+			----------
+			attribution (dict)
+				The ip address and domain info of each purchase row, domain info is None for purchases with no referrer (row: (IP, DomainInfo))
+		"""
+
+		eventrows = numpy.array(referrerrows + purchaserows, dtype = numpy.int64)
+		# referrers sort before purchases of the same row, as the row engine stores the referrer of a row first
+		kinds = numpy.repeat(numpy.array([0, 1], dtype = numpy.int8), [len(referrerrows), len(purchaserows)])
+
+		# number each distinct ip address, and decode each one once
+		eventips, values = factorize(block, data, ipstart[eventrows], ipend[eventrows])
+		addresses = list()
+		for ip in values:
+			try:
+				addresses.append(ip.decode("utf8"))
+			except UnicodeDecodeError as ex:
+				addresses.append(ex)
+
+		order = numpy.lexsort((kinds, eventrows, eventips))
+		sortedips = eventips[order]
+		sortedrows = eventrows[order].tolist()
+		isreferrer = kinds[order] == 0
+
+		# rows with an ip address that can't be decoded stop there in the row engine, so they don't store a referrer
+		baddresses = numpy.array([type(address) is not str for address in addresses], dtype = bool)
+		for position in numpy.flatnonzero(baddresses[sortedips]).tolist():
+			errors[sortedrows[position]] = f"unhandled exception processing line: {addresses[sortedips[position]]}"
+			isreferrer[position] = False
+
+		# forward fill the position of the last referrer, which belongs to the same ip address if the ip id matches
+		last = numpy.maximum.accumulate(numpy.where(isreferrer, numpy.arange(len(order)), -1))
+		matched = last >= 0
+		matched[matched] = sortedips[last[matched]] == sortedips[matched]
+
+		addressdict = self.AddressDict
+		carryover = self.CarryOver
+		attribution = dict()
+
+		for position in numpy.flatnonzero(~isreferrer).tolist():
+			row = sortedrows[position]
+			if row in errors:
+				continue
+
+			address = addresses[sortedips[position]]
+			if matched[position]:
+				domaininfo = referrers[sortedrows[last[position]]]
+			else:
+				domaininfo = addressdict.get(address)
+				if domaininfo is None and carryover is not None:
+					domaininfo = carryover.get(address)
+			attribution[row] = (address, domaininfo)
+
+		# the last event of each ip address holds the position of its last referrer
+		groupends = numpy.flatnonzero(numpy.append(sortedips[1:] != sortedips[:-1], True)) if len(order) else order
+		positions = last[groupends[matched[groupends]]]
+		for position in positions[numpy.argsort(eventrows[order][positions])].tolist():
+			addressdict[addresses[sortedips[position]]] = referrers[sortedrows[position]]
+
+		return attribution
+
+	def finish_block(self, block, invalidrows, errors, purchaserows, attribution, productstart, productend):
+		"""
+			Logs bad rows and records the revenue of each attributed purchase, in row order.
+
+			Parameters
+			----------
+			block (bytes)
+				The lines of the block
+			invalidrows (list)
+				The rows that don't have 12 columns
+			errors (dict)
+				The error message of each row that hit an exception
+			purchaserows (list)
+				The rows with a purchase event
+			attribution (dict)
+				The ip address and domain info of each purchase row (row: (IP, DomainInfo))
+			productstart (numpy.ndarray)
+				The start of the product list column of each row
+			productend (numpy.ndarray)
+				The end of the product list column of each row
+		"""
+
+		linenumber = self.LineCount + 1
+		productstart = productstart.tolist()
+		productend = productend.tolist()
+		# the domain info and total revenue of each purchase with revenue, in row order
+		groups = list()
+		revenues = list()
+
+		for row in sorted(set(invalidrows).union(errors, purchaserows)):
+			if row in errors:
+				self.log_line(LogLevel.ERROR, linenumber + row, errors[row])
+			elif row in attribution:
+				address, domaininfo = attribution[row]
+				try:
+					productlist = block[productstart[row]:productend[row]].decode("utf8")
+					if domaininfo is None:
+						continue
+
+					totalrevenue = self.get_revenue(linenumber + row, productlist)
+					if totalrevenue > 0:
+						groups.append(domaininfo)
+						revenues.append(totalrevenue)
+						self.Log.write(LogLevel.DEBUG, f"Purchase found for ip {address}")
+					else:
+						self.log_line(LogLevel.ERROR, linenumber + row, "Record shows a verified purchase, but total revenue could not be determined.")
+				except Exception as ex:
+					self.log_line(LogLevel.ERROR, linenumber + row, f"unhandled exception processing line: {ex}")
+			else:
+				self.log_line(LogLevel.ERROR, linenumber + row, "Record does not contain 12 columns. Possible invalid file format.")
+
+		self.add_revenues(groups, revenues)
+
+	def add_revenues(self, groups, revenues):
+		"""
+			Adds the revenue of each purchase of a block to its group. numpy.add.at adds the purchases of each group one
+			at a time in order, so every group sums to exactly the same float as adding them one by one.
+
+			Parameters
+			----------
+			groups (list)
+				The domain and keywords of each purchase (Domain|Keywords)
+			revenues (list)
+				The revenue of each purchase
+		"""
+
+		if not groups:
+			return
+
+		groupids = dict()
+		ids = [groupids.setdefault(domaininfo, len(groupids)) for domaininfo in groups]
+		totals = numpy.array([self.ResultsDict.get(domaininfo, 0.0) for domaininfo in groupids], dtype = numpy.float64)
+		numpy.add.at(totals, numpy.array(ids, dtype = numpy.int64), numpy.array(revenues, dtype = numpy.float64))
+		self.ResultsDict.update(zip(groupids, totals.tolist()))
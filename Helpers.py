@@ -1,17 +1,241 @@
 import os
+import bz2
+import hashlib
+import hmac
+import mmap
+import pickle
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import deque, OrderedDict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from boto3 import client as botoclient, resource as botoresource
+from botocore.config import Config as BotoConfig
+from Metrics import METRICS
+
+# zstandard is only needed to read zstd compressed files
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# magic bytes and file extensions of the compression formats that can be read while streaming
+COMPRESSIONMAGIC = {"gzip": b"\x1f\x8b", "bz2": b"BZh", "zstd": b"\x28\xb5\x2f\xfd"}
+COMPRESSIONEXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".bz2": "bz2", ".zst": "zstd", ".zstd": "zstd"}
+
+def detect_compression(head, name = ""):
+	"""
+		Detects the compression of a file from its first bytes, or from its extension when the bytes don't match.
+
+		Parameters
+		----------
+		head (bytes)
+			The first bytes of the file
+		name (string)
+			The name of the file
+
+		Returns
+		----------
+		compression (string)
+			'gzip', 'bz2' or 'zstd', or None if the file is not compressed
+	"""
+
+	for compression, magic in COMPRESSIONMAGIC.items():
+		if head.startswith(magic):
+			return compression
+
+	return COMPRESSIONEXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+def split_lines(chunks):
+	"""
+		Splits a stream of bytes chunks in to lines, the same way as splitting all of the chunks joined together.
+
+		Parameters
+		----------
+		chunks (iterator)
+			The bytes chunks in order
+
+		Returns
+		----------
+		lines (iterator)
+			The lines without line endings
+	"""
+
+	pending = b""
+	for chunk in chunks:
+		data = pending + chunk
+		# a line feed always ends a line, so the data up to the last one can be split now
+		pos = data.rfind(b"\n") + 1
+		pending = data[pos:]
+		yield data[:pos].splitlines()
+
+	if pending:
+		yield pending.splitlines()
+
+def split_blocks(chunks, start = 0):
+	"""
+		Regroups a stream of bytes chunks in to blocks that end on line breaks, along with the byte offset each block ends
+		at. The last block holds any data after the last line break.
+
+		Parameters
+		----------
+		chunks (iterator)
+			The bytes chunks in order
+		start (int)
+			The byte offset of the first chunk
+
+		Returns
+		----------
+		blocks (iterator)
+			(offset after the last line, bytes) for each chunk
+	"""
+
+	position = start
+	pending = b""
+	for chunk in chunks:
+		data = pending + chunk
+		pos = data.rfind(b"\n") + 1
+		pending = data[pos:]
+		position += pos
+		yield position, data[:pos]
+
+	if pending:
+		yield position + len(pending), pending
+
+def split_line_batches(chunks, start = 0):
+	"""
+		Splits a stream of bytes chunks in to lines the same way as split_lines, along with the byte offset each batch
+		of lines ends at, so a reader can record how far through the stream it is.
+
+		Parameters
+		----------
+		chunks (iterator)
+			The bytes chunks in order
+		start (int)
+			The byte offset of the first chunk
+
+		Returns
+		----------
+		batches (iterator)
+			(offset after the last line, lines) for each chunk
+	"""
+
+	for position, block in split_blocks(chunks, start):
+		yield position, block.splitlines()
+
+class StreamDecompressor(object):
+	"""
+		Decompresses a gzip, bzip2 or zstd stream one chunk at a time, including files made of several concatenated streams
+	"""
+
+	def __init__(self, compression):
+		"""
+			Parameters
+			----------
+			compression (string)
+				'gzip', 'bz2' or 'zstd'
+		"""
+
+		self.Compression = compression
+		self.CompressedBytes = 0
+		self.DecompressedBytes = 0
+		self.Seconds = 0
+		self.Decompressor = self.create()
+
+	def create(self):
+		"""
+			Creates a decompressor for one stream.
+
+			Returns
+			----------
+			decompressor (object)
+				A decompressor with decompress, eof and unused_data
+		"""
+
+		if self.Compression == "gzip":
+			return zlib.decompressobj(16 + zlib.MAX_WBITS)
+		elif self.Compression == "bz2":
+			return bz2.BZ2Decompressor()
+		elif zstandard is None:
+			raise ImportError("The zstandard package is needed to read zstd compressed files")
+
+		return zstandard.ZstdDecompressor().decompressobj()
+
+	def decompress(self, data):
+		"""
+			Decompresses the next chunk of the compressed stream.
+
+			Parameters
+			----------
+			data (bytes)
+				The next compressed chunk
+
+			Returns
+			----------
+			data (bytes)
+				The decompressed bytes available so far
+		"""
+
+		starttime = time.perf_counter()
+		self.CompressedBytes += len(data)
+		output = list()
+
+		while len(data):
+			# start the next stream of a file made of concatenated streams
+			if self.Decompressor.eof:
+				self.Decompressor = self.create()
+			output.append(self.Decompressor.decompress(data))
+			data = self.Decompressor.unused_data if self.Decompressor.eof else b""
+
+		result = b"".join(output)
+		self.DecompressedBytes += len(result)
+		seconds = time.perf_counter() - starttime
+		self.Seconds += seconds
+		METRICS.observe("decompress", seconds)
+		METRICS.count("decompressed_bytes", len(result))
+
+		return result
+
+	def iter_decompress(self, chunks, log = None):
+		"""
+			Decompresses a stream of compressed chunks.
+
+			Parameters
+			----------
+			chunks (iterator)
+				The compressed chunks in order
+			log (Logger)
+				Optional log to write the decompression rate and compression ratio to at the end of the stream
+
+			Returns
+			----------
+			chunks (iterator)
+				The decompressed chunks in order
+		"""
+
+		for chunk in chunks:
+			yield self.decompress(chunk)
+
+		if log is not None:
+			ratio = self.DecompressedBytes / max(self.CompressedBytes, 1)
+			rate = self.DecompressedBytes / max(self.Seconds, 1e-9) / 1048576
+			log.write(LogLevel.INFO, f"Decompression: {self.Compression}, {self.CompressedBytes} bytes decompressed to {self.DecompressedBytes} bytes, {ratio:.2f} compression ratio, {rate:.2f} MB/s decompressed")
 
 class S3Client(object):
 	"""
 		A class that contains information relevant to the S3 client
 	"""
 
-	def __init__(self, path = ""):
+	def __init__(self, path = "", client = None, resource = None):
 		self.Bucket = ""
 		self.Path = ""
 		self.BaseName = ""
-		self.Client = botoclient("s3")
-		self.Resource = botoresource("s3")
+		# clients can be shared between S3Clients, so a batch of files reuses one connection pool
+		self.Client = botoclient("s3") if client is None else client
+		self.Resource = botoresource("s3") if resource is None else resource
 		self.Key = ""
 		self.Path = path
 
@@ -40,6 +264,801 @@ class S3Client(object):
 		if pos > 0:
 			self.Path = self.Key[:pos]
 
+	def __reduce__(self):
+		# boto3 clients can't be pickled, so a copy sent to another process creates its own
+		return (S3Client, (f"{self.Bucket}/{self.Key}",))
+
+	def get_size(self):
+		"""
+			Gets the size of the S3 object.
+
+			Returns
+			----------
+			size (int)
+				The size of the S3 object in bytes
+		"""
+
+		return self.Client.head_object(Bucket = self.Bucket, Key = self.Key)['ContentLength']
+
+	def get_version(self):
+		"""
+			Gets the version of the S3 object, which changes when the object is uploaded again.
+
+			Returns
+			----------
+			version (string)
+				The ETag of the S3 object
+		"""
+
+		return self.Client.head_object(Bucket = self.Bucket, Key = self.Key)['ETag']
+
+	def read_range(self, start, end):
+		"""
+			Reads a byte range of the S3 object.
+
+			Parameters
+			----------
+			start (int)
+				The first byte to read
+			end (int)
+				The byte to stop reading at, not included in the result
+
+			Returns
+			----------
+			data (bytes)
+				The bytes in the range
+		"""
+
+		return self.Client.get_object(Bucket = self.Bucket, Key = self.Key, Range = f"bytes={start}-{end - 1}")['Body'].read()
+
+	def read_lines(self, start, end):
+		"""
+			Reads a byte range of the S3 object line by line, splitting lines the same way as the S3 stream does.
+
+			Parameters
+			----------
+			start (int)
+				The first byte to read
+			end (int)
+				The byte to stop reading at
+
+			Returns
+			----------
+			lines (iterator)
+				The lines in the range without line endings
+		"""
+
+		return iter(self.read_range(start, end).splitlines())
+
+class MappedFile(object):
+	"""
+		A local file that is memory mapped, giving the same ranged access to the file that S3Client gives to an S3 object.
+		Lines are split out of windows of the mapping, so the file is never copied through a buffered reader.
+	"""
+
+	# the size of each window of the mapping that is split in to lines, small enough to stay in the cpu cache
+	WINDOWSIZE = 1024 * 1024
+
+	def __init__(self, path):
+		self.Path = path
+		self.Size = os.path.getsize(path)
+		self.Map = None
+
+		# an empty file can't be mapped
+		if self.Size > 0:
+			with open(path, "rb") as infile:
+				self.Map = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+
+	def __reduce__(self):
+		# a copy sent to another process maps the file again, which shares the same pages of the page cache
+		return (MappedFile, (self.Path,))
+
+	def get_size(self):
+		"""
+			Gets the size of the local file.
+
+			Returns
+			----------
+			size (int)
+				The size of the file in bytes
+		"""
+
+		return self.Size
+
+	def get_version(self):
+		"""
+			Gets the version of the local file, which changes when the file is written again.
+
+			Returns
+			----------
+			version (string)
+				The modification time of the file in nanoseconds
+		"""
+
+		return str(os.stat(self.Path).st_mtime_ns)
+
+	def read_range(self, start, end):
+		"""
+			Reads a byte range of the local file.
+
+			Parameters
+			----------
+			start (int)
+				The first byte to read
+			end (int)
+				The byte to stop reading at, not included in the result
+
+			Returns
+			----------
+			data (bytes)
+				The bytes in the range
+		"""
+
+		return self.Map[start:end] if self.Map is not None else b""
+
+	def read_lines(self, start = 0, end = None):
+		"""
+			Reads a byte range of the local file line by line. Lines are split the same way as the S3 stream does.
+
+			Parameters
+			----------
+			start (int)
+				The first byte to read
+			end (int)
+				The byte to stop reading at, defaults to the end of the file
+
+			Returns
+			----------
+			lines (iterator)
+				The lines in the range without line endings
+		"""
+
+		# chain the lists of lines so iterating over them stays in C
+		return chain.from_iterable(lines for windowend, lines in self.read_windows(start, self.Size if end is None else end))
+
+	def read_windows(self, start, end):
+		"""
+			Splits a byte range of the mapping in to windows that end on line breaks, and splits each window in to lines.
+
+			Parameters
+			----------
+			start (int)
+				The first byte to read
+			end (int)
+				The byte to stop reading at
+
+			Returns
+			----------
+			windows (iterator)
+				(offset the window ends at, lines) for each window
+		"""
+
+		for windowend, block in self.read_blocks(start, end):
+			yield windowend, block.splitlines()
+
+	def read_blocks(self, start, end, blocksize = None):
+		"""
+			Splits a byte range of the mapping in to blocks that end on line breaks.
+
+			Parameters
+			----------
+			start (int)
+				The first byte to read
+			end (int)
+				The byte to stop reading at
+			blocksize (int)
+				The target size of each block in bytes, defaults to WINDOWSIZE
+
+			Returns
+			----------
+			blocks (iterator)
+				(offset the block ends at, bytes) for each block
+		"""
+
+		blocksize = blocksize or self.WINDOWSIZE
+		position = start
+
+		while position < end:
+			blockend = min(position + blocksize, end)
+
+			# end each block on a line break so no line is split across blocks
+			if blockend < end:
+				newline = self.Map.rfind(b"\n", position, blockend)
+				if newline < 0:
+					newline = self.Map.find(b"\n", blockend, end)
+				blockend = end if newline < 0 else newline + 1
+
+			yield blockend, self.Map[position:blockend]
+			position = blockend
+
+	def iter_lines(self, log = None):
+		"""
+			Reads the whole file line by line. Compressed files are decompressed as they are read.
+
+			Parameters
+			----------
+			log (Logger)
+				Optional log to write the decompression rate and compression ratio to
+
+			Returns
+			----------
+			lines (iterator)
+				The lines of the file without line endings
+		"""
+
+		compression = detect_compression(self.read_range(0, 4), self.Path)
+		if compression is None:
+			return self.read_lines()
+
+		windows = (self.Map[position:position + self.WINDOWSIZE] for position in range(0, self.Size, self.WINDOWSIZE))
+		return chain.from_iterable(split_lines(StreamDecompressor(compression).iter_decompress(windows, log)))
+
+	def iter_blocks(self, blocksize, log = None):
+		"""
+			Reads the whole file in blocks that end on line breaks. Compressed files are decompressed as they are read.
+
+			Parameters
+			----------
+			blocksize (int)
+				The target size of each block in bytes
+			log (Logger)
+				Optional log to write the decompression rate and compression ratio to
+
+			Returns
+			----------
+			blocks (iterator)
+				The bytes of each block
+		"""
+
+		compression = detect_compression(self.read_range(0, 4), self.Path)
+		if compression is None:
+			return (block for blockend, block in self.read_blocks(0, self.Size, blocksize))
+
+		windows = (self.Map[position:position + blocksize] for position in range(0, self.Size, blocksize))
+		return (block for blockend, block in split_blocks(StreamDecompressor(compression).iter_decompress(windows, log)))
+
+	def close(self):
+		"""
+			Closes the memory map of the file.
+		"""
+
+		if self.Map is not None:
+			self.Map.close()
+
+class RangedS3Reader(object):
+	"""
+		Reads an S3 object as concurrent HTTP Range requests over a pooled S3 client, and reassembles the parts in order
+	"""
+
+	def __init__(self, s3client, partsize = 8 * 1024 * 1024, concurrency = 8, prefetch = None, client = None, log = None, start = 0):
+		"""
+			Parameters
+			----------
+			s3client (S3Client)
+				The S3Client pointed at the object to read
+			partsize (int)
+				The size in bytes of each range request
+			concurrency (int)
+				The number of range requests to run at the same time
+			prefetch (int)
+				The most parts to hold in memory ahead of the reader, defaults to twice the concurrency
+			client (botocore client)
+				Optional S3 client to make the range requests with, a client with a connection pool sized to the concurrency is created by default
+			log (Logger)
+				Optional log to write the throughput of each part to
+			start (int)
+				The byte offset to start reading from, such as the offset of a checkpoint
+		"""
+
+		self.Bucket = s3client.Bucket
+		self.Key = s3client.Key
+		self.PartSize = partsize
+		self.Concurrency = max(1, concurrency)
+		self.Prefetch = max(self.Concurrency, prefetch or self.Concurrency * 2)
+		self.Client = client if client is not None else botoclient("s3", config = BotoConfig(max_pool_connections = self.Concurrency))
+		self.Log = log
+		self.Size = self.Client.head_object(Bucket = self.Bucket, Key = self.Key)['ContentLength']
+		self.Start = min(start, self.Size)
+		# (part number, bytes, seconds) for each part read
+		self.PartStats = list()
+
+	def read_part(self, part):
+		"""
+			Reads one part of the object with a range request.
+
+			Parameters
+			----------
+			part (int)
+				The part number to read
+
+			Returns
+			----------
+			data (bytes)
+				The bytes of the part
+		"""
+
+		start = self.Start + part * self.PartSize
+		end = min(start + self.PartSize, self.Size) - 1
+
+		starttime = time.time()
+		data = self.Client.get_object(Bucket = self.Bucket, Key = self.Key, Range = f"bytes={start}-{end}")['Body'].read()
+		self.PartStats.append((part, len(data), time.time() - starttime))
+
+		return data
+
+	def iter_parts(self):
+		"""
+			Reads the parts of the object in order, with up to Prefetch parts requested ahead of the reader.
+
+			Returns
+			----------
+			parts (iterator)
+				The bytes of each part in order
+		"""
+
+		partcount = (self.Size - self.Start + self.PartSize - 1) // self.PartSize
+		nextpart = 0
+		pending = deque()
+
+		with ThreadPoolExecutor(max_workers = self.Concurrency) as executor:
+			while nextpart < partcount or len(pending):
+				# keep the prefetch window full
+				while nextpart < partcount and len(pending) < self.Prefetch:
+					pending.append(executor.submit(self.read_part, nextpart))
+					nextpart += 1
+
+				yield pending.popleft().result()
+
+		# parts are timed on the reader threads and added to the metrics here, on the thread that owns them
+		for part, size, seconds in self.PartStats:
+			METRICS.observe("s3_read", seconds)
+			METRICS.count("s3_bytes", size)
+
+		self.log_stats()
+
+	def iter_lines(self):
+		"""
+			Reads the object line by line, splitting lines the same way as the iter_lines of a single S3 stream.
+			Compressed objects are decompressed as they are read.
+
+			Returns
+			----------
+			lines (iterator)
+				The lines of the object without line endings
+		"""
+
+		parts = self.iter_parts()
+		first = next(parts, b"")
+		parts = chain([first], parts)
+
+		compression = detect_compression(first, self.Key)
+		if compression is not None:
+			parts = StreamDecompressor(compression).iter_decompress(parts, self.Log)
+
+		return chain.from_iterable(split_lines(parts))
+
+	def iter_blocks(self):
+		"""
+			Reads the object in blocks that end on line breaks, one block for each part. Compressed objects are
+			decompressed as they are read.
+
+			Returns
+			----------
+			blocks (iterator)
+				The bytes of each block
+		"""
+
+		parts = self.iter_parts()
+		first = next(parts, b"")
+		parts = chain([first], parts)
+
+		compression = detect_compression(first, self.Key)
+		if compression is not None:
+			parts = StreamDecompressor(compression).iter_decompress(parts, self.Log)
+
+		return (block for blockend, block in split_blocks(parts))
+
+	def iter_batches(self, split = True):
+		"""
+			Reads an uncompressed object in batches of lines, with the byte offset each batch ends at.
+
+			Parameters
+			----------
+			split (bool)
+				Split each batch in to lines, otherwise each batch holds one block of whole lines
+
+			Returns
+			----------
+			batches (iterator)
+				(offset after the last line, lines) for each part
+		"""
+
+		if split:
+			return split_line_batches(self.iter_parts(), self.Start)
+		return ((blockend, [block]) for blockend, block in split_blocks(self.iter_parts(), self.Start))
+
+	def log_stats(self):
+		"""
+			Writes the throughput of each part and of the whole object to the log.
+		"""
+
+		if self.Log is None:
+			return
+
+		totalbytes = 0
+		for part, size, seconds in sorted(self.PartStats):
+			totalbytes += size
+			self.Log.write(LogLevel.DEBUG, f"S3 Part: {part}\t{size} bytes\t{size / max(seconds, 1e-9) / 1048576:.2f} MB/s")
+
+		if len(self.PartStats):
+			partseconds = sum(stat[2] for stat in self.PartStats)
+			self.Log.write(LogLevel.INFO, f"S3 Read: {totalbytes} bytes in {len(self.PartStats)} parts, average {totalbytes / max(partseconds, 1e-9) / 1048576:.2f} MB/s per part")
+
+class S3MultipartWriter(object):
+	"""
+		Writes text to an S3 object as a multipart upload. Each part is uploaded on a thread pool as soon as it fills, while
+		the writer carries on producing the next one, so the object never has to land on local storage first.
+		Objects smaller than one part are sent with a single put instead.
+	"""
+
+	# S3 rejects parts smaller than 5MB, apart from the last part
+	MINPARTSIZE = 5 * 1024 * 1024
+
+	def __init__(self, client, bucket, key, partsize = 8 * 1024 * 1024, concurrency = 4, log = None):
+		"""
+			Parameters
+			----------
+			client (botocore client)
+				The S3 client to upload with
+			bucket (string)
+				The bucket to write to
+			key (string)
+				The key of the object to write
+			partsize (int)
+				The size in bytes of each part, at least 5MB
+			concurrency (int)
+				The most parts to upload at the same time, the writer waits when this many parts are in flight
+			log (Logger)
+				Optional log to write the throughput of the upload to
+		"""
+
+		self.Client = client
+		self.Bucket = bucket
+		self.Key = key
+		self.PartSize = max(partsize, self.MINPARTSIZE)
+		self.Concurrency = max(1, concurrency)
+		self.Log = log
+		# text waiting to fill a part, and its length in characters, which is never more than its length in bytes
+		self.Buffer = list()
+		self.BufferSize = 0
+		self.UploadId = None
+		self.Executor = None
+		# the futures of every part in order, and the ones still in flight
+		self.Parts = list()
+		self.Pending = deque()
+		# (part number, bytes, seconds) for each part uploaded
+		self.PartStats = list()
+		self.StartTime = time.time()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+	def write(self, text):
+		"""
+			Writes text to the object.
+
+			Parameters
+			----------
+			text (string)
+				The text to write
+		"""
+
+		self.Buffer.append(text)
+		self.BufferSize += len(text)
+		if self.BufferSize >= self.PartSize:
+			self.flush_part()
+
+	def writelines(self, lines):
+		"""
+			Writes each line to the object.
+
+			Parameters
+			----------
+			lines (iterator)
+				The lines to write, with their line endings
+		"""
+
+		for line in lines:
+			self.write(line)
+
+	def flush_part(self):
+		"""
+			Hands the buffered text to the thread pool as the next part, starting the multipart upload with the first part.
+		"""
+
+		if self.UploadId is None:
+			self.UploadId = self.Client.create_multipart_upload(Bucket = self.Bucket, Key = self.Key)['UploadId']
+			self.Executor = ThreadPoolExecutor(max_workers = self.Concurrency)
+
+		# keep the parts held in memory to the parts in flight
+		while len(self.Pending) >= self.Concurrency:
+			self.Pending.popleft().result()
+
+		data = "".join(self.Buffer).encode("utf8")
+		self.Buffer = list()
+		self.BufferSize = 0
+
+		future = self.Executor.submit(self.upload_part, len(self.Parts) + 1, data)
+		self.Parts.append(future)
+		self.Pending.append(future)
+
+	def upload_part(self, number, data):
+		"""
+			Uploads one part of the object.
+
+			Parameters
+			----------
+			number (int)
+				The part number, starting from 1
+			data (bytes)
+				The bytes of the part
+
+			Returns
+			----------
+			part (dict)
+				The part number and ETag of the part, as complete_multipart_upload takes them
+		"""
+
+		starttime = time.time()
+		response = self.Client.upload_part(Bucket = self.Bucket, Key = self.Key, UploadId = self.UploadId, PartNumber = number, Body = data)
+		self.PartStats.append((number, len(data), time.time() - starttime))
+
+		return {'ETag': response['ETag'], 'PartNumber': number}
+
+	def close(self):
+		"""
+			Uploads the last part and completes the upload, or puts the whole object if it is smaller than one part.
+		"""
+
+		if self.UploadId is None:
+			data = "".join(self.Buffer).encode("utf8")
+			self.Buffer = list()
+			with METRICS.timer("upload"):
+				self.Client.put_object(Bucket = self.Bucket, Key = self.Key, Body = data)
+			METRICS.count("upload_bytes", len(data))
+			return
+
+		if self.BufferSize > 0:
+			self.flush_part()
+
+		try:
+			parts = [future.result() for future in self.Parts]
+			self.Client.complete_multipart_upload(Bucket = self.Bucket, Key = self.Key, UploadId = self.UploadId, MultipartUpload = {'Parts': parts})
+		except Exception:
+			self.abort()
+			raise
+
+		self.Executor.shutdown()
+		self.log_stats()
+
+	def abort(self):
+		"""
+			Stops the upload and removes the parts already uploaded.
+		"""
+
+		if self.UploadId is None:
+			return
+
+		self.Executor.shutdown(wait = True, cancel_futures = True)
+		self.Client.abort_multipart_upload(Bucket = self.Bucket, Key = self.Key, UploadId = self.UploadId)
+		self.UploadId = None
+
+	def log_stats(self):
+		"""
+			Adds the time and size of each part to the metrics, and writes the throughput of the upload to the log.
+		"""
+
+		totalbytes = 0
+		for part, size, seconds in self.PartStats:
+			totalbytes += size
+			METRICS.observe("upload_part", seconds)
+			METRICS.count("upload_bytes", size)
+
+		if self.Log is not None:
+			seconds = time.time() - self.StartTime
+			self.Log.write(LogLevel.INFO, f"S3 Upload: {totalbytes} bytes to s3://{self.Bucket}/{self.Key} in {len(self.PartStats)} parts, {totalbytes / max(seconds, 1e-9) / 1048576:.2f} MB/s")
+
+class SignedWriter(object):
+	"""
+		Writes to a file and adds everything written to an HMAC, so a pickle can be signed as it is written.
+	"""
+
+	def __init__(self, file, signature):
+		self.File = file
+		self.Signature = signature
+
+	def write(self, data):
+		self.Signature.update(data)
+		return self.File.write(data)
+
+class Checkpoint(object):
+	"""
+		Periodically saves the progress of a parse, so a run that dies partway through a file can resume from the last
+		checkpoint instead of the start of the file. Checkpoints are written to local storage, and optionally copied to S3
+		so a run on another machine can resume. Each checkpoint starts with an HMAC of its pickled state, and a checkpoint
+		is only unpickled when the HMAC matches the checkpoint key. The key is the CHECKPOINT_KEY environment variable, or
+		a random key kept next to the checkpoint, so runs on other machines need the same CHECKPOINT_KEY to resume.
+	"""
+
+	def __init__(self, filename, name, size, version = None, interval = 600, s3client = None, log = None):
+		"""
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the checkpoint
+			name (string)
+				The name of the input, a checkpoint is only resumed for the same input
+			size (int)
+				The size of the input in bytes, a checkpoint is only resumed if the input has not changed size
+			version (string)
+				The ETag or modification time of the input, a checkpoint is only resumed if the input has not been replaced
+			interval (int)
+				The least seconds between checkpoints
+			s3client (S3Client)
+				Optional S3Client to copy each checkpoint to, under checkpoints/ in its bucket
+			log (Logger)
+				Optional log to write each checkpoint to
+		"""
+
+		self.FileName = filename
+		self.Name = name
+		self.Size = size
+		self.Version = version
+		self.Interval = interval
+		self.S3Client = s3client
+		self.S3Key = f"checkpoints/{os.path.basename(filename)}"
+		self.Log = log
+		self.LastSave = time.time()
+		self.State = None
+
+	def load(self):
+		"""
+			Loads the last checkpoint of the input from local storage, or from S3 when there is no local checkpoint.
+
+			Returns
+			----------
+			offset (int)
+				The byte offset to resume the input from, 0 if there is no checkpoint to resume
+		"""
+
+		if not os.path.exists(self.FileName) and self.S3Client is not None:
+			try:
+				self.S3Client.Client.download_file(self.S3Client.Bucket, self.S3Key, self.FileName)
+			except Exception:
+				# no checkpoint in S3
+				pass
+
+		if not os.path.exists(self.FileName):
+			return 0
+
+		with open(self.FileName, "rb") as checkpointfile:
+			signature = hmac.new(self.get_key(), digestmod = hashlib.sha256)
+			expected = checkpointfile.read(signature.digest_size)
+			for block in iter(lambda: checkpointfile.read(16 * 1024 * 1024), b""):
+				signature.update(block)
+
+			# the state is only unpickled once it is known to be written with the checkpoint key
+			if not hmac.compare_digest(expected, signature.digest()):
+				if self.Log is not None:
+					self.Log.write(LogLevel.ERROR, f"Checkpoint {self.FileName} was not written with the checkpoint key, starting from the beginning")
+				return 0
+
+			checkpointfile.seek(signature.digest_size)
+			state = pickle.load(checkpointfile)
+
+		if state["name"] != self.Name or state["size"] != self.Size or state["version"] != self.Version:
+			if self.Log is not None:
+				self.Log.write(LogLevel.INFO, f"Checkpoint is for {state['name']} ({state['size']} bytes, version {state['version']}), starting from the beginning")
+			return 0
+
+		self.State = state
+		if self.Log is not None:
+			self.Log.write(LogLevel.INFO, f"Resuming from checkpoint at byte {state['offset']}, line {state['linecount']}")
+		return state["offset"]
+
+	def get_key(self):
+		"""
+			Gets the key of the checkpoint HMAC, creating a random key next to the checkpoint when CHECKPOINT_KEY is not set.
+
+			Returns
+			----------
+			key (bytes)
+				The checkpoint key
+		"""
+
+		key = os.environ.get("CHECKPOINT_KEY")
+		if key:
+			return key.encode("utf8")
+
+		keypath = os.path.join(os.path.dirname(os.path.abspath(self.FileName)), ".checkpoint_key")
+		try:
+			# only the owner can read the key
+			with os.fdopen(os.open(keypath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as keyfile:
+				keyfile.write(os.urandom(32))
+		except FileExistsError:
+			pass
+
+		with open(keypath, "rb") as keyfile:
+			return keyfile.read()
+
+	def is_due(self):
+		"""
+			Returns
+			----------
+			due (bool)
+				True when the interval has passed since the last checkpoint
+		"""
+
+		return time.time() - self.LastSave >= self.Interval
+
+	def save(self, offset, linecount, errorcount, addressdict, resultsdict):
+		"""
+			Writes a checkpoint. The checkpoint is written to a temporary file and renamed, so a run that dies while
+			writing never leaves a partial checkpoint behind.
+
+			Parameters
+			----------
+			offset (int)
+				The byte offset of the first line not yet parsed
+			linecount (int)
+				The number of lines parsed, not including the header
+			errorcount (int)
+				The number of errors written to the log so far
+			addressdict (dict | AttributionTable)
+				The store for the referrer of each ip address
+			resultsdict (dict)
+				The grouped sum of revenue (Domain|KeyWords: Revenue)
+		"""
+
+		starttime = time.perf_counter()
+		state = {"name": self.Name, "size": self.Size, "version": self.Version, "offset": offset, "linecount": linecount, "errorcount": errorcount, "addressdict": addressdict, "resultsdict": resultsdict}
+
+		signature = hmac.new(self.get_key(), digestmod = hashlib.sha256)
+		with open(f"{self.FileName}.tmp", "wb") as checkpointfile:
+			# the HMAC is written over the space left for it once the whole state has been written
+			checkpointfile.write(bytes(signature.digest_size))
+			pickle.dump(state, SignedWriter(checkpointfile, signature), protocol = pickle.HIGHEST_PROTOCOL)
+			checkpointfile.seek(0)
+			checkpointfile.write(signature.digest())
+		os.replace(f"{self.FileName}.tmp", self.FileName)
+
+		if self.S3Client is not None:
+			self.S3Client.Client.upload_file(self.FileName, self.S3Client.Bucket, self.S3Key)
+
+		seconds = time.perf_counter() - starttime
+		METRICS.observe("checkpoint", seconds)
+		if self.Log is not None:
+			self.Log.write(LogLevel.INFO, f"Checkpoint saved at byte {offset}, line {linecount}: {os.path.getsize(self.FileName)} bytes in {seconds:.2f} seconds")
+
+		self.LastSave = time.time()
+
+	def remove(self):
+		"""
+			Removes the checkpoint once the input is finished.
+		"""
+
+		if os.path.exists(self.FileName):
+			os.remove(self.FileName)
+
+		if self.S3Client is not None:
+			self.S3Client.Client.delete_object(Bucket = self.S3Client.Bucket, Key = self.S3Key)
+
 class UrlParser(object):
 	"""
 		A UrlParser class for storing relevant url properties
@@ -146,6 +1165,120 @@ class UrlParser(object):
 		else:
 			return "Unknown"
 
+class ReferrerCache(object):
+	"""
+		A bounded cache of parsed referrer urls, so a referrer that is seen many times is only parsed once.
+		When the cache is full the oldest url is evicted.
+	"""
+
+	def __init__(self, maxsize = 100000):
+		"""
+			Parameters
+			----------
+			maxsize (int)
+				The most urls to keep in the cache, 0 turns off caching
+		"""
+
+		self.MaxSize = maxsize
+		self.Cache = OrderedDict()
+		# guards adding and evicting urls when the cache is shared between threads, hits don't need the lock
+		self.Lock = threading.Lock()
+		self.Hits = 0
+		self.Misses = 0
+		self.Evictions = 0
+
+	def lookup(self, url):
+		"""
+			Gets the search engine domain and keywords of a referrer url.
+
+			Parameters
+			----------
+			url (string | bytes)
+				The referrer url, raw bytes are only decoded when the url is not in the cache
+
+			Returns
+			----------
+			DomainInfo (string)
+				The domain and keywords of the url (Domain|Keywords), or None if the url has no parameters
+		"""
+
+		result = self.Cache.get(url, self)
+		if result is not self:
+			self.Hits += 1
+			return result
+
+		self.Misses += 1
+		with METRICS.timer("url_parse"), UrlParser(url.decode("utf8") if type(url) is bytes else url) as parsedurl:
+			result = f"{parsedurl.Domain}|{parsedurl.get_keywords()}" if len(parsedurl.Parameters) else None
+
+		if self.MaxSize > 0:
+			with self.Lock:
+				if len(self.Cache) >= self.MaxSize:
+					self.Cache.popitem(last = False)
+					self.Evictions += 1
+				self.Cache[url] = result
+
+		return result
+
+	def get_counts(self):
+		"""
+			Returns
+			----------
+			counts (tuple)
+				The (hits, misses, evictions) of the cache
+		"""
+
+		return self.Hits, self.Misses, self.Evictions
+
+	def add_counts(self, hits, misses, evictions):
+		"""
+			Adds counts from another cache, such as the cache of a worker process.
+
+			Parameters
+			----------
+			hits (int)
+				The number of lookups found in the cache
+			misses (int)
+				The number of lookups that had to be parsed
+			evictions (int)
+				The number of urls evicted from the cache
+		"""
+
+		with self.Lock:
+			self.Hits += hits
+			self.Misses += misses
+			self.Evictions += evictions
+
+	def share(self):
+		"""
+			Gets a cache for one thread that shares the urls of this cache but counts its own lookups, so the counters
+			are never updated from two threads. The counts are added back to this cache with add_counts.
+
+			Returns
+			----------
+			cache (ReferrerCache)
+				The cache for the thread
+		"""
+
+		cache = ReferrerCache(self.MaxSize)
+		cache.Cache = self.Cache
+		cache.Lock = self.Lock
+		return cache
+
+	def log_stats(self, log):
+		"""
+			Writes the cache counters to the log.
+
+			Parameters
+			----------
+			log (Logger)
+				The log to write to
+		"""
+
+		lookups = self.Hits + self.Misses
+		hitrate = self.Hits / lookups * 100 if lookups else 0
+		log.write(LogLevel.INFO, f"Referrer Cache: {self.Hits} hits, {self.Misses} misses, {self.Evictions} evictions, {hitrate:.2f}% hit rate")
+
 class LogLevel():
 	"""
 		A class that contains an Enum of Log Levels
@@ -158,14 +1291,39 @@ class LogLevel():
 
 class Logger(object):
 	"""
-		A simple logger that writes to a log file.
+		A simple logger that writes to a log file. The logger can also run asynchronously, handing messages to a
+		background thread through a bounded queue that writes them in batches.
 	"""
 
-	def __init__(self, level = 1, filename = "logfile.txt"):
+	# the line number prefix removed from error messages when checking for repeats
+	LINEPREFIX = re.compile(r"^Line: \d+\t ?")
+
+	def __init__(self, level = 1, filename = "logfile.txt", repeatlimit = 0):
+		"""
+			Parameters
+			----------
+			level (LogLevel)
+				The level of the log
+			filename (string)
+				The local storage location of the log file
+			repeatlimit (int)
+				The number of times the same error is written before repeats are only counted, 0 writes every error
+		"""
+
 		self.LogFile = None
 		self.ErrorCount = 0
 		self.Level = level
 		self.FileName = filename
+		self.RepeatLimit = repeatlimit
+		self.RepeatCounts = dict()
+		self.Queue = None
+		self.Thread = None
+		self.Pending = list()
+		self.BatchSize = 1000
+		self.FlushOnError = True
+		# errors flush the file at most once in this many seconds, so a file full of bad lines is still written in batches
+		self.ErrorFlushInterval = 1.0
+		self.LastErrorFlush = 0.0
 
 	def write(self, level, message):
 		"""
@@ -187,13 +1345,105 @@ class Logger(object):
 		elif level == LogLevel.ERROR:
 			messagestr = "Error"
 			self.ErrorCount += 1
+			if self.RepeatLimit and self.is_repeat(message):
+				return
 		elif level == LogLevel.DEBUG:
 			messagestr = "Debug"
 
+		if self.Queue is not None:
+			# messages are handed to the writer in batches, so the queue is only touched once per batch
+			self.Pending.append(f"[{messagestr}]\t{message}\n")
+			flush = level == LogLevel.ERROR and self.FlushOnError and time.monotonic() - self.LastErrorFlush >= self.ErrorFlushInterval
+			if flush:
+				self.LastErrorFlush = time.monotonic()
+			if flush or len(self.Pending) >= self.BatchSize:
+				self.put_pending(flush)
+			return
+
 		self.check_file()
 		self.LogFile.write(f"[{messagestr}]\t{message}\n")
 		self.LogFile.flush()
-	
+
+	def is_repeat(self, message):
+		"""
+			Counts an error message, ignoring its line number, and checks if it has been written RepeatLimit times already.
+
+			Parameters
+			----------
+			message (string)
+				The error message
+
+			Returns
+			----------
+			repeat (bool)
+				True if the message should only be counted
+		"""
+
+		key = self.LINEPREFIX.sub("", message)
+		count = self.RepeatCounts.get(key, 0) + 1
+		self.RepeatCounts[key] = count
+
+		return count > self.RepeatLimit
+
+	def start_async(self, queuesize = 100, batchsize = 1000, flushonerror = True, errorflushinterval = 1.0):
+		"""
+			Starts writing messages from a background thread. Messages are put on a bounded queue, so the caller only
+			waits when the writer falls behind. Closing the logger always writes and flushes every message.
+
+			Parameters
+			----------
+			queuesize (int)
+				The most batches of messages waiting to be written
+			batchsize (int)
+				The number of messages handed to the background thread at one time
+			flushonerror (bool)
+				Flush the file after a batch that contains an error
+			errorflushinterval (float)
+				The fewest seconds between flushes for errors, errors in between are written with the next batch
+		"""
+
+		if self.Thread is not None:
+			return
+
+		self.BatchSize = batchsize
+		self.FlushOnError = flushonerror
+		self.ErrorFlushInterval = errorflushinterval
+		self.Queue = queue.Queue(maxsize = queuesize)
+		self.Thread = threading.Thread(target = self.write_batches, daemon = True)
+		self.Thread.start()
+
+	def put_pending(self, option = False):
+		"""
+			Hands the pending messages to the background thread.
+
+			Parameters
+			----------
+			option (bool | string)
+				True to flush after the batch, 'flush' for a flush request or 'stop' to stop the thread
+		"""
+
+		self.Queue.put((self.Pending, option))
+		self.Pending = list()
+
+	def write_batches(self):
+		"""
+			The background thread of the asynchronous logger. Each record on the queue is (messages, option), where option
+			is True to flush after the messages, 'flush' for a flush request or 'stop' to stop the thread.
+		"""
+
+		while True:
+			messages, option = self.Queue.get()
+
+			self.check_file()
+			self.LogFile.writelines(messages)
+			if option:
+				self.LogFile.flush()
+
+			self.Queue.task_done()
+
+			if option == "stop":
+				return
+
 	def check_file(self):
 		"""
 			Open the log file if it hasn't been opened yet. Prevents a file from being created if nothing is being written to the log.
@@ -204,7 +1454,31 @@ class Logger(object):
 
 	def flush(self):
 		"""
-			Flush the current file so the write stream writes to the file.
+			Flush the current file so the write stream writes to the file. The asynchronous queue is drained first.
 		"""
 
-		self.LogFile.flush()
+		if self.Queue is not None:
+			self.put_pending("flush")
+			self.Queue.join()
+		elif self.LogFile is not None:
+			self.LogFile.flush()
+
+	def close(self):
+		"""
+			Drains and stops the asynchronous writer, and writes the counts of repeated errors that were not written.
+			The log file stays open, and later messages are written directly.
+		"""
+
+		if self.Thread is not None:
+			self.put_pending("stop")
+			self.Thread.join()
+			self.Queue = None
+			self.Thread = None
+
+		for message, count in self.RepeatCounts.items():
+			if count > self.RepeatLimit:
+				self.check_file()
+				self.LogFile.write(f"[Error]\t{count - self.RepeatLimit} more errors not written: {message}\n")
+		self.RepeatCounts.clear()
+
+		self.flush()
@@ -0,0 +1,650 @@
+from Helpers import ReferrerCache, LogLevel
+from Metrics import METRICS
+from itertools import chain
+import time
+
+# the input source, referrer cache and sample rate for the current worker process, set once by init_worker when the process pool starts
+WORKERSOURCE = None
+WORKERCACHE = None
+WORKERSAMPLERATE = 0
+
+class HitParser(object):
+	"""
+		Parses hit data line by line. Search engine referrers are tracked by ip address, and the revenue of actualized
+		purchases is summed up grouped by the search engine domain and keywords that led to them.
+	"""
+
+	def __init__(self, log, addressdict = None, resultsdict = None, referrercache = None, purchasers = None, samplerate = 0, carryover = None, spool = None):
+		"""
+			Parameters
+			----------
+			log (Logger)
+				The log to write errors and purchases to
+			addressdict (dict)
+				Optional dictionary of relevant ip addresses to start from (IP: DomainInfo), a store with an advance method
+				is moved forward to the hit_time_gmt of each referrer and purchase
+			resultsdict (dict)
+				Optional dictionary of grouped revenue to start from (Domain|KeyWords: Revenue)
+			referrercache (ReferrerCache)
+				Optional cache of parsed referrer urls, which can be shared between parsers
+			purchasers (set | PackedSet | BloomFilter)
+				Optional set of ip addresses that make a purchase, when given only the referrers of these ip addresses are stored
+			samplerate (int)
+				Time decoding and splitting one line in every samplerate lines for the metrics, 0 turns off sampling
+			carryover (AttributionSnapshot)
+				Optional referrers of ip addresses from earlier days, used for purchases from ip addresses with no referrer
+				yet, which can't be used with an attribution window
+			spool (SpoolWriter)
+				Optional spool to write every search engine referrer and purchase to, for runs from the spool later
+		"""
+
+		# dictionary that stores relevant ip addresses (IP: DomainInfo)
+		self.AddressDict = dict() if addressdict is None else addressdict
+		# dictionary that stores grouped sum of revenue based on domain info (Domain|KeyWords: Revenue)
+		self.ResultsDict = dict() if resultsdict is None else resultsdict
+		self.ReferrerCache = ReferrerCache() if referrercache is None else referrercache
+		self.Purchasers = purchasers
+		self.SampleRate = samplerate
+		self.CarryOver = carryover
+		self.Spool = spool
+		self.Log = log
+		self.LineCount = 0
+
+		# the snapshot keeps no hit times, so a carried over referrer can't be checked against an attribution window
+		if carryover is not None and hasattr(self.AddressDict, "advance"):
+			raise ValueError("Carry over can't be used with an attribution window")
+
+	def parse(self, filestream, skipheader = True):
+		"""
+			Iterate through the input stream line by line to parse and clean data. Streams of bytes use the byte level
+			fast path, streams of text use the text path.
+
+			Parameters
+			----------
+			filestream (Stream)
+				The stream to read line by line
+			skipheader (bool)
+				Skip the first line of the stream as a header record
+
+			Returns
+			----------
+			LineCount (int)
+				The number of lines parsed, not including the header
+		"""
+
+		# the first line is the header record, and tells us if the stream is bytes or text
+		first = next(filestream, None)
+		if first is None:
+			return 0
+
+		if not skipheader:
+			filestream = chain([first], filestream)
+
+		if self.SampleRate > 0:
+			filestream = self.sample_lines(filestream)
+
+		if type(first) is bytes:
+			linenumber = self.parse_bytes(filestream)
+		else:
+			linenumber = self.parse_text(filestream)
+
+		self.LineCount += linenumber
+		return linenumber
+
+	def sample_lines(self, filestream):
+		"""
+			Times decoding and splitting one line in every SampleRate lines, and passes every line through unchanged.
+			Timing every line would slow down the loop being measured.
+
+			Parameters
+			----------
+			filestream (Stream)
+				The stream to read line by line
+
+			Returns
+			----------
+			lines (iterator)
+				The lines of the stream
+		"""
+
+		countdown = self.SampleRate
+
+		for line in filestream:
+			countdown -= 1
+			if not countdown:
+				countdown = self.SampleRate
+
+				try:
+					starttime = time.perf_counter()
+					text = line.decode("utf8") if type(line) is bytes else line
+					decodetime = time.perf_counter()
+					text.split("\t")
+					METRICS.observe("split", time.perf_counter() - decodetime)
+					METRICS.observe("decode", decodetime - starttime)
+				except UnicodeDecodeError:
+					# the parser logs the bad line
+					pass
+
+			yield line
+
+	def parse_bytes(self, filestream):
+		"""
+			Iterate through a stream of raw bytes lines. Only the ip, event list, product list and referrer columns are
+			pulled out, and each is only decoded when it is needed.
+
+			Parameters
+			----------
+			filestream (Stream)
+				The stream of bytes to read line by line
+
+			Returns
+			----------
+			linenumber (int)
+				The number of lines parsed
+		"""
+
+		addressdict = self.AddressDict
+		lookup = self.ReferrerCache.lookup
+		purchasers = self.Purchasers
+		# a store with an attribution window is moved forward to the hit time before each referrer or purchase
+		advance = getattr(addressdict, "advance", None)
+		spool = self.Spool
+
+		# line numbers carry on from earlier calls, so a stream parsed in batches is numbered the same as one stream
+		linenumber = self.LineCount
+
+		for line in filestream:
+			linenumber += 1
+
+			# error catch bad lines so one bad line doesn't fail the entire file
+			try:
+				try:
+					hittime, _, _, ip, events, _, _, _, _, _, productlist, url = line.split(b"\t")
+				except ValueError:
+					self.log_line(LogLevel.ERROR, linenumber, "Record does not contain 12 columns. Possible invalid file format.")
+					continue
+
+				# handle external reference storage, the cache is keyed on the raw bytes so hot referrers are never decoded
+				if b'esshopzilla' not in url:
+					domaininfo = lookup(url)
+					if domaininfo is not None:
+						address = ip.decode("utf8")
+						if spool is not None:
+							spool.add_referrer(linenumber, hittime, address, domaininfo)
+						if purchasers is None or address in purchasers:
+							if advance is not None:
+								advance(hittime)
+							# store domain and search details in dictionary with associated ip address
+							addressdict[address] = domaininfo
+
+				# handle an actualized revenue record, the product list is only decoded for purchases
+				if b'1' in events and b'1' in events.split(b","):
+					if spool is not None:
+						self.spool_purchase(linenumber, hittime, ip.decode("utf8"), productlist.decode("utf8"))
+					if advance is not None:
+						advance(hittime)
+					self.purchase(linenumber, ip.decode("utf8"), productlist.decode("utf8"))
+
+			except Exception as ex:
+				# error procesing line
+				self.log_line(LogLevel.ERROR, linenumber, f"unhandled exception processing line: {ex}")
+
+		return linenumber - self.LineCount
+
+	def parse_text(self, filestream):
+		"""
+			Iterate through a stream of text lines, splitting every column of each line.
+
+			Parameters
+			----------
+			filestream (Stream)
+				The stream of text to read line by line
+
+			Returns
+			----------
+			linenumber (int)
+				The number of lines parsed
+		"""
+
+		addressdict = self.AddressDict
+		lookup = self.ReferrerCache.lookup
+		purchasers = self.Purchasers
+		advance = getattr(addressdict, "advance", None)
+		spool = self.Spool
+		# dictionary for storing column names and values
+		row = dict()
+
+		linenumber = self.LineCount
+
+		for line in filestream:
+			linenumber += 1
+
+			if type(line) is bytes:
+				line = line.decode("utf8")
+
+			# error catch bad lines so one bad line doesn't fail the entire file
+			try:
+				# parse each line in to a row dictionary
+				columns = line.split(sep = "\t")
+				if len(columns) != 12:
+					self.log_line(LogLevel.ERROR, linenumber, "Record does not contain 12 columns. Possible invalid file format.")
+					continue
+
+				row['hit_time_gmt'] = columns[0]
+				row['ip'] = columns[3]
+				row['events'] = columns[4]
+				row['productlist'] = columns[10]
+				row['url'] = columns[11]
+
+				# handle external reference storage
+				if 'esshopzilla' not in row['url']:
+					domaininfo = lookup(row['url'])
+					if domaininfo is not None and spool is not None:
+						spool.add_referrer(linenumber, row['hit_time_gmt'], row['ip'], domaininfo)
+					if domaininfo is not None and (purchasers is None or row['ip'] in purchasers):
+						if advance is not None:
+							advance(row['hit_time_gmt'])
+						# store domain and search details in dictionary with associated ip address
+						addressdict[row['ip']] = domaininfo
+
+				# get the events from column 5
+				events = row['events'].split(",")
+
+				# handle an actualized revenue record
+				if events is not None and '1' in events:
+					if spool is not None:
+						self.spool_purchase(linenumber, row['hit_time_gmt'], row['ip'], row['productlist'])
+					if advance is not None:
+						advance(row['hit_time_gmt'])
+					self.purchase(linenumber, row['ip'], row['productlist'])
+
+			except Exception as ex:
+				# error procesing line
+				self.log_line(LogLevel.ERROR, linenumber, f"unhandled exception processing line: {ex}")
+
+		return linenumber - self.LineCount
+
+	def purchase(self, linenumber, ip, productlist):
+		"""
+			Handles an actualized revenue record if we have a matching external reference for the ip address.
+
+			Parameters
+			----------
+			linenumber (int)
+				The line number of the record
+			ip (string)
+				The ip address of the record
+			productlist (string)
+				The product list column of the record
+		"""
+
+		domaininfo = self.AddressDict.get(ip)
+		if domaininfo is None and self.CarryOver is not None:
+			domaininfo = self.CarryOver.get(ip)
+		if domaininfo is not None:
+			self.record_purchase(linenumber, ip, domaininfo, productlist)
+
+	def record_purchase(self, linenumber, ip, domaininfo, productlist):
+		"""
+			Calculates the total revenue of a purchase and adds it to the group of the referring search engine.
+
+			Parameters
+			----------
+			linenumber (int)
+				The line number of the record
+			ip (string)
+				The ip address of the record
+			domaininfo (string)
+				The domain and keywords of the search engine that referred the ip address (Domain|Keywords)
+			productlist (string)
+				The product list column of the record
+		"""
+
+		starttime = time.perf_counter()
+		totalrevenue = self.get_revenue(linenumber, productlist)
+		METRICS.observe("revenue_parse", time.perf_counter() - starttime)
+
+		self.record_revenue(linenumber, ip, domaininfo, totalrevenue)
+
+	def record_revenue(self, linenumber, ip, domaininfo, totalrevenue):
+		"""
+			Adds the total revenue of a purchase to the group of the referring search engine.
+
+			Parameters
+			----------
+			linenumber (int)
+				The line number of the record
+			ip (string)
+				The ip address of the record
+			domaininfo (string)
+				The domain and keywords of the search engine that referred the ip address (Domain|Keywords)
+			totalrevenue (float)
+				The sum of the revenue of each product of the purchase
+		"""
+
+		if totalrevenue > 0:
+			starttime = time.perf_counter()
+			# the domain information is grouped by domain and keywords, as it is already grouped sum up the values now
+			self.add_revenue(domaininfo, totalrevenue)
+			METRICS.observe("aggregation", time.perf_counter() - starttime)
+			self.Log.write(LogLevel.DEBUG, f"Purchase found for ip {ip}")
+		else:
+			# totalrevenue is 0 or lower
+			self.log_line(LogLevel.ERROR, linenumber, "Record shows a verified purchase, but total revenue could not be determined.")
+
+	def spool_purchase(self, linenumber, hittime, ip, productlist):
+		"""
+			Writes a purchase and its total revenue to the spool. Errors in the product list are only logged if the
+			purchase is attributed, so they are not logged here.
+
+			Parameters
+			----------
+			linenumber (int)
+				The line number of the record
+			hittime (string | bytes)
+				The hit_time_gmt column of the record
+			ip (string)
+				The ip address of the record
+			productlist (string)
+				The product list column of the record
+		"""
+
+		try:
+			totalrevenue = self.get_revenue(linenumber, productlist, logerrors = False)
+		except ValueError as ex:
+			self.Spool.add_purchase(linenumber, hittime, ip, None, ex)
+			return
+		self.Spool.add_purchase(linenumber, hittime, ip, totalrevenue)
+
+	def get_revenue(self, linenumber, productlist, logerrors = True):
+		"""
+			Calculates the total revenue of the products in a product list, logging products without a revenue.
+
+			Parameters
+			----------
+			linenumber (int)
+				The line number of the record
+			productlist (string)
+				The product list column of the record
+			logerrors (bool)
+				Log the products without a revenue
+
+			Returns
+			----------
+			totalrevenue (float)
+				The sum of the revenue of each product, 0 if none of the products have a revenue
+		"""
+
+		totalrevenue = 0
+		productlist = productlist.split(",")
+
+		# iterate through product list to calculate total revenue for this actualized event
+		if len(productlist) > 0:
+			for product in productlist:
+				productinfo = product.split(";")
+				if len(productinfo) >= 4:
+					revenue = float(productinfo[3])
+					if revenue >= 0:
+						totalrevenue += revenue
+				elif logerrors:
+					self.log_line(LogLevel.ERROR, linenumber, f"Invalid Product Attribute in Product List: {product}")
+		elif logerrors:
+			# no product in productlist
+			self.log_line(LogLevel.ERROR, linenumber, "Record shows a verified purchase, but no products are listed.")
+
+		return totalrevenue
+
+	def add_revenue(self, domaininfo, revenue):
+		"""
+			Adds revenue to the group of a search engine domain and keywords.
+
+			Parameters
+			----------
+			domaininfo (string)
+				The domain and keywords to group by (Domain|Keywords)
+			revenue (float)
+				The revenue to add
+		"""
+
+		if domaininfo in self.ResultsDict:
+			self.ResultsDict[domaininfo] += revenue
+		else:
+			self.ResultsDict[domaininfo] = revenue
+
+	def log_line(self, level, linenumber, message):
+		"""
+			Writes a message about a specific line to the log.
+
+			Parameters
+			----------
+			level (LogLevel)
+				The level of this log message.
+			linenumber (int)
+				The line number the message is about
+			message (string)
+				The message to write to the log
+		"""
+
+		self.Log.write(level, f"Line: {linenumber}\t {message}")
+
+class RecordLog(object):
+	"""
+		A stand in for Logger that stores log messages in a list of records instead of writing them to a file.
+	"""
+
+	def __init__(self, records):
+		self.Records = records
+
+	def write(self, level, message):
+		self.Records.append(("log", level, None, message))
+
+class ChunkParser(HitParser):
+	"""
+		A HitParser for one chunk of a file, run by a worker process. As the chunk does not know the referrers seen in
+		the chunks before it, purchases and revenue are stored as an ordered list of records instead of being summed up,
+		so they can be merged back in file order with the results of the other chunks.
+
+		Records
+		----------
+		("log", level, linenumber, message)
+			A log message, linenumber is None if the message is not about a specific line
+		("add", domaininfo, revenue)
+			Revenue to add to a domain and keywords group
+		("pending", linenumber, ip, productlist)
+			A purchase from an ip address that had no referrer earlier in the chunk
+	"""
+
+	def __init__(self, referrercache = None, samplerate = 0):
+		self.Records = list()
+		super().__init__(RecordLog(self.Records), referrercache = referrercache, samplerate = samplerate)
+
+	def purchase(self, linenumber, ip, productlist):
+		domaininfo = self.AddressDict.get(ip)
+		if domaininfo is not None:
+			self.record_purchase(linenumber, ip, domaininfo, productlist)
+		else:
+			# the referrer for this ip address may be in an earlier chunk
+			self.Records.append(("pending", linenumber, ip, productlist))
+
+	def add_revenue(self, domaininfo, revenue):
+		self.Records.append(("add", domaininfo, revenue))
+
+	def log_line(self, level, linenumber, message):
+		self.Records.append(("log", level, linenumber, message))
+
+def collect_purchasers(filestream, purchasers, skipheader = True, log = None):
+	"""
+		The first pass of the two pass mode. Iterates through the input stream and collects the ip addresses of every
+		actualized revenue record. Lines of bytes are split the same way as parse_bytes, and only the ip address of a
+		purchase is decoded. A line that fails is skipped, the second pass logs its error when it reaches the line.
+
+		Parameters
+		----------
+		filestream (Stream)
+			The stream to read line by line
+		purchasers (set | PackedSet | BloomFilter)
+			The set to add the ip addresses to
+		skipheader (bool)
+			Skip the first line of the stream as a header record
+		log (Logger)
+			Optional log to write the number of skipped lines to
+
+		Returns
+		----------
+		purchasers (set | PackedSet | BloomFilter)
+			The set of ip addresses
+	"""
+
+	if skipheader:
+		next(filestream, None)
+
+	skipped = 0
+	for line in filestream:
+		# error catch bad lines so one bad line doesn't fail the entire pass
+		try:
+			# use the same rules as the parser for which records count
+			if type(line) is bytes:
+				columns = line.split(b"\t")
+				if len(columns) == 12 and b'1' in columns[4] and b'1' in columns[4].split(b","):
+					purchasers.add(columns[3].decode("utf8"))
+			else:
+				columns = line.split(sep = "\t")
+				if len(columns) == 12 and '1' in columns[4].split(","):
+					purchasers.add(columns[3])
+		except Exception:
+			skipped += 1
+
+	if skipped and log is not None:
+		log.write(LogLevel.INFO, f"First pass skipped {skipped} lines, their errors are logged by the second pass")
+
+	return purchasers
+
+def merge_chunk(parser, linecount, records, addressdict, cachecounts, metrics = None):
+	"""
+		Merges the result of a ChunkParser in to a HitParser. Chunks must be merged in file order.
+
+		Parameters
+		----------
+		parser (HitParser)
+			The parser holding the results of all previous chunks
+		linecount (int)
+			The number of lines in the chunk, not including the header
+		records (list)
+			The ordered records of the chunk
+		addressdict (dict)
+			The last referrer seen for each ip address in the chunk
+		cachecounts (tuple)
+			The (hits, misses, evictions) of the worker referrer cache while parsing the chunk
+		metrics (Metrics)
+			Optional metrics of the worker while parsing the chunk
+	"""
+
+	lineoffset = parser.LineCount
+
+	for record in records:
+		if record[0] == "add":
+			parser.add_revenue(record[1], record[2])
+		elif record[0] == "log":
+			if record[2] is None:
+				parser.Log.write(record[1], record[3])
+			else:
+				parser.log_line(record[1], record[2] + lineoffset, record[3])
+		elif record[0] == "pending":
+			linenumber = record[1] + lineoffset
+			try:
+				parser.purchase(linenumber, record[2], record[3])
+			except Exception as ex:
+				parser.log_line(LogLevel.ERROR, linenumber, f"unhandled exception processing line: {ex}")
+
+	# carry the last referrer seen for each ip address over to the next chunk
+	parser.AddressDict.update(addressdict)
+	parser.LineCount += linecount
+	parser.ReferrerCache.add_counts(*cachecounts)
+
+	if metrics is not None:
+		METRICS.merge(metrics)
+
+def find_chunks(source, chunksize):
+	"""
+		Splits an input source in to byte ranges of roughly chunksize bytes that end on line boundaries.
+
+		Parameters
+		----------
+		source (S3Client | MappedFile)
+			The input source to split
+		chunksize (int)
+			The target size of each chunk in bytes
+
+		Returns
+		----------
+		chunks (list)
+			A list of (start, end) byte ranges
+	"""
+
+	size = source.get_size()
+	chunks = list()
+	start = 0
+
+	while start < size:
+		end = min(start + chunksize, size)
+
+		# move the end of the chunk forward to the next line break so no line is split across chunks
+		position = end - 1
+		while end < size:
+			data = source.read_range(position, min(position + 64 * 1024, size))
+			pos = data.find(b"\n")
+			if pos >= 0:
+				end = position + pos + 1
+				break
+			position += len(data)
+			if position >= size:
+				end = size
+
+		chunks.append((start, end))
+		start = end
+
+	return chunks
+
+def init_worker(source, cachesize, samplerate = 0):
+	"""
+		Stores the input source and creates the referrer cache for a worker process.
+
+		Parameters
+		----------
+		source (S3Client | MappedFile)
+			The input source the worker reads chunks from
+		cachesize (int)
+			The most urls to keep in the referrer cache of the worker
+	samplerate (int)
+		Time decoding and splitting one line in every samplerate lines for the metrics, 0 turns off sampling
+	"""
+
+	global WORKERSOURCE, WORKERCACHE, WORKERSAMPLERATE
+	WORKERSOURCE = source
+	WORKERCACHE = ReferrerCache(cachesize)
+	WORKERSAMPLERATE = samplerate
+
+def parse_chunk(chunk):
+	"""
+		Parses one chunk of the input source in a worker process.
+
+		Parameters
+		----------
+		chunk (tuple)
+			The (start, end) byte range of the chunk
+
+		Returns
+		----------
+		result (tuple)
+			The line count, ordered records, last referrer for each ip address, referrer cache counts and metrics of the chunk
+	"""
+
+	start, end = chunk
+	parser = ChunkParser(WORKERCACHE, WORKERSAMPLERATE)
+	startcounts = WORKERCACHE.get_counts()
+	# a forked worker starts with a copy of the metrics of the parent, so only the metrics of this chunk are sent back
+	METRICS.reset()
+	parser.parse(WORKERSOURCE.read_lines(start, end), skipheader = start == 0)
+
+	cachecounts = tuple(count - startcount for count, startcount in zip(WORKERCACHE.get_counts(), startcounts))
+	return parser.LineCount, parser.Records, parser.AddressDict, cachecounts, METRICS
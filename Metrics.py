@@ -0,0 +1,300 @@
+import json
+import os
+import signal
+import threading
+import time
+
+class Histogram(object):
+	"""
+		A histogram of timings in seconds, counted in power of 2 microsecond buckets so it stays small however many
+		timings are added.
+	"""
+
+	def __init__(self):
+		self.Count = 0
+		self.Total = 0
+		self.Min = None
+		self.Max = 0
+		# upper bound in microseconds: count
+		self.Buckets = dict()
+
+	def observe(self, seconds):
+		"""
+			Adds one timing to the histogram.
+
+			Parameters
+			----------
+			seconds (float)
+				The timing to add
+		"""
+
+		self.Count += 1
+		self.Total += seconds
+		self.Min = seconds if self.Min is None or seconds < self.Min else self.Min
+		self.Max = seconds if seconds > self.Max else self.Max
+
+		bucket = 1 << int(seconds * 1000000).bit_length()
+		self.Buckets[bucket] = self.Buckets.get(bucket, 0) + 1
+
+	def merge(self, other):
+		"""
+			Adds the timings of another histogram, such as the histogram of a worker process.
+
+			Parameters
+			----------
+			other (Histogram)
+				The histogram to add
+		"""
+
+		self.Count += other.Count
+		self.Total += other.Total
+		if other.Min is not None:
+			self.Min = other.Min if self.Min is None or other.Min < self.Min else self.Min
+		self.Max = max(self.Max, other.Max)
+
+		for bucket, count in other.Buckets.items():
+			self.Buckets[bucket] = self.Buckets.get(bucket, 0) + count
+
+	def to_dict(self):
+		"""
+			Returns
+			----------
+			histogram (dict)
+				The count, total, mean, min, max and buckets of the histogram
+		"""
+
+		return {
+			"count": self.Count,
+			"total_seconds": round(self.Total, 6),
+			"mean_seconds": round(self.Total / self.Count, 9) if self.Count else 0,
+			"min_seconds": round(self.Min or 0, 9),
+			"max_seconds": round(self.Max, 9),
+			"buckets_microseconds": {f"<{bucket}": self.Buckets[bucket] for bucket in sorted(self.Buckets)}
+		}
+
+class Timer(object):
+	"""
+		Times a block of code in to a histogram of a Metrics object
+	"""
+
+	def __init__(self, metrics, name):
+		self.Metrics = metrics
+		self.Name = name
+		self.StartTime = 0
+
+	def __enter__(self):
+		self.StartTime = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.Metrics.observe(self.Name, time.perf_counter() - self.StartTime)
+
+class Metrics(object):
+	"""
+		Counters, timing histograms and values of a run, written to a json file at the end of the run. Updates are
+		guarded by a lock, as the files of a batch update the same metrics from several threads.
+	"""
+
+	def __init__(self):
+		self.Counters = dict()
+		self.Histograms = dict()
+		self.Values = dict()
+		self.Lock = threading.RLock()
+
+	def __getstate__(self):
+		# a lock can't be sent to another process, the copy creates its own
+		state = self.__dict__.copy()
+		del state["Lock"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.Lock = threading.RLock()
+
+	def count(self, name, amount = 1):
+		"""
+			Adds to a counter.
+
+			Parameters
+			----------
+			name (string)
+				The name of the counter
+			amount (int)
+				The amount to add
+		"""
+
+		with self.Lock:
+			self.Counters[name] = self.Counters.get(name, 0) + amount
+
+	def observe(self, name, seconds):
+		"""
+			Adds a timing to a histogram.
+
+			Parameters
+			----------
+			name (string)
+				The name of the histogram
+			seconds (float)
+				The timing to add
+		"""
+
+		with self.Lock:
+			histogram = self.Histograms.get(name)
+			if histogram is None:
+				histogram = self.Histograms[name] = Histogram()
+			histogram.observe(seconds)
+
+	def timer(self, name):
+		"""
+			Times a with block in to a histogram.
+
+			Parameters
+			----------
+			name (string)
+				The name of the histogram
+
+			Returns
+			----------
+			timer (Timer)
+				The context manager to time the block with
+		"""
+
+		return Timer(self, name)
+
+	def set(self, name, value):
+		"""
+			Sets a value, such as a rate or the peak memory of the run.
+
+			Parameters
+			----------
+			name (string)
+				The name of the value
+			value (object)
+				A value that can be written as json
+		"""
+
+		with self.Lock:
+			self.Values[name] = value
+
+	def merge(self, other):
+		"""
+			Adds the counters and histograms of another Metrics object, such as the metrics of a worker process.
+
+			Parameters
+			----------
+			other (Metrics)
+				The metrics to add
+		"""
+
+		with self.Lock:
+			for name, amount in other.Counters.items():
+				self.count(name, amount)
+
+			for name, histogram in other.Histograms.items():
+				if name in self.Histograms:
+					self.Histograms[name].merge(histogram)
+				else:
+					self.Histograms[name] = histogram
+
+			self.Values.update(other.Values)
+
+	def reset(self):
+		"""
+			Clears all counters, histograms and values.
+		"""
+
+		with self.Lock:
+			self.Counters.clear()
+			self.Histograms.clear()
+			self.Values.clear()
+
+	def to_dict(self):
+		"""
+			Returns
+			----------
+			metrics (dict)
+				The counters, histograms and values
+		"""
+
+		with self.Lock:
+			return {
+				"counters": dict(sorted(self.Counters.items())),
+				"histograms": {name: self.Histograms[name].to_dict() for name in sorted(self.Histograms)},
+				"values": dict(self.Values)
+			}
+
+	def write(self, filename):
+		"""
+			Writes the metrics to a json file.
+
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the metrics file
+		"""
+
+		with open(filename, "w") as metricsfile:
+			json.dump(self.to_dict(), metricsfile, indent = 2)
+
+class SamplingProfiler(object):
+	"""
+		A low overhead profiler that samples the line running on the main thread at a fixed interval of cpu time.
+		Time spent in C functions is counted against the python line that called them.
+	"""
+
+	def __init__(self, interval = 0.005):
+		"""
+			Parameters
+			----------
+			interval (float)
+				The seconds of cpu time between samples
+		"""
+
+		self.Interval = interval
+		# file:function:line: samples
+		self.Samples = dict()
+		self.SampleCount = 0
+
+	def start(self):
+		"""
+			Starts sampling. Only the main thread can start the profiler.
+		"""
+
+		signal.signal(signal.SIGPROF, self.sample)
+		signal.setitimer(signal.ITIMER_PROF, self.Interval, self.Interval)
+
+	def stop(self):
+		"""
+			Stops sampling.
+		"""
+
+		signal.setitimer(signal.ITIMER_PROF, 0, 0)
+		signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+	def sample(self, signum, frame):
+		if frame is None:
+			return
+
+		code = frame.f_code
+		key = f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno or code.co_firstlineno}"
+		self.Samples[key] = self.Samples.get(key, 0) + 1
+		self.SampleCount += 1
+
+	def get_top(self, count = 50):
+		"""
+			Parameters
+			----------
+			count (int)
+				The number of lines to return
+
+			Returns
+			----------
+			top (list)
+				The lines with the most samples, with their share of all samples
+		"""
+
+		top = sorted(self.Samples.items(), key = lambda item: item[1], reverse = True)[:count]
+		return [{"line": key, "samples": samples, "percent": round(samples / self.SampleCount * 100, 2)} for key, samples in top]
+
+# metrics of the current process, worker processes send theirs back to be merged with each chunk
+METRICS = Metrics()
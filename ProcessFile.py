@@ -1,6 +1,23 @@
-from Helpers import S3Client, UrlParser, LogLevel, Logger
-import sys
+from Helpers import S3Client, MappedFile, RangedS3Reader, S3MultipartWriter, ReferrerCache, Checkpoint, LogLevel, Logger, detect_compression
+from HitParser import HitParser, find_chunks, init_worker, parse_chunk, merge_chunk, collect_purchasers
+from Columnar import ColumnarParser, is_available as columnar_available
+from Shuffle import ShuffleDir, init_shuffle, map_chunk, reduce_partition, merge_partitions
+from Spool import SpoolWriter, SpoolParser
+from ResultTable import ResultTableWriter, get_table_file, is_available as table_available
+from Attribution import AttributionTable, AttributionSnapshot, SpillStore, WindowStore, PackedSet, BloomFilter
+from Aggregates import AggregateStore, get_partition_date
+from Metrics import METRICS, SamplingProfiler
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from boto3 import client as botoclient, resource as botoresource
+from botocore.config import Config as BotoConfig
+import argparse
+import cProfile
+import heapq
+import multiprocessing
 import os
+import resource
 import time
 import math
 from datetime import date
@@ -15,14 +32,37 @@ FILEDIR = "datafiles" if LOCALTEST else "/tmp"
 RESULTFILE = f"{FILEDIR}/{DATESTAMP}_SearchKeywordPerformance.tab"
 TEMPFILE = f"{FILEDIR}/{DATESTAMP}_tempfile"
 LOGFILE = f"{FILEDIR}/{DATESTAMP}_Log.txt"
+SPOOLFILE = f"{FILEDIR}/{DATESTAMP}_spool"
+SPILLFILE = f"{FILEDIR}/{DATESTAMP}_spill.db"
+SHUFFLEDIR = f"{FILEDIR}/{DATESTAMP}_shuffle"
+METRICSFILE = f"{FILEDIR}/{DATESTAMP}_Metrics.json"
+# a batch has its own log and metrics, so a batch and a single file run on the same day don't replace each other's
+BATCHLOGFILE = f"{FILEDIR}/{DATESTAMP}_Batch_Log.txt"
+BATCHMETRICSFILE = f"{FILEDIR}/{DATESTAMP}_Batch_Metrics.json"
+PROFILEFILE = f"{FILEDIR}/{DATESTAMP}_Profile.prof"
+# target size of each chunk when parsing on multiple cores
+CHUNKSIZE = 64 * 1024 * 1024
+# threads uploading files and moving the input file at the end of a run
+UPLOADTHREADS = 4
 
 # create S3 client and Logger
 S3 = S3Client()
 LOG = Logger(LogLevel.DEBUG, LOGFILE)
 
-def get_s3_stream():
+def get_s3_stream(path, partsize = 8 * 1024 * 1024, concurrency = 8, blocks = False):
 	"""
-		Opens a Stream to the s3 file provided in the command line argument.
+		Opens a Stream to the s3 file provided in the command line argument. The file is read as concurrent range requests.
+
+		Parameters
+		----------
+		path (string)
+			The full s3 path of the file to open
+		partsize (int)
+			The size in bytes of each range request
+		concurrency (int)
+			The number of range requests to run at the same time
+		blocks (bool)
+			Stream blocks of whole lines for the columnar engine instead of lines
 
 		Returns
 		---------
@@ -31,165 +71,1019 @@ def get_s3_stream():
 	"""
 
 	# parse s3 path from arguments
-	S3.parse_path(sys.argv[1])
+	S3.parse_path(path)
 
 	try:
 		LOG.write(LogLevel.INFO, f"Processing File: s3://{S3.Bucket}/{S3.Key}")
-		return S3.Resource.Object(S3.Bucket, S3.Key).get()['Body'].iter_lines()
+		reader = RangedS3Reader(S3, partsize, concurrency, log = LOG)
+		return reader.iter_blocks() if blocks else reader.iter_lines()
 	except Exception as ex:
 		LOG.write(LogLevel.ERROR, f"Error creating stream from s3://{S3.Bucket}/{S3.Key}: {ex}")
 		quit(1)
 
-def parse_input_file(filestream, outputfile):
+def get_s3_batches(path, start, partsize = 8 * 1024 * 1024, concurrency = 8, blocks = False):
+	"""
+		Opens the s3 file provided in the command line argument from a byte offset, as batches of lines with the byte offset
+		each batch ends at.
+
+		Parameters
+		----------
+		path (string)
+			The full s3 path of the file to open
+		start (int)
+			The byte offset to start reading from
+		partsize (int)
+			The size in bytes of each range request
+		concurrency (int)
+			The number of range requests to run at the same time
+		blocks (bool)
+			Hold each batch as one block of whole lines for the columnar engine instead of lines
+
+		Returns
+		---------
+		batches (iterator)
+			(offset after the last line, lines) for each range request
+	"""
+
+	S3.parse_path(path)
+
+	try:
+		LOG.write(LogLevel.INFO, f"Processing File: s3://{S3.Bucket}/{S3.Key} from byte {start}")
+		return RangedS3Reader(S3, partsize, concurrency, log = LOG, start = start).iter_batches(split = not blocks)
+	except Exception as ex:
+		LOG.write(LogLevel.ERROR, f"Error creating stream from s3://{S3.Bucket}/{S3.Key}: {ex}")
+		quit(1)
+
+def parse_input_file(filestream, cachesize = 100000, addressdict = None, samplerate = 0, checkpoint = None, carryover = None, engine = "rows", spool = None):
 	"""
 		Iterate through the input stream line by line to parse and clean data.
 
 		Parameters
 		----------
 		filestream (string)
-			The stream to read line by line
-		outputfile (string)
-			The local storage location to save the processed and merged file
+			The stream to read line by line, or with a checkpoint the (offset, lines) batches of the input
+		cachesize (int)
+			The most referrer urls to keep parsed in memory
+		addressdict (dict)
+			Optional store for the referrer of each ip address, a dictionary is used by default
+		samplerate (int)
+			Time decoding and splitting one line in every samplerate lines for the metrics, 0 turns off sampling
+		checkpoint (Checkpoint)
+			Optional checkpoint to resume from and to save progress to while parsing
+		carryover (AttributionSnapshot)
+			Optional referrers of ip addresses from earlier days
+		engine (string)
+			'rows' to parse line by line, or 'columnar' to parse blocks of lines as numpy arrays, the stream holds blocks instead of lines
+		spool (SpoolWriter)
+			Optional spool to write the referrers and purchases to, closed once the input is parsed
+
+		Returns
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+	"""
+
+	starttime = time.time()
+
+	if engine == "columnar":
+		parser = ColumnarParser(LOG, addressdict = addressdict, referrercache = ReferrerCache(cachesize), carryover = carryover)
+	else:
+		parser = HitParser(LOG, addressdict = addressdict, referrercache = ReferrerCache(cachesize), samplerate = samplerate, carryover = carryover, spool = spool)
+	if checkpoint is None:
+		parser.parse(filestream)
+	else:
+		parse_checkpointed(parser, filestream, checkpoint)
+	METRICS.set("lines", parser.LineCount)
+
+	if spool is not None:
+		size = spool.close(parser.LineCount)
+		LOG.write(LogLevel.INFO, f"Spool: {spool.Records} records, {len(spool.IPs)} ip addresses, {len(spool.Referrers)} referrers, {size} bytes written to {spool.FileName}")
+		METRICS.set("spool_bytes", size)
+
+	parser.ReferrerCache.log_stats(LOG)
+	log_store_stats(parser.AddressDict)
+
+	# track how long parsing took
+	display_processtime(starttime, "Parsing")
+
+	return parser.ResultsDict
+
+def parse_spool(spoolfile, addressdict = None, carryover = None):
 	"""
+		Runs attribution and aggregation over a spool written by an earlier parse, instead of parsing the input file.
+
+		Parameters
+		----------
+		spoolfile (string)
+			The local storage location of the spool
+		addressdict (dict)
+			Optional store for the referrer of each ip address, a dictionary is used by default
+		carryover (AttributionSnapshot)
+			Optional referrers of ip addresses from earlier days
 
-	# dictionary that stores relevant ip addresses (IP: DomainInfo)
-	addressdict = dict()
-	# dictionary that stores grouped sum of revenue based on domain info (Domain|KeyWords: Revenue)
-	resultsdict = dict()
-	# dictionary for storing column names and values
-	row = dict()
+		Returns
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+	"""
 
-	linenumber = 0
 	starttime = time.time()
 
-	# skip header record
-	next(filestream)
-
-	for line in filestream:
-		linenumber += 1
-
-		if type(line) is bytes:
-			line = line.decode("utf8")
-
-		# error catch bad lines so one bad line doesn't fail the entire file
-		try: 
-			# parse each line in to a row dictionary
-			columns = line.split(sep = "\t")
-			if len(columns) != 12:
-				LOG.write(LogLevel.ERROR, f"Line: {linenumber}\t Record does not contain 12 columns. Possible invalid file format.")
-				continue
-
-			row['ip'] = columns[3]
-			row['events'] = columns[4]
-			row['productlist'] = columns[10]
-			row['url'] = columns[11]
-
-			# handle external reference storage
-			if 'esshopzilla' not in row['url']:
-				with UrlParser(row['url']) as parsedurl:
-					if len(parsedurl.Parameters):
-						# store domain and search details in dictionary with associated ip address
-						addressdict[row['ip']] = f"{parsedurl.Domain}|{parsedurl.get_keywords()}"
-
-			# get the events from column 5
-			events = row['events'].split(",")
-
-			# handle an actualized revenue record if we have a matching external reference for the ip address
-			if events is not None and '1' in events and row['ip'] in addressdict:
-				totalrevenue = 0
-				productlist = row['productlist'].split(",")
-
-				# iterate through product list to calculate total revenue for this actualized event
-				if len(productlist) > 0:
-					for product in productlist:
-						productinfo = product.split(";")
-						if len(productinfo) >= 4:
-							revenue = float(productinfo[3])
-							if revenue >= 0:
-								totalrevenue += revenue
-						else:
-							LOG.write(LogLevel.ERROR, f"Line: {linenumber}\t Invalid Product Attribute in Product List: {product}")
-				else:
-					# no product in productlist
-					LOG.write(LogLevel.ERROR, f"Line: {linenumber}\t Record shows a verified purchase, but no products are listed.")
-
-				if totalrevenue > 0:
-					# retrieve domain information from the ip address dictionary
-					domaininfo = addressdict[row['ip']]
-
-					# the domain information is grouped by domain and keywords, as it is already grouped sum up the values now
-					if domaininfo in resultsdict:
-						resultsdict[domaininfo] += totalrevenue
-					else:
-						resultsdict[domaininfo] = totalrevenue
-
-					LOG.write(LogLevel.DEBUG, f"Purchase found for ip {row['ip']}")
-				else:
-					# totalrevenue is 0 or lower
-					LOG.write(LogLevel.ERROR, f"Line: {linenumber}\t Record shows a verified purchase, but total revenue could not be determined.")
+	parser = SpoolParser(LOG, addressdict = addressdict, carryover = carryover)
+	parser.parse_spool(spoolfile)
+	METRICS.set("lines", parser.LineCount)
 
-		except Exception as ex:
-			# error procesing line
-			LOG.write(LogLevel.ERROR, f"Line: {linenumber}\t unhandled exception processing line: {ex}")
+	log_store_stats(parser.AddressDict)
+
+	# track how long parsing took
+	display_processtime(starttime, "Parsing")
+
+	return parser.ResultsDict
+
+def parse_checkpointed(parser, batches, checkpoint):
+	"""
+		Parses batches of lines, saving a checkpoint between batches whenever the checkpoint interval has passed.
+		A loaded checkpoint is restored in to the parser before the first batch.
+
+		Parameters
+		----------
+		parser (HitParser)
+			The parser to parse the batches with
+		batches (iterator)
+			(offset after the last line, lines) for each batch, starting from the offset of the checkpoint
+		checkpoint (Checkpoint)
+			The checkpoint to resume from and save to
+	"""
+
+	offset = 0
+	state = checkpoint.State
+	if state is not None:
+		offset = state["offset"]
+		# restore in to the stores the parser was given, so the caller's stores hold the resumed state
+		parser.AddressDict.update(state["addressdict"])
+		parser.ResultsDict.update(state["resultsdict"])
+		parser.LineCount = state["linecount"]
+		LOG.ErrorCount = state["errorcount"]
+
+	for batchend, lines in batches:
+		# only the batch at the start of the file holds the header record
+		parser.parse(iter(lines), skipheader = offset == 0)
+		offset = batchend
 
-	# write the grouped results out to a csv file for sorting
-	with open(outputfile, "w", buffering = 16 * 1024 * 1024) as outfile:
-		for domain, revenue in resultsdict.items():
-			# parse keywords from domain
-			domaininfo = domain.split("|")
-			# write domain and revenue to output file
-			outfile.write(f"{domaininfo[0]}\t{domaininfo[1]}\t{revenue}\n")
+		if checkpoint.is_due():
+			checkpoint.save(offset, parser.LineCount, LOG.ErrorCount, parser.AddressDict, parser.ResultsDict)
+
+def parse_input_parallel(source, workers, cachesize = 100000, addressdict = None, samplerate = 0, carryover = None):
+	"""
+		Split the input source in to chunks that are parsed on multiple cores, and merge the results in file order.
+		The output is the same as parse_input_file.
+
+		Parameters
+		----------
+		source (S3Client | MappedFile)
+			The input source to read chunks from
+		workers (int)
+			The number of worker processes to parse chunks with
+		cachesize (int)
+			The most referrer urls each worker keeps parsed in memory
+		addressdict (dict)
+			Optional store for the referrer of each ip address carried across chunks, a dictionary is used by default
+		samplerate (int)
+			Time decoding and splitting one line in every samplerate lines for the metrics, 0 turns off sampling
+		carryover (AttributionSnapshot)
+			Optional referrers of ip addresses from earlier days, used when purchases are merged
+
+		Returns
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+	"""
+
+	starttime = time.time()
+
+	chunks = find_chunks(source, CHUNKSIZE)
+	LOG.write(LogLevel.INFO, f"Parsing {len(chunks)} chunks with {workers} workers")
+
+	parser = HitParser(LOG, addressdict = addressdict, carryover = carryover)
+
+	# chunks are returned in order so referrers and pending purchases can be carried across chunk edges
+	with multiprocessing.Pool(workers, initializer = init_worker, initargs = (source, cachesize, samplerate)) as pool:
+		for linecount, records, chunkaddresses, cachecounts, metrics in pool.imap(parse_chunk, chunks):
+			merge_chunk(parser, linecount, records, chunkaddresses, cachecounts, metrics)
+
+	METRICS.set("lines", parser.LineCount)
+
+	parser.ReferrerCache.log_stats(LOG)
+	log_store_stats(parser.AddressDict)
 
 	# track how long parsing took
 	display_processtime(starttime, "Parsing")
 
-def sort_results(filename, outputfile):
+	return parser.ResultsDict
+
+def parse_input_shuffle(source, workers, partitions, shufflepath, cachesize = 100000, addressdict = None, samplerate = 0, carryover = None, store = "dict"):
 	"""
-		Sorts the results from the given file based on column 3 descending. Removes the input file when it is complete.
+		Parse the input with a map, shuffle and reduce on multiple cores. Mappers split the input in to chunks and write
+		each hit to a partition by the hash of its ip address, reducers each parse the hits of a disjoint set of ip
+		addresses in file order, and the records of the reducers are merged in file order. The steps hand their files to
+		each other through a shuffle directory, which is a local directory or an S3 prefix. The output is the same as
+		parse_input_file.
+
+		Parameters
+		----------
+		source (S3Client | MappedFile)
+			The input source to read chunks from
+		workers (int)
+			The number of processes to run mappers and reducers with
+		partitions (int)
+			The number of partitions, and so reducers
+		shufflepath (string)
+			The local directory or s3://bucket/prefix to create the run directory the partitions are written to under
+		cachesize (int)
+			The most referrer urls each process keeps parsed in memory
+		addressdict (dict | AttributionTable)
+			Optional store the referrers of the reducers are gathered in to when they are carried over to later days
+		samplerate (int)
+			Time decoding and splitting one line in every samplerate lines for the metrics, 0 turns off sampling
+		carryover (AttributionSnapshot)
+			Optional referrers of ip addresses from earlier days, used by the reducers
+		store (string)
+			'compact' for reducers to store referrers in an AttributionTable, otherwise a dictionary
+
+		Returns
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+	"""
+
+	starttime = time.time()
+
+	# enough chunks to keep every process busy, but no bigger than a chunk of the multiple core parse
+	chunks = find_chunks(source, max(1024 * 1024, min(CHUNKSIZE, math.ceil(source.get_size() / workers))))
+	shuffledir = ShuffleDir(shufflepath, SHUFFLEDIR)
+	LOG.write(LogLevel.INFO, f"Shuffling {len(chunks)} chunks in to {partitions} partitions with {workers} workers through {shuffledir.RunPath}")
+
+	parser = HitParser(LOG, addressdict = addressdict, carryover = carryover)
+	settings = {"store": store, "samplerate": samplerate, "carryover": carryover, "keepaddresses": carryover is not None}
+
+	try:
+		with multiprocessing.Pool(workers, initializer = init_shuffle, initargs = (source, shuffledir, partitions, cachesize, settings)) as pool:
+			pool.map(map_chunk, [(mapper, start, end) for mapper, (start, end) in enumerate(chunks)])
+			display_processtime(starttime, "Map")
+
+			reducetime = time.time()
+			pool.map(reduce_partition, [(partition, len(chunks)) for partition in range(partitions)])
+			display_processtime(reducetime, "Reduce")
+
+		mergetime = time.time()
+		partitionstats = merge_partitions(parser, shuffledir, len(chunks), partitions)
+		display_processtime(mergetime, "Merge")
+	finally:
+		shuffledir.close()
+
+	METRICS.set("lines", parser.LineCount)
+
+	lines = [stats[0] for stats in partitionstats]
+	addresses = sum(stats[1] for stats in partitionstats)
+	LOG.write(LogLevel.INFO, f"Shuffle: {METRICS.Counters.get('shuffle_bytes', 0)} bytes shuffled, {min(lines)} to {max(lines)} lines per partition, {addresses} ip addresses")
+	parser.ReferrerCache.log_stats(LOG)
+	if carryover is not None:
+		log_store_stats(parser.AddressDict)
+
+	# track how long parsing took
+	display_processtime(starttime, "Parsing")
+
+	return parser.ResultsDict
+
+def parse_input_twopass(openstream, purchasers, cachesize = 100000, addressdict = None, spoolfile = None, samplerate = 0, carryover = None):
+	"""
+		Parse the input in two passes to use less memory. The first pass collects the ip addresses that make a purchase,
+		and the second pass only stores the referrers of those ip addresses. The output is the same as parse_input_file.
+
+		Parameters
+		----------
+		openstream (function)
+			Opens a new stream to the input each time it is called
+		purchasers (set | PackedSet | BloomFilter)
+			The empty set to collect the ip addresses that make a purchase in
+		cachesize (int)
+			The most referrer urls to keep parsed in memory
+		addressdict (dict)
+			Optional store for the referrer of each ip address, a dictionary is used by default
+		spoolfile (string)
+			Optional local file to copy the input to during the first pass, so the second pass reads it instead of the input
+		samplerate (int)
+			Time decoding and splitting one line in every samplerate lines of the second pass for the metrics, 0 turns off sampling
+		carryover (AttributionSnapshot)
+			Optional referrers of ip addresses from earlier days
+
+		Returns
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+	"""
+
+	starttime = time.time()
+
+	filestream = openstream()
+	if spoolfile is not None:
+		filestream = spool_lines(filestream, spoolfile)
+
+	collect_purchasers(filestream, purchasers, log = LOG)
+	LOG.write(LogLevel.INFO, f"Purchasing ip addresses: {len(purchasers)}")
+	display_processtime(starttime, "First Pass")
+
+	filestream = read_spool(spoolfile) if spoolfile is not None else openstream()
+
+	parser = HitParser(LOG, addressdict = addressdict, referrercache = ReferrerCache(cachesize), purchasers = purchasers, samplerate = samplerate, carryover = carryover)
+	parser.parse(filestream)
+	METRICS.set("lines", parser.LineCount)
+
+	if spoolfile is not None:
+		os.remove(spoolfile)
+
+	parser.ReferrerCache.log_stats(LOG)
+	log_store_stats(parser.AddressDict)
+
+	# track how long parsing took
+	display_processtime(starttime, "Parsing")
+
+	return parser.ResultsDict
+
+def spool_lines(filestream, spoolfile):
+	"""
+		Copies each line of a stream of bytes to a local spool file as it is read.
+
+		Parameters
+		----------
+		filestream (Stream)
+			The stream of lines without line endings to copy
+		spoolfile (string)
+			The local storage location of the spool
+
+		Returns
+		----------
+		lines (iterator)
+			The lines of the stream
+	"""
+
+	with open(spoolfile, "wb", buffering = 16 * 1024 * 1024) as spool:
+		for line in filestream:
+			spool.write(line + b"\n")
+			yield line
+
+def read_spool(spoolfile):
+	"""
+		Reads the lines of a spool file written by spool_lines.
+
+		Parameters
+		----------
+		spoolfile (string)
+			The local storage location of the spool
+
+		Returns
+		----------
+		lines (iterator)
+			The lines of the spool without line endings
+	"""
+
+	with open(spoolfile, "rb", buffering = 16 * 1024 * 1024) as spool:
+		for line in spool:
+			yield line[:-1]
+
+def create_purchasers(purchasers, bloomsize):
+	"""
+		Creates the set of ip addresses that make a purchase for the two pass mode.
+
+		Parameters
+		----------
+		purchasers (string)
+			'set' for a PackedSet of packed ip addresses, 'bloom' for a fixed size BloomFilter
+		bloomsize (int)
+			The size of the BloomFilter in bytes
+
+		Returns
+		----------
+		purchasers (PackedSet | BloomFilter)
+			The empty set
+	"""
+
+	if purchasers == "bloom":
+		return BloomFilter(bloomsize)
+	return PackedSet()
+
+def create_store(store, budget = None, spillfile = SPILLFILE, window = None):
+	"""
+		Creates the store for the referrer of each ip address. An attribution window bounds the store by the visitors
+		active within the window, so it replaces the other stores.
+
+		Parameters
+		----------
+		store (string)
+			'dict' for a dictionary of ip address strings, 'compact' for an AttributionTable of packed ip addresses,
+			'spill' for a SpillStore that spills to disk past the memory budget
+		budget (int)
+			The memory budget in bytes of the spill store, a dictionary store with a budget becomes a spill store, the
+			compact store and an attribution window can't be given a budget
+		spillfile (string)
+			The local storage location of the spill store
+		window (int)
+			Optional attribution window in seconds, referrers older than the window are evicted
+
+		Returns
+		----------
+		addressdict (dict | AttributionTable | SpillStore | WindowStore)
+			The empty store
+	"""
+
+	if budget is not None and (window is not None or store == "compact"):
+		raise ValueError("A memory budget can only be given to the dictionary or spill store")
+
+	if window is not None:
+		return WindowStore(window)
+	if store == "compact":
+		return AttributionTable()
+	if store == "spill" or budget is not None:
+		return SpillStore(spillfile, budget if budget is not None else 1024 * 1024 * 1024)
+	return dict()
+
+def create_checkpoint(source, name, interval, addressdict, uploads3 = False):
+	"""
+		Creates the checkpoint for a one core parse of the input. Compressed inputs can't be resumed from a byte offset,
+		and a spill store keeps most of its ip addresses on disk, so neither is checkpointed.
+
+		Parameters
+		----------
+		source (S3Client | MappedFile)
+			The input source
+		name (string)
+			The name of the input
+		interval (int)
+			The least seconds between checkpoints
+		addressdict (dict | AttributionTable | SpillStore)
+			The store for the referrer of each ip address
+		uploads3 (bool)
+			Copy each checkpoint to the bucket of the S3 input
+
+		Returns
+		----------
+		checkpoint (Checkpoint)
+			The checkpoint, or None if the input can't be checkpointed
+	"""
+
+	if detect_compression(source.read_range(0, 4), name) is not None:
+		LOG.write(LogLevel.INFO, "Compressed input can't be resumed from a byte offset, checkpoints are turned off")
+		return None
+	if isinstance(addressdict, SpillStore):
+		LOG.write(LogLevel.INFO, "The spill store can't be checkpointed, checkpoints are turned off")
+		return None
+
+	checkpointfile = f"{FILEDIR}/{os.path.basename(name)}.checkpoint"
+	return Checkpoint(checkpointfile, name, source.get_size(), source.get_version(), interval, S3 if uploads3 else None, LOG)
+
+def load_carryover(filename, name, ttl):
+	"""
+		Loads the referrers of ip addresses carried over from the runs of earlier days.
 
 		Parameters
 		----------
 		filename (string)
-			The file in local storage to process
+			The local storage location of the snapshot
+		name (string)
+			The name of the input file, the day being run is taken from it or is today
+		ttl (int)
+			The most days a referrer is carried forward
+
+		Returns
+		----------
+		carryover (AttributionSnapshot)
+			The referrers of earlier days, or None if the snapshot was saved by a later day
+	"""
+
+	starttime = time.perf_counter()
+	carryover = AttributionSnapshot(date.fromisoformat(get_partition_date(name, DATESTAMP)).toordinal(), ttl)
+	try:
+		carryover.load(filename)
+	except ValueError as ex:
+		LOG.write(LogLevel.ERROR, f"{ex}, the file is run without carry over and the snapshot is not saved")
+		return None
+
+	seconds = time.perf_counter() - starttime
+	size = os.path.getsize(filename) if os.path.exists(filename) else 0
+	LOG.write(LogLevel.INFO, f"Attribution Snapshot: loaded {len(carryover)} ip addresses, {size} bytes in {seconds:.3f} seconds")
+	METRICS.set("snapshot_load_seconds", round(seconds, 4))
+	METRICS.set("snapshot_load_bytes", size)
+
+	return carryover
+
+def save_carryover(carryover, filename, addressdict):
+	"""
+		Saves the referrers of ip addresses for the runs of later days.
+
+		Parameters
+		----------
+		carryover (AttributionSnapshot)
+			The referrers of earlier days loaded at the start of the run
+		filename (string)
+			The local storage location of the snapshot
+		addressdict (dict | AttributionTable | SpillStore)
+			The referrer of each ip address seen by this run
+	"""
+
+	starttime = time.perf_counter()
+	try:
+		count = carryover.save(filename, addressdict)
+	except ValueError as ex:
+		LOG.write(LogLevel.ERROR, str(ex))
+		return
+
+	seconds = time.perf_counter() - starttime
+	size = os.path.getsize(filename)
+	LOG.write(LogLevel.INFO, f"Attribution Snapshot: saved {count} ip addresses, {size} bytes in {seconds:.3f} seconds")
+	METRICS.set("snapshot_save_seconds", round(seconds, 4))
+	METRICS.set("snapshot_save_bytes", size)
+
+def log_store_stats(addressdict, log = None):
+	"""
+		Writes the number of ip addresses tracked, and the memory used by a compact store or the spills of a spill store, to the log.
+
+		Parameters
+		----------
+		addressdict (dict | AttributionTable | SpillStore | WindowStore)
+			The store for the referrer of each ip address
+		log (Logger)
+			The log to write to, defaults to the log of the run
+	"""
+
+	log = LOG if log is None else log
+
+	if isinstance(addressdict, AttributionTable):
+		size = addressdict.get_size()
+		log.write(LogLevel.INFO, f"Attribution Store: {len(addressdict)} ip addresses, {len(addressdict.Pairs.Values)} domain and keyword pairs, {size} bytes ({size / max(len(addressdict), 1):.1f} bytes per ip address)")
+	elif isinstance(addressdict, SpillStore):
+		log.write(LogLevel.INFO, f"Attribution Store: {len(addressdict)} ip addresses, {addressdict.get_stats()}")
+	elif isinstance(addressdict, WindowStore):
+		log.write(LogLevel.INFO, f"Attribution Store: {len(addressdict)} ip addresses, {addressdict.get_stats()}")
+		METRICS.set("window_high_water", addressdict.HighWater)
+		METRICS.set("window_evictions", addressdict.Evictions)
+	else:
+		log.write(LogLevel.INFO, f"Attribution Store: {len(addressdict)} ip addresses")
+
+def get_result_lines(resultsdict):
+	"""
+		Formats the grouped results as tab separated lines.
+
+		Parameters
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+
+		Returns
+		----------
+		lines (iterator)
+			(revenue, line) for each group
+	"""
+
+	for domain, revenue in resultsdict.items():
+		# parse keywords from domain
+		domaininfo = domain.split("|")
+		yield revenue, f"{domaininfo[0]}\t{domaininfo[1]}\t{revenue}\n"
+
+def sort_key(result):
+	"""
+		Sort key for (revenue, line) results, revenue descending and then the line ascending for ties.
+	"""
+
+	return -result[0], result[1]
+
+def write_sorted_runs(resultsdict, runsize, tempfile = TEMPFILE):
+	"""
+		Sorts the grouped results in runs of runsize groups and writes each run to its own file.
+
+		Parameters
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+		runsize (int)
+			The most groups to sort in memory at one time
+		tempfile (string)
+			The prefix of the local storage locations of the runs
+
+		Returns
+		----------
+		runfiles (list)
+			The local storage locations of the sorted runs
+	"""
+
+	runfiles = list()
+	lines = get_result_lines(resultsdict)
+
+	while True:
+		run = list(islice(lines, runsize))
+		if not len(run):
+			break
+
+		run.sort(key = sort_key)
+		runfile = f"{tempfile}_{len(runfiles)}"
+		with open(runfile, "w", buffering = 16 * 1024 * 1024) as outfile:
+			outfile.writelines(line for revenue, line in run)
+		runfiles.append(runfile)
+
+	return runfiles
+
+def read_sorted_run(runfile):
+	"""
+		Reads back a sorted run written by write_sorted_runs.
+
+		Parameters
+		----------
+		runfile (string)
+			The local storage location of the run
+
+		Returns
+		----------
+		lines (iterator)
+			(revenue, line) for each group in the run
+	"""
+
+	with open(runfile, buffering = 16 * 1024 * 1024) as infile:
+		for line in infile:
+			yield float(line[line.rindex("\t") + 1:]), line
+
+def sort_results(resultsdict, outputfile, top = None, runsize = 5000000, log = None, tempfile = TEMPFILE, s3client = None, tableformat = None):
+	"""
+		Sorts the grouped results by revenue descending and writes them to the output file. When there are more groups
+		than runsize, the groups are sorted in runs on disk and merged. A result table can be written from the sorted
+		results at the same time.
+
+		Parameters
+		----------
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
 		outputfile (string)
 			The local storage location to save the sorted file
+		top (int)
+			Optional number of groups to keep, only the top groups by revenue are written
+		runsize (int)
+			The most groups to sort in memory at one time
+		log (Logger)
+			The log to write to, defaults to the log of the run
+		tempfile (string)
+			The prefix of the local storage locations of the sorted runs
+		s3client (S3Client)
+			Optional S3Client to stream the sorted file to the outbound directory of its bucket as it is written, instead of
+			writing it to local storage
+		tableformat (string)
+			Optional 'parquet' or 'arrow' to also write the results to a table in local storage next to the output file
+
+		Returns
+		----------
+		tablefile (string)
+			The local storage location of the result table, or None if no table was written
 	"""
 
+	log = LOG if log is None else log
 	starttime = time.time()
+	runfiles = list()
 
-	# print in header
-	with open(outputfile, 'w') as sortfile:
+	if top is not None:
+		# a heap of the top groups, so only top groups are held while sorting
+		results = heapq.nsmallest(top, get_result_lines(resultsdict), key = sort_key)
+	elif len(resultsdict) <= runsize:
+		results = sorted(get_result_lines(resultsdict), key = sort_key)
+	else:
+		runfiles = write_sorted_runs(resultsdict, runsize, tempfile)
+		results = heapq.merge(*[read_sorted_run(runfile) for runfile in runfiles], key = sort_key)
+		log.write(LogLevel.INFO, f"Sorting {len(resultsdict)} groups in {len(runfiles)} runs")
+
+	if s3client is None:
+		sortfile = open(outputfile, "w", buffering = 16 * 1024 * 1024)
+	else:
+		sortfile = S3MultipartWriter(s3client.Client, s3client.Bucket, f"outbound/{os.path.basename(outputfile)}", log = log)
+
+	tablewriter = None
+	if tableformat is not None:
+		tablewriter = ResultTableWriter(get_table_file(outputfile, tableformat), tableformat)
+		results = tablewriter.write_results(results)
+
+	with sortfile:
+		# print in header
 		sortfile.write("Search Engine Domain\tSearch Keyword\tRevenue\n")
+		sortfile.writelines(line for revenue, line in results)
 
-	# hard to beat a classic unix sort command
-	os.system(f"sort -k 3nr -t '\t' {filename} >> {outputfile}")
+	for runfile in runfiles:
+		os.remove(runfile)
 
-	# remove processed file from storage, worth noting that both files will exist on disk at the same time
-	os.remove(filename)
+	if tablewriter is not None:
+		tablewriter.close()
+		size = os.path.getsize(tablewriter.FileName)
+		log.write(LogLevel.INFO, f"Result Table: {tablewriter.Rows} rows, {size} bytes written to {tablewriter.FileName}")
+		METRICS.set("result_table_bytes", size)
 
 	# track how long sorting took
-	display_processtime(starttime, "Sorting")
+	display_processtime(starttime, "Sorting", log)
+
+	return None if tablewriter is None else tablewriter.FileName
 
-def process_s3_files():
+def process_s3_files(uploads, copy, uploadfiles = ()):
 	"""
-		Upload log file and result file to S3 bucket, and move processed file to 'processed' directory.
+		Upload log file, profile file and metrics file to S3 bucket, and move processed file to 'processed' directory.
+		The results were already streamed to the bucket while they were sorted. The log and profile are uploaded at the
+		same time, while the processed file is still being copied.
+
+		Parameters
+		----------
+		uploads (ThreadPoolExecutor)
+			The threads to upload with
+		copy (Future)
+			The copy of the processed file to the 'processed' directory, started before the results were sorted
+		uploadfiles (list)
+			Optional files written by the run to upload with the log, such as the spool and the result table
 	"""
 
-	# flush the log file
-	LOG.flush()
+	# drain and flush the log file
+	LOG.close()
+
+	filenames = [filename for filename in [LOGFILE, PROFILEFILE, *uploadfiles] if filename is not None and os.path.exists(filename)]
+	for seconds in [future.result() for future in [uploads.submit(upload_file, S3, filename) for filename in filenames]]:
+		METRICS.observe("upload", seconds)
+
+	# the metrics are written after the other uploads so they include the upload times
+	METRICS.write(METRICSFILE)
+	upload_file(S3, METRICSFILE)
 
-	S3.Client.upload_file(LOGFILE, S3.Bucket, f"outbound/{os.path.basename(LOGFILE)}")
-	S3.Client.upload_file(RESULTFILE, S3.Bucket, f"outbound/{os.path.basename(RESULTFILE)}")
+	# the input is only removed from the inbound directory once everything it produced is uploaded
+	copy.result()
+	delete_inbound(S3)
+	uploads.shutdown()
+
+def upload_file(s3client, filename):
+	"""
+		Upload a local file to the outbound directory of the bucket of an S3Client.
+
+		Parameters
+		----------
+		s3client (S3Client)
+			The S3Client pointed at the processed file
+		filename (string)
+			The local storage location of the file
+
+		Returns
+		----------
+		seconds (float)
+			The time the upload took, for the thread that owns the metrics to add
+	"""
+
+	starttime = time.perf_counter()
+	s3client.Client.upload_file(filename, s3client.Bucket, f"outbound/{os.path.basename(filename)}")
+	return time.perf_counter() - starttime
+
+def move_processed(s3client):
+	"""
+		Move a processed file from the inbound directory to the 'processed' directory.
+
+		Parameters
+		----------
+		s3client (S3Client)
+			The S3Client pointed at the processed file
+	"""
+
+	copy_processed(s3client)
+	delete_inbound(s3client)
+
+def copy_processed(s3client, name = None):
+	"""
+		Copy a processed file from the inbound directory to the 'processed' directory, with a server side copy.
+
+		Parameters
+		----------
+		s3client (S3Client)
+			The S3Client pointed at the processed file
+		name (string)
+			Optional name of the copy, the name of the file by default
+	"""
 
-	# copy processed file from inbound to processed directory
 	copysource = {
-		'Bucket': S3.Bucket,
-		'Key' : S3.Key
+		'Bucket': s3client.Bucket,
+		'Key' : s3client.Key
 	}
-	S3.Resource.meta.client.copy(copysource, S3.Bucket, f"processed/{DATESTAMP}_{S3.BaseName}")
-	S3.Resource.Object(S3.Bucket, S3.Key).delete()
+	s3client.Resource.meta.client.copy(copysource, s3client.Bucket, f"processed/{DATESTAMP}_{name or s3client.BaseName}")
 
-def display_processtime(starttime, process):
+def delete_inbound(s3client):
+	"""
+		Delete a processed file from the inbound directory, once it has been copied to the 'processed' directory.
+
+		Parameters
+		----------
+		s3client (S3Client)
+			The S3Client pointed at the processed file
+	"""
+
+	s3client.Resource.Object(s3client.Bucket, s3client.Key).delete()
+
+def merge_aggregates(aggregates, name, resultsdict, date = None, log = None):
+	"""
+		Merges the grouped revenue of a run in to the aggregate store, replacing the partition of its date and input file.
+
+		Parameters
+		----------
+		aggregates (AggregateStore)
+			The aggregate store
+		name (string)
+			The name of the input file, the source file of the partition, and its date when no date is given
+		resultsdict (dict)
+			The grouped sum of revenue (Domain|KeyWords: Revenue)
+		date (string)
+			Optional date of the partition as YYYY-MM-DD
+		log (Logger)
+			The log to write to, defaults to the log of the run
+	"""
+
+	log = LOG if log is None else log
+	date = get_partition_date(name, DATESTAMP) if date is None else date
+
+	starttime = time.perf_counter()
+	rows, othersources = aggregates.replace_partition(date, name, resultsdict)
+	log.write(LogLevel.INFO, f"Aggregate Store: replaced {date} of {name} with {rows} groups in {(time.perf_counter() - starttime) * 1000:.1f} ms")
+	if len(othersources):
+		log.write(LogLevel.INFO, f"Aggregate Store: {date} also holds the revenue of {', '.join(othersources)}, which is added to it in rollups")
+
+def list_inbound(prefix, client):
+	"""
+		Lists the files under an S3 prefix.
+
+		Parameters
+		----------
+		prefix (string)
+			The bucket and prefix to list (bucket/inbound/)
+		client (botocore client)
+			The S3 client to list with
+
+		Returns
+		----------
+		paths (list)
+			The full s3 path of each file (bucket/key)
+	"""
+
+	bucket, _, keyprefix = prefix.partition("/")
+	paths = list()
+
+	for page in client.get_paginator("list_objects_v2").paginate(Bucket = bucket, Prefix = keyprefix):
+		for item in page.get("Contents", []):
+			# skip directory placeholders
+			if not item["Key"].endswith("/"):
+				paths.append(f"{bucket}/{item['Key']}")
+
+	return paths
+
+def process_batch_file(path, name, client, resource, referrercache, aggregates, args):
+	"""
+		Processes one file of a batch with its own log and results, sharing the S3 connection pool and the referrer
+		cache with the other files of the batch. The results and log are uploaded to the outbound directory with the
+		name of the input file, and the input file is moved to the 'processed' directory.
+
+		Parameters
+		----------
+		path (string)
+			The full s3 path of the file to process
+		name (string)
+			The name of the file in the names of its results, log and processed copy, unique within the batch
+		client (botocore client)
+			The shared S3 client
+		resource (boto3 resource)
+			The shared S3 resource
+		referrercache (ReferrerCache)
+			The shared cache of parsed referrer urls
+		aggregates (AggregateStore)
+			Optional shared aggregate store to merge the grouped revenue of the file in to
+		args (Namespace)
+			The command line arguments
+
+		Returns
+		----------
+		errors (int)
+			The number of errors written to the log of the file
+	"""
+
+	starttime = time.time()
+	s3file = S3Client(path, client, resource)
+	prefix = f"{FILEDIR}/{DATESTAMP}_{name}"
+	logfile = f"{prefix}_Log.txt"
+	resultfile = f"{prefix}_SearchKeywordPerformance.tab"
+	spillfile = f"{prefix}_spill.db"
+
+	log = Logger(LogLevel.DEBUG, logfile, args.error_repeat_limit)
+	if args.async_log:
+		log.start_async(args.log_queue_size, flushonerror = not args.no_flush_on_error)
+	log.write(LogLevel.INFO, f"Processing File: s3://{s3file.Bucket}/{s3file.Key}")
+
+	budget = args.memory_budget * 1024 * 1024 if args.memory_budget is not None else None
+	addressdict = create_store(args.store, budget, spillfile, args.attribution_window)
+	# the files of a batch share the urls of the cache, each counts its own lookups
+	sharedcache = referrercache
+	referrercache = sharedcache.share()
+
+	try:
+		reader = RangedS3Reader(s3file, args.part_size * 1024 * 1024, args.concurrency, client = client, log = log)
+		if args.engine == "columnar":
+			parser = ColumnarParser(log, addressdict = addressdict, referrercache = referrercache)
+			parser.parse(reader.iter_blocks())
+		else:
+			parser = HitParser(log, addressdict = addressdict, referrercache = referrercache, samplerate = args.metrics_sample)
+			parser.parse(reader.iter_lines())
+
+		log_store_stats(parser.AddressDict, log)
+		display_processtime(starttime, "Parsing", log)
+
+		if isinstance(addressdict, SpillStore):
+			addressdict.close()
+
+		with ThreadPoolExecutor(max_workers = 1) as uploads:
+			# the input is no longer read, so its copy to the processed directory overlaps the upload of the results
+			copy = uploads.submit(copy_processed, s3file, name)
+			tablefile = sort_results(parser.ResultsDict, resultfile, args.top, args.sort_run_size, log, f"{prefix}_tempfile", s3file, args.table_format)
+
+			if aggregates is not None:
+				merge_aggregates(aggregates, name, parser.ResultsDict, args.aggregate_date, log)
+
+			log.write(LogLevel.INFO, f"File finished processing.")
+			log.write(LogLevel.INFO, f"Exceptions: {log.ErrorCount}")
+			log.close()
+
+			for filename in [logfile, tablefile]:
+				if filename is not None:
+					METRICS.observe("upload", upload_file(s3file, filename))
+			copy.result()
+		delete_inbound(s3file)
+	finally:
+		sharedcache.add_counts(*referrercache.get_counts())
+		log.close()
+		if log.LogFile is not None:
+			log.LogFile.close()
+		for filename in [logfile, resultfile, get_table_file(resultfile, args.table_format or "parquet")]:
+			if os.path.exists(filename):
+				os.remove(filename)
+
+	return log.ErrorCount
+
+def get_batch_names(paths):
+	"""
+		Gets the name each file of a batch is written under. A file is named after its file name, unless another file of
+		the batch has the same file name under a different prefix, when it is named after its full path instead.
+
+		Parameters
+		----------
+		paths (list)
+			The full s3 path of each file (bucket/key)
+
+		Returns
+		----------
+		names (list)
+			The name of each file, unique within the batch
+	"""
+
+	basenames = [os.path.basename(path) for path in paths]
+	counts = Counter(basenames)
+	return [path.replace("/", "_") if counts[basename] > 1 else basename for path, basename in zip(paths, basenames)]
+
+def process_batch(paths, client, args):
+	"""
+		Processes a batch of S3 files in this process, up to args.batch_concurrency files at a time. The files share one
+		S3 connection pool and one referrer cache, so only the first file pays for creating them.
+
+		Parameters
+		----------
+		paths (list)
+			The full s3 path of each file to process (bucket/key)
+		client (botocore client)
+			The S3 client to share between the files, with enough connections for every file running at once
+		args (Namespace)
+			The command line arguments
+	"""
+
+	starttime = time.time()
+	concurrency = max(1, args.batch_concurrency)
+	resource = botoresource("s3")
+	referrercache = ReferrerCache(args.cache_size)
+	aggregates = AggregateStore(args.aggregate_store) if args.aggregate_store is not None else None
+
+	LOG.write(LogLevel.INFO, f"Processing {len(paths)} files, {concurrency} at a time")
+
+	with ThreadPoolExecutor(max_workers = concurrency) as executor:
+		futures = [(path, executor.submit(process_batch_file, path, name, client, resource, referrercache, aggregates, args)) for path, name in zip(paths, get_batch_names(paths))]
+		for path, future in futures:
+			try:
+				LOG.write(LogLevel.INFO, f"Finished s3://{path}: {future.result()} exceptions")
+			except Exception as ex:
+				LOG.write(LogLevel.ERROR, f"Error processing s3://{path}: {ex}")
+
+	if aggregates is not None:
+		aggregates.close()
+
+	referrercache.log_stats(LOG)
+	display_resources(starttime)
+
+def display_processtime(starttime, process, log = None):
 	"""
 		Display minutes and seconds that have passed since starttime was defined
 
@@ -199,42 +1093,394 @@ def display_processtime(starttime, process):
 			The start time to compare to now
 		process (string)
 			The process name that will appear in the log
+		log (Logger)
+			The log to write to, defaults to the log of the run
 	"""
 
 	timedelta = time.time() - starttime
-	minutes = math.floor(timedelta % 60)
+	minutes = math.floor(timedelta / 60)
 	seconds = round(timedelta - (minutes * 60), 4)
-	LOG.write(LogLevel.DEBUG, f"{process} Time: {minutes}:{seconds}")
+	(LOG if log is None else log).write(LogLevel.DEBUG, f"{process} Time: {minutes}:{seconds}")
+	METRICS.set(f"{process.lower().replace(' ', '_')}_seconds", round(timedelta, 4))
+
+def display_throughput(size, starttime):
+	"""
+		Display the rate the input was parsed at since starttime was defined, in bytes and in lines
+
+		Parameters
+		----------
+		size (int)
+			The size of the input in bytes
+		starttime (string)
+			The start time to compare to now
+	"""
+
+	timedelta = max(time.time() - starttime, 1e-9)
+	lines = METRICS.Values.get("lines", 0)
+	LOG.write(LogLevel.INFO, f"Input Throughput: {round(size / timedelta / 1048576, 2)} MB/s, {round(lines / timedelta)} lines/s")
+	METRICS.set("input_bytes", size)
+	METRICS.set("bytes_per_second", round(size / timedelta))
+	METRICS.set("lines_per_second", round(lines / timedelta))
+
+def display_resources(starttime):
+	"""
+		Display the wall time of the whole run and the peak memory used by the process
+
+		Parameters
+		----------
+		starttime (string)
+			The start time of the run
+	"""
+
+	# ru_maxrss is in kilobytes on linux
+	peakmemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+	walltime = time.time() - starttime
+	LOG.write(LogLevel.INFO, f"Wall Time: {round(walltime, 4)} seconds")
+	LOG.write(LogLevel.INFO, f"Peak Memory: {round(peakmemory, 2)} MB")
+	METRICS.set("wall_seconds", round(walltime, 4))
+	METRICS.set("peak_rss_mb", round(peakmemory, 2))
+
+def select_engine(args):
+	"""
+		Falls back to the row engine when the columnar engine can't be used for the run.
+
+		Parameters
+		----------
+		args (Namespace)
+			The command line arguments
+
+		Returns
+		----------
+		engine (string)
+			'rows' or 'columnar'
+	"""
+
+	if args.engine != "columnar":
+		return args.engine
+
+	if not columnar_available():
+		LOG.write(LogLevel.ERROR, "The numpy package is needed by the columnar engine, parsing with the row engine")
+		return "rows"
+
+	if args.mode != "onepass" or args.workers > 1:
+		LOG.write(LogLevel.INFO, "The columnar engine only parses in one pass on one core, parsing with the row engine")
+		return "rows"
+
+	if args.attribution_window is not None:
+		LOG.write(LogLevel.INFO, "The columnar engine doesn't evict referrers by hit time, parsing with the row engine")
+		return "rows"
+
+	if args.write_spool is not None:
+		LOG.write(LogLevel.INFO, "The spool is written by the row engine, parsing with the row engine")
+		return "rows"
+
+	return "columnar"
+
+def run_batch(args):
+	"""
+		Processes the s3 files and prefix passed on the command line as one batch, and uploads the log and metrics of the
+		batch to the outbound directory of the bucket of the first file.
+
+		Parameters
+		----------
+		args (Namespace)
+			The command line arguments
+	"""
+
+	LOG.RepeatLimit = args.error_repeat_limit
+
+	# enough connections for the range requests of every file running at once
+	client = botoclient("s3", config = BotoConfig(max_pool_connections = args.concurrency * max(1, args.batch_concurrency)))
+	paths = list(args.s3file)
+	if args.prefix is not None:
+		paths += list_inbound(args.prefix, client)
+
+	process_batch(paths, client, args)
+
+	LOG.close()
+	METRICS.write(BATCHMETRICSFILE)
+
+	if len(paths):
+		bucket = paths[0].partition("/")[0]
+		try:
+			for filename in [BATCHLOGFILE, BATCHMETRICSFILE]:
+				client.upload_file(filename, bucket, f"outbound/{os.path.basename(filename)}")
+		except Exception as ex:
+			print(f"Error uploading batch log to S3: {ex}")
+
+	for filename in [BATCHLOGFILE, BATCHMETRICSFILE]:
+		if os.path.exists(filename):
+			os.remove(filename)
+
+def positive_int(value):
+	"""
+		An argparse type for a whole number of 1 or more.
+
+		Parameters
+		----------
+		value (string)
+			The value from the command line
+
+		Returns
+		----------
+		number (int)
+			The number
+	"""
+
+	try:
+		number = int(value)
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"{value} is not a whole number")
+	if number < 1:
+		raise argparse.ArgumentTypeError(f"{value} is less than 1")
+	return number
 
 def main():
 	"""
 		Main entry point for parse program.
 	"""
 
-	if LOCALTEST == False and len(sys.argv) < 2:
+	argparser = argparse.ArgumentParser(usage = "python3 ProcessFile.py <s3 filename> [options]")
+	argparser.add_argument("s3file", nargs = "*", help = "the s3 file to process (bucket/key), several files are processed as a batch")
+	argparser.add_argument("--prefix", metavar = "BUCKET/PREFIX", help = "process every file under an s3 prefix as a batch, such as bucket/inbound/")
+	argparser.add_argument("--batch-concurrency", type = int, default = 2, help = "number of files of a batch to process at the same time")
+	argparser.add_argument("--local", metavar = "PATH", help = "process a local file instead of an s3 file, the file is memory mapped and results are kept in local storage")
+	argparser.add_argument("--workers", type = int, default = 1, help = "number of cores to parse the file with")
+	argparser.add_argument("--part-size", type = int, default = 8, help = "size in MB of each S3 range request")
+	argparser.add_argument("--concurrency", type = int, default = 8, help = "number of S3 range requests to run at the same time")
+	argparser.add_argument("--mode", choices = ["onepass", "twopass", "shuffle"], default = "onepass", help = "twopass reads the file twice to only store the referrers of ip addresses that make a purchase, shuffle partitions the hits by ip address with --workers processes and parses each partition separately")
+	argparser.add_argument("--partitions", type = int, help = "number of ip address partitions in the shuffle mode, defaults to the number of workers")
+	argparser.add_argument("--shuffle-dir", default = SHUFFLEDIR, metavar = "PATH", help = "local directory or s3://bucket/prefix the shuffle mode writes its partitions to")
+	argparser.add_argument("--purchasers", choices = ["set", "bloom"], default = "set", help = "set of ip addresses that make a purchase in the two pass mode")
+	argparser.add_argument("--bloom-size", type = int, default = 16, help = "size in MB of the bloom filter of ip addresses that make a purchase")
+	argparser.add_argument("--spool", action = "store_true", help = "copy the s3 file to local storage during the first pass of the two pass mode and read the copy in the second pass")
+	argparser.add_argument("--store", choices = ["dict", "compact", "spill"], default = "dict", help = "store for the referrer of each ip address, compact packs ip addresses in to integers to use less memory, spill moves ip addresses to disk past the memory budget")
+	argparser.add_argument("--memory-budget", type = positive_int, help = "memory budget in MB of the ip address store before it spills to disk, defaults to the PROCESSFILE_MEMORY_BUDGET environment variable, only for the dict and spill stores")
+	argparser.add_argument("--top", type = int, help = "only write the top N search engine domain and keyword groups by revenue")
+	argparser.add_argument("--sort-run-size", type = int, default = 5000000, help = "most groups to sort in memory at one time before sorting in runs on disk")
+	argparser.add_argument("--async-log", action = "store_true", help = "write the log from a background thread in batches")
+	argparser.add_argument("--log-queue-size", type = int, default = 100, help = "most batches of log messages waiting to be written by the background thread")
+	argparser.add_argument("--no-flush-on-error", action = "store_true", help = "don't flush the log after errors when writing from a background thread")
+	argparser.add_argument("--error-repeat-limit", type = int, default = 0, help = "write the same error this many times and then only count repeats, 0 writes every error")
+	argparser.add_argument("--cache-size", type = int, default = 100000, help = "number of parsed referrer urls to keep in memory, 0 turns off the cache")
+	argparser.add_argument("--metrics-sample", type = int, default = 1000, help = "time decoding and splitting one line in every N lines for the metrics file, 0 turns off sampling")
+	argparser.add_argument("--checkpoint-interval", type = int, default = 0, help = "seconds between checkpoints of a one core parse, a run of the same file resumes from the last checkpoint, 0 (the default) turns off checkpoints")
+	argparser.add_argument("--checkpoint-s3", action = "store_true", help = "copy checkpoints of an s3 file to the checkpoints directory of its bucket")
+	argparser.add_argument("--aggregate-store", metavar = "PATH", help = "sqlite file of revenue by date, domain and keywords to merge the results in to, a date that is run again replaces its results")
+	argparser.add_argument("--aggregate-date", metavar = "YYYY-MM-DD", help = "date to merge the results in to the aggregate store under, defaults to the date in the file name or today")
+	argparser.add_argument("--carry-over", metavar = "PATH", help = "snapshot file of the referrer of each ip address, loaded at the start of the run and saved at the end so purchases are attributed to searches from earlier days")
+	argparser.add_argument("--carry-over-ttl", type = int, default = 1, help = "most days a referrer is carried over to later days")
+	argparser.add_argument("--attribution-window", type = int, metavar = "MINUTES", help = "most minutes between a search and a purchase it is attributed to, such as 30 or 1440, older referrers are evicted by hit_time_gmt so memory is bounded by the visitors active within the window")
+	argparser.add_argument("--engine", choices = ["rows", "columnar"], default = "rows", help = "rows parses line by line, columnar parses blocks of lines as numpy arrays and needs the numpy package")
+	argparser.add_argument("--block-size", type = int, default = 16, help = "size in MB of each block of lines parsed by the columnar engine")
+	argparser.add_argument("--write-spool", metavar = "PATH", help = "write the search engine referrers and purchases of the file to a binary spool while parsing, the spool of an s3 file is uploaded with the log")
+	argparser.add_argument("--from-spool", metavar = "PATH", help = "run attribution and aggregation over a spool written by --write-spool instead of parsing a file")
+	argparser.add_argument("--table-format", choices = ["parquet", "arrow"], help = "also write the results to a parquet or arrow ipc table with typed revenue, uploaded next to the tab separated results, needs the pyarrow package")
+	argparser.add_argument("--profile", choices = ["cprofile", "sample"], help = "profile the parse and sort, cprofile writes a profile file next to the results, sample adds the busiest lines to the metrics file")
+	args = argparser.parse_args()
+	if args.prefix is not None or len(args.s3file) > 1:
+		# nothing has been written to the log yet, so the whole log of a batch goes to the batch log
+		LOG.FileName = BATCHLOGFILE
+	if args.memory_budget is not None and (args.store == "compact" or args.attribution_window is not None):
+		argparser.error("--memory-budget can only be used with --store dict or spill, not --store compact or --attribution-window")
+	if args.memory_budget is None and os.environ.get("PROCESSFILE_MEMORY_BUDGET"):
+		try:
+			budget = positive_int(os.environ["PROCESSFILE_MEMORY_BUDGET"])
+		except argparse.ArgumentTypeError as ex:
+			argparser.error(f"PROCESSFILE_MEMORY_BUDGET: {ex}")
+		# the environment is shared by every run of the host, so it only applies to the stores a budget can be given to
+		if args.store == "compact" or args.attribution_window is not None:
+			LOG.write(LogLevel.INFO, "PROCESSFILE_MEMORY_BUDGET is not used by the compact store or an attribution window")
+		else:
+			args.memory_budget = budget
+	if args.prefix is not None or len(args.s3file) > 1:
+		# each file of a batch is parsed in one pass on one core from s3, so the options of the other modes don't apply
+		batchoptions = ["--local", "--workers", "--mode", "--partitions", "--shuffle-dir", "--purchasers", "--bloom-size", "--spool", "--checkpoint-interval", "--checkpoint-s3", "--carry-over", "--carry-over-ttl", "--write-spool", "--from-spool", "--profile"]
+		ignored = [option for option in batchoptions if getattr(args, option[2:].replace("-", "_")) != argparser.get_default(option[2:].replace("-", "_"))]
+		if len(ignored):
+			argparser.error(f"{', '.join(ignored)} can't be used with a batch of files")
+	args.engine = select_engine(args)
+	if args.table_format is not None and not table_available():
+		LOG.write(LogLevel.ERROR, "The pyarrow package is needed by the result table, only the tab separated results are written")
+		args.table_format = None
+	if args.mode == "twopass" and args.carry_over is not None:
+		# the second pass only keeps the referrers of the day's purchasers, so a search bought on a later day would be lost
+		argparser.error("--carry-over can't be used with --mode twopass")
+	if args.attribution_window is not None and args.carry_over is not None:
+		# the snapshot keeps no hit times, so it would attribute purchases to searches from outside the window
+		argparser.error("--carry-over can't be used with --attribution-window")
+	if args.attribution_window is not None:
+		# minutes on the command line, seconds in the store
+		args.attribution_window *= 60
+		if args.workers > 1 or args.mode == "shuffle":
+			LOG.write(LogLevel.INFO, "The attribution window evicts referrers in file order, parsing on one core")
+			args.workers = 1
+			args.mode = "onepass" if args.mode == "shuffle" else args.mode
+	if args.write_spool is not None and (args.workers > 1 or args.mode != "onepass"):
+		LOG.write(LogLevel.INFO, "The spool is written in file order by a one pass parse, parsing in one pass on one core")
+		args.workers = 1
+		args.mode = "onepass"
+
+	if args.prefix is not None or len(args.s3file) > 1:
+		run_batch(args)
+		return
+
+	args.s3file = args.s3file[0] if len(args.s3file) else None
+	localpath = args.local if args.local is not None else (f"{FILEDIR}/samplefile.sql" if LOCALTEST else None)
+	# a run from a spool reads the local spool instead of an input file
+	localpath = args.from_spool if args.from_spool is not None else localpath
+
+	if localpath is None and args.s3file is None:
 		print("Syntax: python3 ProcessFile.py <s3 filename>")
 		quit(1)
 
-	if LOCALTEST == True:
-		filestream = open(f"{FILEDIR}/samplefile.sql")
-		parse_input_file(filestream, TEMPFILE)
+	LOG.RepeatLimit = args.error_repeat_limit
+	if args.async_log:
+		LOG.start_async(args.log_queue_size, flushonerror = not args.no_flush_on_error)
+
+	profiler = None
+	if args.profile == "cprofile":
+		profiler = cProfile.Profile()
+		profiler.enable()
+	elif args.profile == "sample":
+		profiler = SamplingProfiler()
+		profiler.start()
+
+	starttime = time.time()
+	budget = args.memory_budget * 1024 * 1024 if args.memory_budget is not None else None
+	addressdict = create_store(args.store, budget, window = args.attribution_window)
+
+	if localpath is not None:
+		LOG.write(LogLevel.INFO, f"Processing File: {localpath}")
+		source = MappedFile(localpath)
+		openstream = lambda: source.iter_lines(LOG)
+		openblocks = lambda: source.iter_blocks(args.block_size * 1024 * 1024, LOG)
+	else:
+		openstream = lambda: get_s3_stream(args.s3file, args.part_size * 1024 * 1024, args.concurrency)
+		openblocks = lambda: get_s3_stream(args.s3file, args.part_size * 1024 * 1024, args.concurrency, blocks = True)
+
+	checkpoint = None
+	carryover = None
+	if args.carry_over is not None:
+		carryover = load_carryover(args.carry_over, os.path.basename(localpath or args.s3file), args.carry_over_ttl)
+
+	spool = None
+	if args.write_spool is not None and args.from_spool is None:
+		spool = SpoolWriter(args.write_spool, os.path.basename(localpath or args.s3file))
+
+	if args.from_spool is not None:
+		resultsdict = parse_spool(args.from_spool, addressdict, carryover)
+	elif args.mode == "twopass":
+		purchasers = create_purchasers(args.purchasers, args.bloom_size * 1024 * 1024)
+		# a local file can be read twice without a spool
+		spoolfile = SPOOLFILE if args.spool and localpath is None else None
+		resultsdict = parse_input_twopass(openstream, purchasers, args.cache_size, addressdict, spoolfile, args.metrics_sample, carryover)
+	elif args.mode == "shuffle":
+		if localpath is None:
+			S3.parse_path(args.s3file)
+			source = S3
+
+		# a compressed file can't be split in to byte ranges, so it is parsed on one core
+		if detect_compression(source.read_range(0, 4), localpath or S3.Key) is not None:
+			LOG.write(LogLevel.INFO, "Compressed input can't be split in to chunks, parsing on one core")
+			resultsdict = parse_input_file(openstream(), args.cache_size, addressdict, args.metrics_sample, carryover = carryover)
+		else:
+			if localpath is None:
+				LOG.write(LogLevel.INFO, f"Processing File: s3://{S3.Bucket}/{S3.Key}")
+			resultsdict = parse_input_shuffle(source, args.workers, args.partitions or args.workers, args.shuffle_dir, args.cache_size, addressdict, args.metrics_sample, carryover, args.store)
+	elif args.workers > 1:
+		if localpath is None:
+			S3.parse_path(args.s3file)
+			source = S3
+
+		# a compressed file can't be split in to byte ranges, so it is parsed on one core
+		if detect_compression(source.read_range(0, 4), localpath or S3.Key) is not None:
+			LOG.write(LogLevel.INFO, "Compressed input can't be split in to chunks, parsing on one core")
+			resultsdict = parse_input_file(openstream(), args.cache_size, addressdict, args.metrics_sample, carryover = carryover)
+		else:
+			if localpath is None:
+				LOG.write(LogLevel.INFO, f"Processing File: s3://{S3.Bucket}/{S3.Key}")
+			resultsdict = parse_input_parallel(source, args.workers, args.cache_size, addressdict, args.metrics_sample, carryover)
+	elif args.checkpoint_interval > 0 and spool is None:
+		if localpath is None:
+			S3.parse_path(args.s3file)
+			source = S3
+
+		checkpoint = create_checkpoint(source, localpath or f"{S3.Bucket}/{S3.Key}", args.checkpoint_interval, addressdict, args.checkpoint_s3 and localpath is None)
+		if checkpoint is None:
+			filestream = openblocks() if args.engine == "columnar" else openstream()
+			resultsdict = parse_input_file(filestream, args.cache_size, addressdict, args.metrics_sample, carryover = carryover, engine = args.engine)
+		else:
+			offset = checkpoint.load()
+			if localpath is None:
+				batches = get_s3_batches(args.s3file, offset, args.part_size * 1024 * 1024, args.concurrency, args.engine == "columnar")
+			elif args.engine == "columnar":
+				# each batch holds one block, which the columnar parser parses as a stream of one block
+				batches = ((blockend, [block]) for blockend, block in source.read_blocks(offset, source.get_size(), args.block_size * 1024 * 1024))
+			else:
+				batches = source.read_windows(offset, source.get_size())
+			resultsdict = parse_input_file(batches, args.cache_size, addressdict, args.metrics_sample, checkpoint, carryover, args.engine)
+	else:
+		filestream = openblocks() if args.engine == "columnar" else openstream()
+		resultsdict = parse_input_file(filestream, args.cache_size, addressdict, args.metrics_sample, carryover = carryover, engine = args.engine, spool = spool)
+
+	if localpath is not None:
+		display_throughput(source.get_size(), starttime)
+		source.close()
 	else:
-		filestream = get_s3_stream()
-		parse_input_file(filestream, TEMPFILE)
+		display_throughput(S3.get_size(), starttime)
 
-	sort_results(TEMPFILE, RESULTFILE)
+	if carryover is not None:
+		save_carryover(carryover, args.carry_over, addressdict)
+
+	if isinstance(addressdict, SpillStore):
+		addressdict.close()
+
+	uploads = None
+	copy = None
+	if localpath is None:
+		# the input is no longer read, so its copy to the processed directory overlaps the sort and the upload of the results
+		uploads = ThreadPoolExecutor(max_workers = UPLOADTHREADS)
+		copy = uploads.submit(copy_processed, S3)
+
+	# results of an s3 file are streamed to the bucket as they are sorted
+	tablefile = sort_results(resultsdict, RESULTFILE, args.top, args.sort_run_size, s3client = S3 if localpath is None else None, tableformat = args.table_format)
+
+	if args.aggregate_store is not None:
+		aggregates = AggregateStore(args.aggregate_store)
+		merge_aggregates(aggregates, os.path.basename(localpath or S3.Key), resultsdict, args.aggregate_date)
+		aggregates.close()
+
+	if args.profile == "cprofile":
+		profiler.disable()
+		profiler.dump_stats(PROFILEFILE)
+		LOG.write(LogLevel.INFO, f"Profile written to {PROFILEFILE}")
+	elif args.profile == "sample":
+		profiler.stop()
+		METRICS.set("profile", profiler.get_top())
 
 	LOG.write(LogLevel.INFO, f"File finished processing.")
 	LOG.write(LogLevel.INFO, f"Exceptions: {LOG.ErrorCount}")
+	display_resources(starttime)
 
-	if LOCALTEST == False:
+	if localpath is None:
 		try:
-			process_s3_files()
+			process_s3_files(uploads, copy, [args.write_spool, tablefile])
+			# the results are uploaded, so a rerun of this file starts from the beginning
+			if checkpoint is not None:
+				checkpoint.remove()
 		except Exception as ex:
 			LOG.write(LogLevel.ERROR, f"Error uploading files to S3: {ex}")
 
-		# clear up files if not running a local test
-		os.remove(LOGFILE)
-		os.remove(RESULTFILE)
+		# clear up files if not processing a local file
+		for filename in [LOGFILE, RESULTFILE, METRICSFILE, PROFILEFILE, tablefile]:
+			if filename is not None and os.path.exists(filename):
+				os.remove(filename)
+	else:
+		if checkpoint is not None:
+			checkpoint.remove()
+		LOG.close()
+		METRICS.write(METRICSFILE)
 
-main()
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,186 @@
+from Metrics import METRICS
+
+# pyarrow is only needed by the columnar result table
+try:
+	import pyarrow
+	import pyarrow.ipc
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+# the column names match the header of the tab separated results
+DOMAIN = "Search Engine Domain"
+KEYWORD = "Search Keyword"
+REVENUE = "Revenue"
+
+def is_available():
+	"""
+		Returns
+		----------
+		available (bool)
+			True if pyarrow is installed, which the result table needs
+	"""
+
+	return pyarrow is not None
+
+def get_table_file(outputfile, tableformat):
+	"""
+		Gets the name of the result table written next to the tab separated results.
+
+		Parameters
+		----------
+		outputfile (string)
+			The local storage location of the tab separated results
+		tableformat (string)
+			'parquet' or 'arrow'
+
+		Returns
+		----------
+		tablefile (string)
+			The local storage location of the table
+	"""
+
+	return f"{outputfile.rpartition('.')[0] or outputfile}.{tableformat}"
+
+class ResultTableWriter(object):
+	"""
+		Writes the sorted results to a Parquet or Arrow IPC file in batches of rows, so dashboards can read typed revenue
+		and only the columns and row groups they need instead of parsing the text results. The domain and keyword
+		columns are dictionary encoded. Parquet encodes each row group with its own dictionary, and Arrow IPC keeps one
+		dictionary per column that only grows, so each batch only adds the new values to it.
+	"""
+
+	# rows in each row group or record batch
+	BATCHSIZE = 64 * 1024
+
+	def __init__(self, filename, tableformat = "parquet"):
+		"""
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the table
+			tableformat (string)
+				'parquet' or 'arrow'
+		"""
+
+		if pyarrow is None:
+			raise ImportError("The pyarrow package is needed to write the result table")
+
+		self.FileName = filename
+		self.Format = tableformat
+		self.Rows = 0
+		self.Domains = list()
+		self.Keywords = list()
+		self.Revenues = list()
+
+		dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+		schema = pyarrow.schema([(DOMAIN, dictionary), (KEYWORD, dictionary), (REVENUE, pyarrow.float64())])
+
+		if tableformat == "parquet":
+			self.Writer = pyarrow.parquet.ParquetWriter(filename, schema)
+		else:
+			# the value: index map and values of the dictionary of each column, which only grow so batches are written as
+			# dictionary deltas
+			self.Dictionaries = [(dict(), pyarrow.array([], pyarrow.string())) for _ in range(2)]
+			self.Writer = pyarrow.ipc.new_file(filename, schema, options = pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas = True))
+
+		self.Schema = schema
+
+	def write(self, domain, keyword, revenue):
+		"""
+			Adds one row to the table.
+
+			Parameters
+			----------
+			domain (string)
+				The search engine domain
+			keyword (string)
+				The search keywords
+			revenue (float)
+				The revenue of the group
+		"""
+
+		self.Domains.append(domain)
+		self.Keywords.append(keyword)
+		self.Revenues.append(revenue)
+		if len(self.Revenues) >= self.BATCHSIZE:
+			self.flush_batch()
+
+	def write_results(self, results):
+		"""
+			Adds the rows of the sorted results and passes the results through unchanged, so the table is written while
+			the tab separated results are.
+
+			Parameters
+			----------
+			results (iterator)
+				(revenue, line) for each group
+
+			Returns
+			----------
+			results (iterator)
+				(revenue, line) for each group
+		"""
+
+		for revenue, line in results:
+			domain, keyword, _ = line.split("\t", 2)
+			self.write(domain, keyword, revenue)
+			yield revenue, line
+
+	def encode(self, values, column):
+		"""
+			Dictionary encodes the values of a batch against the growing dictionary of an Arrow IPC column. Only the new
+			values are converted, and appended to the dictionary.
+		"""
+
+		indices, dictionary = self.Dictionaries[column]
+		positions = list()
+		newvalues = list()
+		for value in values:
+			index = indices.get(value)
+			if index is None:
+				index = indices[value] = len(indices)
+				newvalues.append(value)
+			positions.append(index)
+
+		if len(newvalues):
+			dictionary = pyarrow.concat_arrays([dictionary, pyarrow.array(newvalues, pyarrow.string())])
+			self.Dictionaries[column] = (indices, dictionary)
+
+		return pyarrow.DictionaryArray.from_arrays(pyarrow.array(positions, pyarrow.int32()), dictionary)
+
+	def flush_batch(self):
+		"""
+			Writes the buffered rows as one row group or record batch.
+		"""
+
+		if not len(self.Revenues):
+			return
+
+		with METRICS.timer("result_table_batch"):
+			if self.Format == "parquet":
+				columns = [pyarrow.array(values, pyarrow.string()).dictionary_encode() for values in [self.Domains, self.Keywords]]
+			else:
+				columns = [self.encode(self.Domains, 0), self.encode(self.Keywords, 1)]
+			columns.append(pyarrow.array(self.Revenues, pyarrow.float64()))
+
+			self.Writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema = self.Schema))
+
+		self.Rows += len(self.Revenues)
+		self.Domains.clear()
+		self.Keywords.clear()
+		self.Revenues.clear()
+
+	def close(self):
+		"""
+			Writes the last rows and closes the table.
+		"""
+
+		self.flush_batch()
+		self.Writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
@@ -0,0 +1,401 @@
+from Helpers import ReferrerCache
+from HitParser import HitParser
+from Attribution import AttributionTable
+from Metrics import METRICS
+from boto3 import client as botoclient
+from array import array
+from zlib import crc32
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+# the input source, shuffle directory, number of partitions, referrer cache and settings of the current worker process,
+# set once by init_shuffle when the process pool starts
+SHUFFLESOURCE = None
+SHUFFLEDIR = None
+SHUFFLEPARTITIONS = 1
+SHUFFLECACHE = None
+SHUFFLESETTINGS = None
+
+# lines of a partition buffered by a mapper before they are written
+MAPBUFFER = 8192
+# the line number of a record is stored as mapper << LINEBITS | line number within the chunk of the mapper
+LINEBITS = 40
+
+class ShuffleDir(object):
+	"""
+		The directory the map, reduce and merge steps of the shuffle mode hand their files to each other through. Each step
+		only reads the files written by the step before it, so the steps can run in different processes or on different
+		nodes. A local directory stands in for S3, and an s3://bucket/prefix path keeps the files in S3, with a local
+		scratch directory for the copies being written or read. Each run writes to its own new directory under the path,
+		so runs sharing a path never see or remove each other's files, and only the run directory is removed.
+	"""
+
+	def __init__(self, path, scratchdir, client = None):
+		"""
+			Parameters
+			----------
+			path (string)
+				A local directory, or s3://bucket/prefix, the run directory is created under it
+			scratchdir (string)
+				The local directory for copies of S3 files, not used for a local directory
+			client (botocore client)
+				Optional S3 client, each process creates its own by default
+		"""
+
+		self.Path = path
+		self.Client = client
+		self.Bucket = None
+
+		if path.startswith("s3://"):
+			self.Bucket, _, prefix = path[len("s3://"):].partition("/")
+			os.makedirs(scratchdir, exist_ok = True)
+			self.LocalDir = tempfile.mkdtemp(prefix = "shuffle-", dir = scratchdir)
+			# the name of the local scratch directory is unique on this node, the process id keeps it unique across nodes
+			runid = f"{os.path.basename(self.LocalDir)}-{os.getpid()}-{os.urandom(4).hex()}"
+			self.Prefix = "/".join(part for part in [prefix.strip("/"), runid] if part)
+			self.RunPath = f"s3://{self.Bucket}/{self.Prefix}"
+		else:
+			os.makedirs(path, exist_ok = True)
+			self.LocalDir = tempfile.mkdtemp(prefix = "shuffle-", dir = path)
+			self.RunPath = self.LocalDir
+
+	def __getstate__(self):
+		# an S3 client can't be sent to another process, the process creates its own
+		state = self.__dict__.copy()
+		state["Client"] = None
+		return state
+
+	def get_client(self):
+		if self.Client is None:
+			self.Client = botoclient("s3")
+		return self.Client
+
+	def get_path(self, name):
+		"""
+			Returns
+			----------
+			path (string)
+				The local path a file is written to or read from
+		"""
+
+		return os.path.join(self.LocalDir, name)
+
+	def publish(self, name):
+		"""
+			Makes a file written to its local path readable by the other steps.
+		"""
+
+		if self.Bucket is not None:
+			self.get_client().upload_file(self.get_path(name), self.Bucket, f"{self.Prefix}/{name}")
+			os.remove(self.get_path(name))
+
+	def fetch(self, name):
+		"""
+			Returns
+			----------
+			path (string)
+				The local path of a file published by another step
+		"""
+
+		if self.Bucket is not None:
+			self.get_client().download_file(self.Bucket, f"{self.Prefix}/{name}", self.get_path(name))
+		return self.get_path(name)
+
+	def remove(self, name):
+		"""
+			Removes a file once the step reading it is done with it.
+		"""
+
+		if os.path.exists(self.get_path(name)):
+			os.remove(self.get_path(name))
+		if self.Bucket is not None:
+			self.get_client().delete_object(Bucket = self.Bucket, Key = f"{self.Prefix}/{name}")
+
+	def close(self):
+		"""
+			Removes the run directory with any files a failed step left in it. Only files under the run directory are
+			removed, the path it was created under is left alone.
+		"""
+
+		shutil.rmtree(self.LocalDir, ignore_errors = True)
+		if self.Bucket is not None:
+			client = self.get_client()
+			for page in client.get_paginator("list_objects_v2").paginate(Bucket = self.Bucket, Prefix = f"{self.Prefix}/"):
+				for item in page.get("Contents", []):
+					client.delete_object(Bucket = self.Bucket, Key = item["Key"])
+
+class PartitionLog(object):
+	"""
+		A stand in for Logger that stores log messages as records of the line the partition parser is on.
+	"""
+
+	def __init__(self, parser):
+		self.Parser = parser
+
+	def write(self, level, message):
+		parser = self.Parser
+		parser.Records.append(("log", parser.Lines[parser.CurrentLine - 1], level, message, False))
+
+class PartitionParser(HitParser):
+	"""
+		A HitParser for one partition of the shuffle mode. Every hit of an ip address is in the same partition, in file
+		order, so referrers are attributed exactly as in one pass over the file. Revenue and log messages are stored as
+		records with the line they come from, so the merge can apply the records of every partition in file order.
+
+		Records
+		----------
+		("log", line, level, message, isline)
+			A log message, isline is False if the message was not written with a line number
+		("add", line, domaininfo, revenue)
+			Revenue to add to a domain and keywords group
+	"""
+
+	def __init__(self, addressdict = None, referrercache = None, samplerate = 0, carryover = None):
+		self.Records = list()
+		# the line of each line parsed, mapper << LINEBITS | line number within the chunk of the mapper
+		self.Lines = array("q")
+		self.CurrentLine = 0
+		super().__init__(PartitionLog(self), addressdict = addressdict, referrercache = referrercache, samplerate = samplerate, carryover = carryover)
+
+	def read_partition(self, filenames):
+		"""
+			Reads the files of the partition written by each mapper in mapper order, which is file order.
+
+			Parameters
+			----------
+			filenames (list)
+				The local path of the partition file of each mapper
+
+			Returns
+			----------
+			lines (iterator)
+				The hit lines of the partition, without line numbers or line endings
+		"""
+
+		lines = self.Lines
+		for mapper, filename in enumerate(filenames):
+			base = mapper << LINEBITS
+			with open(filename, "rb") as partitionfile:
+				for line in partitionfile:
+					number, _, line = line[:-1].partition(b"\t")
+					lines.append(base | int(number))
+					yield line
+
+	def record_purchase(self, linenumber, ip, domaininfo, productlist):
+		self.CurrentLine = linenumber
+		super().record_purchase(linenumber, ip, domaininfo, productlist)
+
+	def add_revenue(self, domaininfo, revenue):
+		self.Records.append(("add", self.Lines[self.CurrentLine - 1], domaininfo, revenue))
+
+	def log_line(self, level, linenumber, message):
+		self.CurrentLine = linenumber
+		self.Records.append(("log", self.Lines[linenumber - 1], level, message, True))
+
+def get_partition(ip, partitions):
+	"""
+		Gets the partition of an ip address. crc32 is used instead of hash, as hash is seeded differently by every
+		process and every node must put an ip address in the same partition.
+
+		Parameters
+		----------
+		ip (bytes)
+			The ip address column of a hit
+		partitions (int)
+			The number of partitions
+
+		Returns
+		----------
+		partition (int)
+			The partition of the ip address
+	"""
+
+	return crc32(ip) % partitions
+
+def init_shuffle(source, shuffledir, partitions, cachesize, settings):
+	"""
+		Stores the input source and shuffle directory, and creates the referrer cache for a worker process.
+
+		Parameters
+		----------
+		source (S3Client | MappedFile)
+			The input source mappers read chunks from
+		shuffledir (ShuffleDir)
+			The directory the steps hand their files to each other through
+		partitions (int)
+			The number of partitions
+		cachesize (int)
+			The most urls to keep in the referrer cache of the worker
+		settings (dict)
+			The store, samplerate, carryover and keepaddresses settings of the reducers
+	"""
+
+	global SHUFFLESOURCE, SHUFFLEDIR, SHUFFLEPARTITIONS, SHUFFLECACHE, SHUFFLESETTINGS
+	SHUFFLESOURCE = source
+	SHUFFLEDIR = shuffledir
+	SHUFFLEPARTITIONS = partitions
+	SHUFFLECACHE = ReferrerCache(cachesize)
+	SHUFFLESETTINGS = settings
+
+def map_chunk(task):
+	"""
+		The map step. Reads one chunk of the input and writes each hit, with its line number within the chunk, to the
+		partition file of its ip address. Lines that can't be split are kept in partition 0 so their error is logged
+		by a reducer.
+
+		Parameters
+		----------
+		task (tuple)
+			The (mapper, start, end) of the chunk
+
+		Returns
+		----------
+		linecount (int)
+			The number of lines in the chunk, not including the header
+	"""
+
+	mapper, start, end = task
+	partitions = SHUFFLEPARTITIONS
+	METRICS.reset()
+	starttime = time.perf_counter()
+
+	lines = SHUFFLESOURCE.read_lines(start, end)
+	if start == 0:
+		next(lines, None)
+
+	names = [f"map-{mapper}-part-{partition}" for partition in range(partitions)]
+	files = [open(SHUFFLEDIR.get_path(name), "wb") for name in names]
+	buffers = [list() for _ in range(partitions)]
+	linenumber = 0
+
+	for line in lines:
+		linenumber += 1
+		columns = line.split(b"\t", 4)
+		partition = get_partition(columns[3], partitions) if len(columns) > 3 else 0
+
+		buffer = buffers[partition]
+		buffer.append(b"%d\t%b\n" % (linenumber, line))
+		if len(buffer) >= MAPBUFFER:
+			files[partition].write(b"".join(buffer))
+			buffer.clear()
+
+	size = 0
+	for partition, partitionfile in enumerate(files):
+		partitionfile.write(b"".join(buffers[partition]))
+		size += partitionfile.tell()
+		partitionfile.close()
+		SHUFFLEDIR.publish(names[partition])
+
+	METRICS.observe("shuffle_map", time.perf_counter() - starttime)
+	METRICS.count("shuffle_bytes", size)
+
+	with open(SHUFFLEDIR.get_path(f"map-{mapper}"), "wb") as mapfile:
+		pickle.dump((linenumber, METRICS), mapfile, protocol = pickle.HIGHEST_PROTOCOL)
+	SHUFFLEDIR.publish(f"map-{mapper}")
+
+	return linenumber
+
+def reduce_partition(task):
+	"""
+		The reduce step. Parses the hits of one partition, which hold every hit of a disjoint set of ip addresses, and
+		writes the ordered records of the partition for the merge.
+
+		Parameters
+		----------
+		task (tuple)
+			The (partition, mappers) of the reducer
+
+		Returns
+		----------
+		linecount (int)
+			The number of lines in the partition
+	"""
+
+	partition, mappers = task
+	settings = SHUFFLESETTINGS
+	METRICS.reset()
+	starttime = time.perf_counter()
+
+	# each reducer holds only the ip addresses of its partition, so the spill store isn't needed
+	addressdict = AttributionTable() if settings["store"] == "compact" else dict()
+	parser = PartitionParser(addressdict, SHUFFLECACHE, settings["samplerate"], settings["carryover"])
+	startcounts = SHUFFLECACHE.get_counts()
+
+	names = [f"map-{mapper}-part-{partition}" for mapper in range(mappers)]
+	parser.parse(parser.read_partition([SHUFFLEDIR.fetch(name) for name in names]), skipheader = False)
+	for name in names:
+		SHUFFLEDIR.remove(name)
+
+	cachecounts = tuple(count - startcount for count, startcount in zip(SHUFFLECACHE.get_counts(), startcounts))
+	METRICS.observe("shuffle_reduce", time.perf_counter() - starttime)
+
+	addresses = addressdict if settings["keepaddresses"] else len(addressdict)
+	with open(SHUFFLEDIR.get_path(f"reduce-{partition}"), "wb") as reducefile:
+		pickle.dump((parser.LineCount, parser.Records, addresses, cachecounts, METRICS), reducefile, protocol = pickle.HIGHEST_PROTOCOL)
+	SHUFFLEDIR.publish(f"reduce-{partition}")
+
+	return parser.LineCount
+
+def merge_partitions(parser, shuffledir, mappers, partitions):
+	"""
+		The merge step. Applies the records of every partition to a HitParser in file order, so revenue is summed and
+		log messages are written in the same order as one pass over the file.
+
+		Parameters
+		----------
+		parser (HitParser)
+			The parser to merge the results in to
+		shuffledir (ShuffleDir)
+			The directory the steps hand their files to each other through
+		mappers (int)
+			The number of mappers
+		partitions (int)
+			The number of partitions
+
+		Returns
+		----------
+		partitionstats (list)
+			The (lines, ip addresses) of each partition
+	"""
+
+	# the first line of each chunk, so line numbers within a chunk can be turned in to line numbers of the file
+	offsets = list()
+	for mapper in range(mappers):
+		with open(shuffledir.fetch(f"map-{mapper}"), "rb") as mapfile:
+			linecount, metrics = pickle.load(mapfile)
+		shuffledir.remove(f"map-{mapper}")
+		offsets.append(parser.LineCount)
+		parser.LineCount += linecount
+		METRICS.merge(metrics)
+
+	recordlists = list()
+	partitionstats = list()
+	for partition in range(partitions):
+		with open(shuffledir.fetch(f"reduce-{partition}"), "rb") as reducefile:
+			linecount, records, addresses, cachecounts, metrics = pickle.load(reducefile)
+		shuffledir.remove(f"reduce-{partition}")
+
+		recordlists.append(records)
+		if isinstance(addresses, int):
+			partitionstats.append((linecount, addresses))
+		else:
+			partitionstats.append((linecount, len(addresses)))
+			parser.AddressDict.update(addresses)
+		parser.ReferrerCache.add_counts(*cachecounts)
+		METRICS.merge(metrics)
+
+	mask = (1 << LINEBITS) - 1
+	# a line is in only one partition, so records of the same line stay in the order they were written
+	for record in heapq.merge(*recordlists, key = lambda record: record[1]):
+		if record[0] == "add":
+			parser.add_revenue(record[2], record[3])
+		elif record[4]:
+			parser.log_line(record[2], offsets[record[1] >> LINEBITS] + (record[1] & mask), record[3])
+		else:
+			parser.Log.write(record[2], record[3])
+
+	return partitionstats
@@ -0,0 +1,221 @@
+from Helpers import LogLevel
+from HitParser import HitParser
+import mmap
+import pickle
+import struct
+
+# the first bytes of a spool file
+MAGIC = b"HITSPOOL"
+# line number, hit time, ip address id, referrer id, flags, total revenue
+RECORD = struct.Struct("<QqIiBd")
+# the byte offset of the trailer, at the end of the file
+TRAILER = struct.Struct("<Q")
+# records buffered before they are written
+SPOOLBUFFER = 4096
+
+# flags of a record
+REFERRER = 1
+PURCHASE = 2
+BADTIME = 4
+BADREVENUE = 8
+
+class SpoolWriter(object):
+	"""
+		Writes the hits that matter to attribution, the search engine referrers and purchases, to a binary spool file as
+		fixed width records. Each record holds the line number, hit time, an id for the ip address, an id for the search
+		engine domain and keywords and the total revenue of a purchase, so attribution and aggregation can be run again
+		without downloading or splitting the input file. The ip addresses and referrers of the ids, and the messages of the
+		records flagged as bad, are stored once in a trailer at the end of the file.
+	"""
+
+	def __init__(self, filename, name):
+		"""
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the spool
+			name (string)
+				The name of the input file the spool is written from
+		"""
+
+		self.FileName = filename
+		self.Name = name
+		self.IPs = dict()
+		self.Referrers = dict()
+		# line number: message, of the hit times and of the revenues that are not numbers
+		self.TimeErrors = dict()
+		self.RevenueErrors = dict()
+		self.Buffer = list()
+		self.Records = 0
+		self.File = open(filename, "wb")
+		self.File.write(MAGIC)
+
+	def get_id(self, ids, value):
+		"""
+			Gets the id of an ip address or referrer, adding it if it is new.
+		"""
+
+		valueid = ids.get(value)
+		if valueid is None:
+			valueid = ids[value] = len(ids)
+		return valueid
+
+	def write_record(self, linenumber, hittime, ip, referrerid, flags, revenue):
+		"""
+			Buffers one record, a hit time that isn't a number is flagged instead of failing the line.
+		"""
+
+		try:
+			hittime = int(hittime)
+		except ValueError as ex:
+			hittime = 0
+			flags |= BADTIME
+			self.TimeErrors[linenumber] = f"unhandled exception processing line: {ex}"
+
+		self.Buffer.append(RECORD.pack(linenumber, hittime, self.get_id(self.IPs, ip), referrerid, flags, revenue))
+		self.Records += 1
+		if len(self.Buffer) >= SPOOLBUFFER:
+			self.File.write(b"".join(self.Buffer))
+			self.Buffer.clear()
+
+	def add_referrer(self, linenumber, hittime, ip, domaininfo):
+		"""
+			Writes a hit with a search engine referrer.
+
+			Parameters
+			----------
+			linenumber (int)
+				The line number of the hit
+			hittime (string | bytes)
+				The hit_time_gmt column of the hit
+			ip (string)
+				The ip address of the hit
+			domaininfo (string)
+				The domain and keywords of the search engine (Domain|Keywords)
+		"""
+
+		self.write_record(linenumber, hittime, ip, self.get_id(self.Referrers, domaininfo), REFERRER, 0)
+
+	def add_purchase(self, linenumber, hittime, ip, totalrevenue, error = None):
+		"""
+			Writes a purchase.
+
+			Parameters
+			----------
+			linenumber (int)
+				The line number of the hit
+			hittime (string | bytes)
+				The hit_time_gmt column of the hit
+			ip (string)
+				The ip address of the hit
+			totalrevenue (float)
+				The sum of the revenue of each product, or None if a revenue is not a number
+			error (Exception)
+				The error of a revenue that is not a number
+		"""
+
+		if totalrevenue is None:
+			self.RevenueErrors[linenumber] = f"unhandled exception processing line: {error}"
+			self.write_record(linenumber, hittime, ip, -1, PURCHASE | BADREVENUE, 0)
+		else:
+			self.write_record(linenumber, hittime, ip, -1, PURCHASE, totalrevenue)
+
+	def close(self, linecount):
+		"""
+			Writes the trailer and closes the spool.
+
+			Parameters
+			----------
+			linecount (int)
+				The number of lines of the input file, not including the header
+
+			Returns
+			----------
+			size (int)
+				The size of the spool in bytes
+		"""
+
+		self.File.write(b"".join(self.Buffer))
+		self.Buffer.clear()
+
+		offset = self.File.tell()
+		trailer = {"name": self.Name, "lines": linecount, "records": self.Records, "ips": list(self.IPs), "referrers": list(self.Referrers), "timeerrors": self.TimeErrors, "revenueerrors": self.RevenueErrors}
+		pickle.dump(trailer, self.File, protocol = pickle.HIGHEST_PROTOCOL)
+		self.File.write(TRAILER.pack(offset))
+		size = self.File.tell()
+		self.File.close()
+
+		return size
+
+class SpoolParser(HitParser):
+	"""
+		A HitParser that runs attribution and aggregation over a spool instead of the lines of an input file. Referrers
+		and purchases are applied in file order with the same rules as the line parsers. Lines that are not hits and
+		products without a revenue are not in the spool, so only the errors of purchases and hit times are logged.
+	"""
+
+	def parse_spool(self, filename):
+		"""
+			Runs attribution and aggregation over a spool.
+
+			Parameters
+			----------
+			filename (string)
+				The local storage location of the spool
+
+			Returns
+			----------
+			LineCount (int)
+				The number of lines of the input file the spool was written from
+		"""
+
+		addressdict = self.AddressDict
+		carryover = self.CarryOver
+		advance = getattr(addressdict, "advance", None)
+		# the referrer and purchase of the same line share a hit time, which is only logged once
+		badline = None
+
+		with open(filename, "rb") as spoolfile, mmap.mmap(spoolfile.fileno(), 0, access = mmap.ACCESS_READ) as data:
+			if data[:len(MAGIC)] != MAGIC:
+				raise ValueError(f"{filename} is not a spool file")
+
+			offset = TRAILER.unpack_from(data, len(data) - TRAILER.size)[0]
+			trailer = pickle.loads(data[offset:len(data) - TRAILER.size])
+			ips = trailer["ips"]
+			referrers = trailer["referrers"]
+			timeerrors = trailer["timeerrors"]
+			revenueerrors = trailer["revenueerrors"]
+			self.Log.write(LogLevel.INFO, f"Spool: {trailer['records']} records of {trailer['lines']} lines of {trailer['name']}, {len(ips)} ip addresses, {len(referrers)} referrers")
+
+			records = memoryview(data)[len(MAGIC):offset]
+			try:
+				for linenumber, hittime, ipid, referrerid, flags, revenue in RECORD.iter_unpack(records):
+					if advance is not None:
+						if flags & BADTIME:
+							if linenumber != badline:
+								self.log_line(LogLevel.ERROR, linenumber, timeerrors[linenumber])
+								badline = linenumber
+							continue
+						advance(hittime)
+
+					ip = ips[ipid]
+					if flags & REFERRER:
+						addressdict[ip] = referrers[referrerid]
+						continue
+
+					domaininfo = addressdict.get(ip)
+					if domaininfo is None and carryover is not None:
+						domaininfo = carryover.get(ip)
+					if domaininfo is None:
+						continue
+
+					if flags & BADREVENUE:
+						self.log_line(LogLevel.ERROR, linenumber, revenueerrors[linenumber])
+					else:
+						self.record_revenue(linenumber, ip, domaininfo, revenue)
+			finally:
+				# the view has to be released before the mapping is closed
+				records.release()
+
+		self.LineCount += trailer["lines"]
+		return trailer["lines"]
@@ -0,0 +1,36 @@
+# A benchmark of the memory mapped local input of ProcessFile.py --local against opening the file as a buffered text stream
+# reports MB/s for reading the lines alone, and for reading and parsing them
+# usage: python3 tools/BenchmarkLocalInput.py <local file>
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from HitParser import HitParser
+from Helpers import MappedFile, Logger, LogLevel
+
+if len(sys.argv) < 2:
+	print("Syntax: python3 tools/BenchmarkLocalInput.py <local file>")
+	quit(1)
+
+inputfile = sys.argv[1]
+size = os.path.getsize(inputfile) / 1048576
+
+def report(name, run):
+	starttime = time.perf_counter()
+	run()
+	seconds = time.perf_counter() - starttime
+	print(f"{name}: {seconds:.3f} seconds, {size / seconds:.2f} MB/s")
+
+def scan(lines):
+	for line in lines:
+		pass
+
+def parse(lines):
+	HitParser(Logger(LogLevel.DEBUG, os.devnull)).parse(lines)
+
+report("Buffered Text Scan", lambda: scan(open(inputfile)))
+report("Memory Mapped Scan", lambda: scan(MappedFile(inputfile).read_lines()))
+report("Buffered Text Parse", lambda: parse(open(inputfile)))
+report("Memory Mapped Parse", lambda: parse(MappedFile(inputfile).read_lines()))
@@ -0,0 +1,38 @@
+# A microbenchmark of the byte level fast path in HitParser against the text loop that decodes and splits every column
+# the sample file is repeated in memory so the benchmark measures parsing and not reading from disk
+# usage: python3 tools/BenchmarkTokenizer.py [repeats]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from HitParser import HitParser
+from Helpers import Logger, LogLevel
+
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+samplefile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datafiles", "samplefile.sql")
+
+with open(samplefile, "rb") as inputfile:
+	header, *records = inputfile.read().splitlines()
+
+lines = records * repeats
+print(f"Lines: {len(lines)}")
+
+def run(parse):
+	parser = HitParser(Logger(LogLevel.DEBUG, os.devnull))
+	starttime = time.perf_counter()
+	parse(parser)
+	seconds = time.perf_counter() - starttime
+	return parser.ResultsDict, seconds
+
+# the text loop decodes every line before splitting it, the same as the loop before the fast path
+textresults, textseconds = run(lambda parser: parser.parse_text(iter(lines)))
+byteresults, byteseconds = run(lambda parser: parser.parse_bytes(iter(lines)))
+
+if textresults != byteresults:
+	print("Results do not match")
+
+print(f"Text Loop: {textseconds:.3f} seconds, {len(lines) / textseconds:,.0f} lines/sec")
+print(f"Byte Fast Path: {byteseconds:.3f} seconds, {len(lines) / byteseconds:,.0f} lines/sec")
+print(f"Speed Up: {textseconds / byteseconds:.2f}x")
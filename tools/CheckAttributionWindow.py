@@ -0,0 +1,94 @@
+# A tool to check the attribution window of ProcessFile.py --attribution-window. A purchase within the window of its
+# search is attributed, a purchase after its search has been evicted is not, a run from a spool gives the same results,
+# and a parser with both a window and a carry over snapshot is refused
+# usage: python3 tools/CheckAttributionWindow.py
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Attribution import AttributionSnapshot, WindowStore
+from HitParser import HitParser
+from Spool import SpoolWriter, SpoolParser
+
+HEADER = "hit_time_gmt\tdate_time\tuser_agent\tip\tevent_list\tgeo_city\tgeo_region\tgeo_country\tpagename\tpage_url\tproduct_list\treferrer"
+START = 1254033280
+MINUTE = 60
+
+class ListLog(object):
+	"""
+		Keeps the log messages in a list
+	"""
+
+	def __init__(self):
+		self.Messages = list()
+
+	def write(self, level, message):
+		self.Messages.append(message)
+
+def create_hit(minutes, ip, referrer, revenue = None):
+	"""
+		Returns a line for a search engine referrer, or a purchase when revenue is given
+	"""
+
+	events, products = ("1", f"Electronics;Ipod - Touch - 32GB;1;{revenue};") if revenue is not None else ("", "")
+	return f"{START + minutes * MINUTE}\t2009-09-27 06:34:40\tMozilla\t{ip}\t{events}\tSalem\tOR\tUS\tHome\thttp://www.esshopzilla.com\t{products}\t{referrer}"
+
+def get_lines():
+	return [
+		HEADER,
+		# searched 10 minutes before buying
+		create_hit(0, "1.1.1.1", "http://www.google.com/search?q=Ipod"),
+		create_hit(10, "1.1.1.1", "http://www.esshopzilla.com/checkout/", 290),
+		# searched 40 minutes before buying, the search is evicted by the time of the purchase
+		create_hit(20, "2.2.2.2", "http://www.bing.com/search?q=Zune"),
+		create_hit(60, "2.2.2.2", "http://www.esshopzilla.com/checkout/", 250),
+		# searched again within the window
+		create_hit(61, "2.2.2.2", "http://search.yahoo.com/search?p=cd+player"),
+		create_hit(75, "2.2.2.2", "http://www.esshopzilla.com/checkout/", 190),
+	]
+
+def run(lines, window, spool = None):
+	"""
+		Parses lines of bytes with a window of minutes, and returns the grouped revenue
+	"""
+
+	parser = HitParser(ListLog(), addressdict = WindowStore(window * MINUTE), spool = spool)
+	parser.parse(iter([line.encode("utf8") for line in lines]))
+	if spool is not None:
+		spool.close(parser.LineCount)
+	return parser.ResultsDict
+
+def main():
+	results = list()
+	expected = {"Google|Ipod": 290.0, "Yahoo|Cd Player": 190.0}
+
+	resultsdict = run(get_lines(), 30)
+	assert resultsdict == expected, f"a 30 minute window gave {resultsdict}"
+	results.append("30 minute window: the purchase 40 minutes after its search is not attributed")
+
+	resultsdict = run(get_lines(), 60)
+	assert resultsdict["Bing|Zune"] == 250.0, f"a 60 minute window gave {resultsdict}"
+	results.append("60 minute window: the purchase 40 minutes after its search is attributed")
+
+	# a run from a spool applies the window the same way as the file
+	with tempfile.TemporaryDirectory() as directory:
+		spoolfile = os.path.join(directory, "window.spool")
+		run(get_lines(), 30, SpoolWriter(spoolfile, "window.tsv"))
+		parser = SpoolParser(ListLog(), addressdict = WindowStore(30 * MINUTE))
+		parser.parse_spool(spoolfile)
+		assert parser.ResultsDict == expected, f"the spool gave {parser.ResultsDict}"
+	results.append("30 minute window from a spool: the same results as the file")
+
+	# the snapshot keeps no hit times, so it would attribute the evicted purchase to a search from an earlier day
+	try:
+		HitParser(ListLog(), addressdict = WindowStore(30 * MINUTE), carryover = AttributionSnapshot(1))
+		raise AssertionError("a parser with a window and a carry over snapshot was created")
+	except ValueError:
+		results.append("a window with a carry over snapshot is refused")
+
+	print("\n".join(results))
+
+if __name__ == "__main__":
+	main()
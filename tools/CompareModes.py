@@ -0,0 +1,41 @@
+# A tool to compare the wall time and peak memory of the one pass and two pass modes of ProcessFile.py on the same local file
+# each mode runs in its own process so the peak memory of one doesn't hide the other
+# usage: python3 tools/CompareModes.py <local file>
+
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+MODES = ["onepass", "twopass", "twopass-bloom"]
+
+def run_mode(inputfile, mode):
+	import ProcessFile
+	from Helpers import Logger, LogLevel
+
+	ProcessFile.LOG = Logger(LogLevel.INFO, f"{inputfile}.{mode}.log")
+	outputfile = f"{inputfile}.{mode}.out"
+	starttime = time.time()
+
+	if mode == "onepass":
+		resultsdict = ProcessFile.parse_input_file(open(inputfile))
+	else:
+		purchasers = ProcessFile.create_purchasers("bloom" if mode == "twopass-bloom" else "set", 16 * 1024 * 1024)
+		resultsdict = ProcessFile.parse_input_twopass(lambda: open(inputfile), purchasers)
+
+	ProcessFile.sort_results(resultsdict, outputfile)
+
+	walltime = time.time() - starttime
+	peakmemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+	print(f"{mode}\t{walltime:.2f} seconds\t{peakmemory:.2f} MB peak")
+
+if len(sys.argv) == 3:
+	run_mode(sys.argv[1], sys.argv[2])
+elif len(sys.argv) == 2:
+	for mode in MODES:
+		subprocess.run([sys.executable, os.path.abspath(__file__), sys.argv[1], mode], check = True)
+else:
+	print("Syntax: python3 tools/CompareModes.py <local file>")
@@ -1,15 +1,165 @@
-# A quick tool to generate a 10GB file for testing purposes
+# A tool to generate large synthetic hit data files for testing purposes
+# the file is generated from a seed, so the same arguments always give the same file. The number of distinct ip addresses,
+# referrer domains and keywords, and the rate of purchases and malformed rows can be set to look more like production data
+# usage: python3 tools/GenerateLargeFile.py [output] [--size MB] [--seed N] [--ips N] [--domains N] [--keywords N] [--purchase-rate R] [--malformed-rate R]
 
-import os
+import argparse
+import random
+import time
 
-output = "datafiles/tengigtest.csv"
-outputfile = open(output, "a")
+HEADER = "hit_time_gmt\tdate_time\tuser_agent\tip\tevent_list\tgeo_city\tgeo_region\tgeo_country\tpagename\tpage_url\tproduct_list\treferrer\n"
 
-tengig = 10737418240
+USERAGENTS = [
+	"Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.10) Gecko/2009042316 Firefox/3.0.10",
+	"\"Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_4_11; en) AppleWebKit/525.27.1 (KHTML, like Gecko) Version/3.2.1 Safari/525.27.1\"",
+	"Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1; .NET CLR 1.1.4322)",
+	"Mozilla/5.0 (iPhone; U; CPU iPhone OS 3_0 like Mac OS X; en-us) AppleWebKit/528.18 (KHTML, like Gecko) Version/4.0 Mobile/7A341 Safari/528.16"
+]
 
-while os.path.getsize(output) < tengig:
-	with open("datafiles/samplefile.sql") as inputfile:
-		next(inputfile)
-		for line in inputfile:
-			outputfile.write(line)
-	outputfile.write('\n')
+LOCATIONS = [("Salem", "OR", "US"), ("Rochester", "NY", "US"), ("Salt Lake City", "UT", "US"), ("Duncan", "OK", "US"), ("Austin", "TX", "US"), ("Denver", "CO", "US")]
+
+PRODUCTS = [("Ipod - Nano - 8GB", 190), ("Ipod - Touch - 32GB", 290), ("Zune - 32GB", 250), ("CD Player", 80), ("Headphones", 40)]
+
+PAGES = [("Home", "http://www.esshopzilla.com"), ("Hot Buys", "http://www.esshopzilla.com/hotbuys/"), ("Search Results", "http://www.esshopzilla.com/search/?k=Ipod"), ("Shopping Cart", "http://www.esshopzilla.com/cart/")]
+
+# search engine hosts and the query parameter that holds their keywords, hosts past these are counted as Other by the parser
+ENGINES = [("www.google.com", "q"), ("www.bing.com", "q"), ("search.yahoo.com", "p")]
+
+WORDS = ["ipod", "nano", "touch", "zune", "cd", "player", "headphones", "cheap", "best", "review", "price", "sale", "music", "video", "case", "charger"]
+
+def create_keywords(rng, count):
+	"""
+		Creates count distinct keyword phrases from the word list.
+	"""
+
+	keywords = list()
+	seen = set()
+	while len(keywords) < count:
+		phrase = " ".join(rng.sample(WORDS, rng.randint(1, 3)))
+		# add a number once the short phrases run out, so any number of keywords can be made
+		if phrase in seen:
+			phrase = f"{phrase} {len(keywords)}"
+		seen.add(phrase)
+		keywords.append(phrase)
+	return keywords
+
+def create_engines(count):
+	"""
+		Creates count search engine (host, parameter) pairs, starting with the real search engines.
+	"""
+
+	engines = ENGINES[:count]
+	for number in range(len(engines), count):
+		engines.append((f"search.engine{number}.com", "q"))
+	return engines
+
+def create_ips(rng, count):
+	"""
+		Creates count distinct ipv4 addresses.
+	"""
+
+	ips = set()
+	while len(ips) < count:
+		ips.add(f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}")
+	return sorted(ips)
+
+def generate_file(output, size, seed = 1, ips = 100000, domains = 10, keywords = 1000, purchaserate = 0.05, malformedrate = 0.001, searchrate = 0.3):
+	"""
+		Writes a synthetic hit data file of at least size bytes.
+
+		Parameters
+		----------
+		output (string)
+			The local storage location of the file
+		size (int)
+			The size of the file in bytes
+		seed (int)
+			The seed of the random generator
+		ips (int)
+			The number of distinct ip addresses
+		domains (int)
+			The number of distinct referrer search engine domains
+		keywords (int)
+			The number of distinct search keywords
+		purchaserate (float)
+			The share of rows that are purchases
+		malformedrate (float)
+			The share of rows that are malformed
+		searchrate (float)
+			The share of rows that are referred by a search engine
+
+		Returns
+		----------
+		lines (int)
+			The number of lines written, not including the header
+	"""
+
+	rng = random.Random(seed)
+	iplist = create_ips(rng, ips)
+	engines = create_engines(domains)
+	keywordlist = [keyword.replace(" ", "+") for keyword in create_keywords(rng, keywords)]
+
+	hittime = 1254033280
+	written = len(HEADER)
+	lines = 0
+
+	with open(output, "w", buffering = 16 * 1024 * 1024) as outputfile:
+		outputfile.write(HEADER)
+
+		while written < size:
+			batch = list()
+			for _ in range(10000):
+				hittime += rng.randint(0, 3)
+				ip = rng.choice(iplist)
+				city, region, country = rng.choice(LOCATIONS)
+				pagename, pageurl = rng.choice(PAGES)
+				roll = rng.random()
+
+				events = ""
+				productlist = ""
+				if roll < purchaserate:
+					events = "1"
+					pagename, pageurl = "Order Complete", "https://www.esshopzilla.com/checkout/?a=complete"
+					productlist = ",".join(f"Electronics;{product};1;{price};" for product, price in rng.sample(PRODUCTS, rng.randint(1, 2)))
+
+				if rng.random() < searchrate:
+					host, parameter = rng.choice(engines)
+					referrer = f"http://{host}/search?hl=en&{parameter}={rng.choice(keywordlist)}&form={rng.randint(1, 8)}"
+				else:
+					referrer = pageurl
+
+				columns = [str(hittime), time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(hittime)), rng.choice(USERAGENTS), ip, events, city, region, country, pagename, pageurl, productlist, referrer]
+
+				if rng.random() < malformedrate:
+					# a missing column, a purchase without products, or a product without a revenue
+					error = rng.randint(0, 2)
+					if error == 0:
+						columns.pop(rng.randint(0, 11))
+					else:
+						columns[4] = "1"
+						columns[10] = "" if error == 1 else "Electronics;Zune - 32GB;1;;"
+
+				batch.append("\t".join(columns) + "\n")
+
+			data = "".join(batch)
+			outputfile.write(data)
+			written += len(data)
+			lines += len(batch)
+
+	return lines
+
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser()
+	argparser.add_argument("output", nargs = "?", default = "datafiles/tengigtest.csv", help = "the file to write")
+	argparser.add_argument("--size", type = int, default = 10240, help = "size of the file in MB")
+	argparser.add_argument("--seed", type = int, default = 1, help = "seed of the random generator, the same seed gives the same file")
+	argparser.add_argument("--ips", type = int, default = 100000, help = "number of distinct ip addresses")
+	argparser.add_argument("--domains", type = int, default = 10, help = "number of distinct referrer search engine domains")
+	argparser.add_argument("--keywords", type = int, default = 1000, help = "number of distinct search keywords")
+	argparser.add_argument("--purchase-rate", type = float, default = 0.05, help = "share of rows that are purchases")
+	argparser.add_argument("--malformed-rate", type = float, default = 0.001, help = "share of rows that are malformed")
+	argparser.add_argument("--search-rate", type = float, default = 0.3, help = "share of rows that are referred by a search engine")
+	args = argparser.parse_args()
+
+	lines = generate_file(args.output, args.size * 1024 * 1024, args.seed, args.ips, args.domains, args.keywords, args.purchase_rate, args.malformed_rate, args.search_rate)
+	print(f"Wrote {lines} lines to {args.output}")
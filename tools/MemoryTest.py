@@ -30,3 +30,33 @@ for i in range(50):
     datadict2[i] = f"Purple Ipod Touch"
 
 print(f"Standard Total Size: {sum_dict(datadict2)}")
+
+# the same idea built in to the AttributionTable used by ProcessFile.py --store compact
+# measure the memory per tracked ip address of the original dictionary against the compact table
+import os
+import random
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Attribution import AttributionTable
+
+ipcount = 200000
+random.seed(1)
+ips = [f"{random.randint(1, 255)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(0, 255)}" for i in range(ipcount)]
+pairs = [f"Google|{keyword}" for keyword in ("Ipod", "Zune", "Cd Player", "Ipod Nano", "Laptop")]
+
+def measure(store):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for ip in ips:
+        # build a new string per ip the same way the parser did before the referrer cache
+        domain, keywords = random.choice(pairs).split("|")
+        store[ip] = f"{domain}|{keywords}"
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, len(store)
+
+used, count = measure(dict())
+print(f"Dictionary: {used} bytes for {count} ip addresses, {used / count:.1f} bytes per ip address")
+
+used, count = measure(AttributionTable())
+print(f"AttributionTable: {used} bytes for {count} ip addresses, {used / count:.1f} bytes per ip address")
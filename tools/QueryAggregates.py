@@ -0,0 +1,38 @@
+# A tool to roll up the revenue in an aggregate store written by ProcessFile.py --aggregate-store over a range of dates
+# prints the groups in the same format as the results file, or the dates in the store with --dates
+# usage: python3 tools/QueryAggregates.py <store> [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--top N] [--dates]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Aggregates import AggregateStore
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("store", help = "the sqlite file of the aggregate store")
+argparser.add_argument("--start", default = "0000-00-00", help = "first date of the range")
+argparser.add_argument("--end", default = "9999-99-99", help = "last date of the range, included in the range")
+argparser.add_argument("--top", type = int, help = "only print the top N groups by revenue")
+argparser.add_argument("--dates", action = "store_true", help = "print the dates in the store instead of a rollup")
+args = argparser.parse_args()
+
+if not os.path.exists(args.store):
+	print(f"No aggregate store at {args.store}")
+	quit(1)
+
+aggregates = AggregateStore(args.store)
+starttime = time.perf_counter()
+
+if args.dates:
+	print("Date\tFiles\tGroups\tRevenue")
+	for date, sources, groups, revenue in aggregates.get_dates():
+		print(f"{date}\t{sources}\t{groups}\t{revenue}")
+else:
+	print("Search Engine Domain\tSearch Keyword\tRevenue")
+	for domain, keywords, revenue in aggregates.rollup(args.start, args.end, args.top):
+		print(f"{domain}\t{keywords}\t{revenue}")
+
+print(f"Query Time: {(time.perf_counter() - starttime) * 1000:.1f} ms", file = sys.stderr)
+aggregates.close()
@@ -0,0 +1,134 @@
+# A benchmark suite that times parse_input_file and sort_results end to end on synthetic files from GenerateLargeFile.py
+# each scale runs in its own process so the peak memory of one doesn't hide the other, and the results are saved as json
+# with the commit they were run on, so runs on different commits can be compared with --compare
+# generated files are kept in the data directory and reused by later runs with the same seed and scale
+# usage: python3 tools/RunBenchmarks.py [--scales 100 1024 10240] [--seed N] [--engine rows|columnar] [--data-dir DIR] [--output FILE] [--compare FILE]
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+TOOLSDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLSDIR, ".."))
+sys.path.insert(0, TOOLSDIR)
+
+from GenerateLargeFile import generate_file
+
+def run_scale(inputfile, engine = "rows"):
+	"""
+		Parses and sorts one file with the rows or columnar engine, and prints the timings as json.
+	"""
+
+	import ProcessFile
+	from Helpers import MappedFile, Logger, LogLevel
+	from Metrics import METRICS
+
+	ProcessFile.LOG = Logger(LogLevel.INFO, f"{inputfile}.log")
+	outputfile = f"{inputfile}.out"
+	source = MappedFile(inputfile)
+
+	starttime = time.perf_counter()
+	filestream = source.iter_blocks(16 * 1024 * 1024) if engine == "columnar" else source.read_lines()
+	resultsdict = ProcessFile.parse_input_file(filestream, engine = engine)
+	parseseconds = time.perf_counter() - starttime
+
+	sorttime = time.perf_counter()
+	ProcessFile.sort_results(resultsdict, outputfile)
+	sortseconds = time.perf_counter() - sorttime
+
+	totalseconds = time.perf_counter() - starttime
+	size = source.get_size()
+	source.close()
+	ProcessFile.LOG.close()
+
+	print(json.dumps({
+		"bytes": size,
+		"lines": METRICS.Values.get("lines", 0),
+		"groups": len(resultsdict),
+		"errors": ProcessFile.LOG.ErrorCount,
+		"parse_seconds": round(parseseconds, 4),
+		"sort_seconds": round(sortseconds, 4),
+		"total_seconds": round(totalseconds, 4),
+		"mb_per_second": round(size / totalseconds / 1048576, 2),
+		"lines_per_second": round(METRICS.Values.get("lines", 0) / parseseconds),
+		"peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+	}))
+
+def get_commit():
+	"""
+		Returns the current git commit, or None outside of a git repository.
+	"""
+
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = TOOLSDIR, capture_output = True, text = True, check = True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(results, baseline):
+	"""
+		Prints the change in time and peak memory of each scale against an earlier run.
+	"""
+
+	print(f"Compared to {baseline.get('commit')}")
+	for scale, result in results["scales"].items():
+		old = baseline["scales"].get(scale)
+		if old is None:
+			continue
+		for name in ["parse_seconds", "sort_seconds", "total_seconds", "peak_rss_mb"]:
+			change = (result[name] - old[name]) / max(old[name], 1e-9) * 100
+			print(f"{scale} MB\t{name}\t{old[name]} -> {result[name]}\t{change:+.1f}%")
+
+def main():
+	argparser = argparse.ArgumentParser()
+	argparser.add_argument("--scales", type = int, nargs = "+", default = [100, 1024, 10240], help = "sizes in MB of the files to benchmark")
+	argparser.add_argument("--seed", type = int, default = 1, help = "seed of the generated files")
+	argparser.add_argument("--ips", type = int, default = 100000, help = "number of distinct ip addresses")
+	argparser.add_argument("--domains", type = int, default = 10, help = "number of distinct referrer search engine domains")
+	argparser.add_argument("--keywords", type = int, default = 1000, help = "number of distinct search keywords")
+	argparser.add_argument("--purchase-rate", type = float, default = 0.05, help = "share of rows that are purchases")
+	argparser.add_argument("--malformed-rate", type = float, default = 0.001, help = "share of rows that are malformed")
+	argparser.add_argument("--engine", choices = ["rows", "columnar"], default = "rows", help = "parser engine to benchmark, columnar needs the numpy package")
+	argparser.add_argument("--data-dir", default = "datafiles", help = "directory to keep the generated files in")
+	argparser.add_argument("--output", help = "json file to save the results to, defaults to benchmark_<commit>.json in the data directory")
+	argparser.add_argument("--compare", metavar = "FILE", help = "json results of an earlier run to compare against")
+	argparser.add_argument("--run-one", metavar = "FILE", help = argparse.SUPPRESS)
+	args = argparser.parse_args()
+
+	if args.run_one is not None:
+		run_scale(args.run_one, args.engine)
+		return
+
+	commit = get_commit()
+	settings = {"engine": args.engine, "seed": args.seed, "ips": args.ips, "domains": args.domains, "keywords": args.keywords, "purchase_rate": args.purchase_rate, "malformed_rate": args.malformed_rate}
+	results = {"commit": commit, "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(), "settings": settings, "scales": dict()}
+
+	for scale in args.scales:
+		inputfile = os.path.join(args.data_dir, f"benchmark_{scale}MB_{args.seed}_{args.ips}_{args.domains}_{args.keywords}_{args.purchase_rate}_{args.malformed_rate}.tsv")
+		if not os.path.exists(inputfile):
+			print(f"Generating {inputfile}")
+			generate_file(inputfile, scale * 1024 * 1024, args.seed, args.ips, args.domains, args.keywords, args.purchase_rate, args.malformed_rate)
+
+		output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", inputfile, "--engine", args.engine], capture_output = True, text = True, check = True).stdout
+		result = json.loads(output.strip().splitlines()[-1])
+		results["scales"][str(scale)] = result
+		print(f"{scale} MB\t{result['total_seconds']} seconds\t{result['mb_per_second']} MB/s\t{result['peak_rss_mb']} MB peak")
+
+		for filename in [f"{inputfile}.log", f"{inputfile}.out"]:
+			os.remove(filename)
+
+	outputfile = args.output or os.path.join(args.data_dir, f"benchmark_{commit or 'unknown'}_{args.engine}.json")
+	with open(outputfile, "w") as resultsfile:
+		json.dump(results, resultsfile, indent = 2)
+	print(f"Results saved to {outputfile}")
+
+	if args.compare is not None:
+		with open(args.compare) as baselinefile:
+			compare(results, json.load(baselinefile))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,142 @@
+# A tool to run the retry cron Lambda against local stand-ins for S3 and Lambda, with thousands of objects and a delay
+# on every call like a real API call. It checks that every inbound file that is due a retry is resubmitted exactly once
+# and tagged, that files that are waiting or out of attempts are left alone, and that only the inbound prefix is listed
+# usage: python3 tools/SimulateCronLambda.py [--inbound N] [--other N] [--latency MS] [--threads N]
+
+import argparse
+import os
+import sys
+import threading
+import time
+import types
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AWS"))
+
+class StandInS3(object):
+	"""
+		An in memory bucket with the calls the cron Lambda makes
+	"""
+
+	def __init__(self, objects, latency):
+		# key: (last modified, tags)
+		self.Objects = objects
+		self.Latency = latency
+		self.Lock = threading.Lock()
+		self.Calls = dict()
+		self.ListedKeys = 0
+
+	def call(self, name):
+		with self.Lock:
+			self.Calls[name] = self.Calls.get(name, 0) + 1
+		time.sleep(self.Latency)
+
+	def get_paginator(self, name):
+		s3 = self
+
+		class Paginator(object):
+			def paginate(self, Bucket, Prefix):
+				keys = sorted(key for key in s3.Objects if key.startswith(Prefix))
+				for start in range(0, len(keys), 1000):
+					s3.call("list_objects_v2")
+					s3.ListedKeys += len(keys[start:start + 1000])
+					yield {"Contents": [{"Key": key, "LastModified": s3.Objects[key][0]} for key in keys[start:start + 1000]]}
+
+		return Paginator()
+
+	def get_object_tagging(self, Bucket, Key):
+		self.call("get_object_tagging")
+		return {"TagSet": [{"Key": key, "Value": value} for key, value in self.Objects[Key][1].items()]}
+
+	def put_object_tagging(self, Bucket, Key, Tagging):
+		self.call("put_object_tagging")
+		with self.Lock:
+			self.Objects[Key][1].clear()
+			self.Objects[Key][1].update({tag["Key"]: tag["Value"] for tag in Tagging["TagSet"]})
+
+class StandInLambda(object):
+	"""
+		Records the keys in each invoke payload
+	"""
+
+	def __init__(self, latency):
+		self.Latency = latency
+		self.Lock = threading.Lock()
+		self.Invoked = list()
+
+	def invoke(self, FunctionName, InvocationType, Payload):
+		import json
+		time.sleep(self.Latency)
+		with self.Lock:
+			self.Invoked.append(json.loads(Payload)["Records"][0]["s3"]["object"]["key"])
+
+def create_objects(inbound, other):
+	"""
+		Creates inbound files that are due a retry, waiting for their next retry, or out of attempts, and other files
+		in the processed and outbound directories.
+	"""
+
+	now = datetime.now(timezone.utc)
+	objects = {"inbound/": (now, dict())}
+	expected = set()
+
+	for number in range(inbound):
+		key = f"inbound/hits_{number}.tsv"
+		attempts = number % 4
+		# every other file was modified long enough ago for its next attempt
+		hours = 4 * (attempts + 1) + (1 if number % 2 == 0 else -1)
+		tags = {"Retry Attempts": str(attempts)} if attempts else dict()
+		objects[key] = (now - timedelta(hours = hours), tags)
+		if attempts < 3 and number % 2 == 0:
+			expected.add(key)
+
+	for number in range(other):
+		directory = "processed" if number % 2 else "outbound"
+		objects[f"{directory}/hits_{number}.tsv"] = (now - timedelta(days = 30), dict())
+
+	return objects, expected
+
+def main():
+	argparser = argparse.ArgumentParser()
+	argparser.add_argument("--inbound", type = int, default = 5000, help = "number of files in the inbound directory")
+	argparser.add_argument("--other", type = int, default = 50000, help = "number of files in the processed and outbound directories")
+	argparser.add_argument("--latency", type = float, default = 10, help = "milliseconds each stand in call takes")
+	argparser.add_argument("--threads", type = int, default = 32, help = "threads of the cron Lambda")
+	args = argparser.parse_args()
+
+	objects, expected = create_objects(args.inbound, args.other)
+	s3 = StandInS3(objects, args.latency / 1000)
+	lambdaclient = StandInLambda(args.latency / 1000)
+	clients = {"s3": s3, "lambda": lambdaclient}
+	created = list()
+
+	def client(service, config = None):
+		created.append(service)
+		return clients[service]
+
+	# the stand in boto3 module has to be in place before the Lambda module creates its clients
+	sys.modules["boto3"] = types.SimpleNamespace(client = client)
+	import lambda_function_cron
+	lambda_function_cron.THREADS = args.threads
+
+	starttime = time.time()
+	response = lambda_function_cron.lambda_handler({}, None)
+	seconds = time.time() - starttime
+
+	invoked = lambdaclient.Invoked
+	assert len(invoked) == len(set(invoked)), "a file was resubmitted more than once"
+	assert set(invoked) == expected, f"resubmitted {len(invoked)} files, expected {len(expected)}"
+	for key in expected:
+		attempts = int(objects[key][1]["Retry Attempts"])
+		assert attempts >= 1, f"{key} was not tagged"
+	assert s3.ListedKeys == args.inbound + 1, "keys outside the inbound directory were listed"
+	assert created.count("lambda") == 1, "more than one lambda client was created"
+
+	calls = sum(s3.Calls.values()) + len(invoked)
+	print(response)
+	print(f"{args.inbound} inbound files, {args.other} other files, {calls} calls of {args.latency} ms")
+	print(f"Finished in {seconds:.2f} seconds, {calls * args.latency / 1000:.2f} seconds one call at a time")
+	print(f"Calls: {dict(sorted(s3.Calls.items()))}, invoke: {len(invoked)}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,140 @@
+# A tool to run the launcher Lambdas against local stand-ins for S3, EC2 and ssh, with files of different sizes. It checks
+# that each file gets the instance type, workers, mode and store of its size tier, that the SIZE_TIERS environment
+# variable replaces the default tiers, and that the Lambda for the always running host limits the workers to its cores
+# usage: python3 tools/SimulateLaunchLambda.py
+
+import importlib
+import json
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AWS"))
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+class StandInS3(object):
+	"""
+		Object sizes for head_object, and a key file for download_file
+	"""
+
+	def __init__(self, sizes):
+		self.Sizes = sizes
+
+	def head_object(self, Bucket, Key):
+		return {"ContentLength": self.Sizes[Key]}
+
+	def download_file(self, Bucket, Key, Filename):
+		pass
+
+class StandInEC2(object):
+	"""
+		Records the instance type of each instance created
+	"""
+
+	def __init__(self):
+		self.InstanceTypes = list()
+
+	def create_instances(self, **kwargs):
+		self.InstanceTypes.append(kwargs["InstanceType"])
+		return [types.SimpleNamespace(wait_until_running = lambda: None, public_ip_address = "127.0.0.1")]
+
+class StandInSSH(object):
+	"""
+		Records each command sent to EC2
+	"""
+
+	Commands = list()
+
+	def set_missing_host_key_policy(self, policy):
+		pass
+
+	def connect(self, hostname, username, pkey):
+		pass
+
+	def exec_command(self, command):
+		StandInSSH.Commands.append(command)
+		stream = types.SimpleNamespace(read = lambda: b"")
+		return stream, stream, stream
+
+def create_event(key):
+	return {"Records": [{"s3": {"bucket": {"name": "adobe-project"}, "object": {"key": key}}}]}
+
+def run(module, key):
+	"""
+		Runs the handler of a launcher Lambda for one file, and returns the command it sent to EC2
+	"""
+
+	module.lambda_handler(create_event(key), None)
+	return StandInSSH.Commands[-1]
+
+def main():
+	sizes = {
+		"inbound/small.tsv": 50 * MB,
+		"inbound/medium.tsv": 2 * GB,
+		"inbound/large.tsv": 20 * GB,
+		"inbound/huge.tsv": 50 * GB,
+		"inbound/edge.tsv": 256 * MB,
+	}
+	s3 = StandInS3(sizes)
+	ec2 = StandInEC2()
+
+	# the stand in modules have to be in place before the Lambda modules import them
+	sys.modules["boto3"] = types.SimpleNamespace(client = lambda service: s3, resource = lambda service: ec2)
+	sys.modules["paramiko"] = types.SimpleNamespace(
+		RSAKey = types.SimpleNamespace(from_private_key_file = lambda filename: None),
+		SSHClient = StandInSSH,
+		AutoAddPolicy = None
+	)
+	# printing every event would bury the results
+	sys.stdout = open(os.devnull, "w")
+
+	import lambda_function_create_ec2
+	expected = {
+		"inbound/small.tsv": ("t2.micro", "--workers 1 --mode onepass --store dict"),
+		"inbound/edge.tsv": ("t2.micro", "--workers 1 --mode onepass --store dict"),
+		"inbound/medium.tsv": ("c5.xlarge", "--workers 4 --mode onepass --store dict"),
+		"inbound/large.tsv": ("c5.4xlarge", "--workers 16 --mode onepass --store compact"),
+		"inbound/huge.tsv": ("r5.4xlarge", "--workers 16 --mode onepass --store compact"),
+	}
+	results = list()
+	for key, (instancetype, arguments) in expected.items():
+		command = run(lambda_function_create_ec2, key)
+		assert ec2.InstanceTypes[-1] == instancetype, f"{key} launched {ec2.InstanceTypes[-1]}, expected {instancetype}"
+		assert command.endswith(f"ProcessFile.py adobe-project/{key} {arguments} &"), f"{key} sent {command}"
+		results.append(f"{key}: {sizes[key] // MB} MB on {instancetype} with {arguments}")
+
+	# a tier table from the environment replaces the default tiers
+	os.environ["SIZE_TIERS"] = json.dumps([
+		{"MaxBytes": GB, "InstanceType": "m5.large", "Workers": 2, "Mode": "onepass", "Store": "dict"},
+		{"MaxBytes": None, "InstanceType": "m5.2xlarge", "Workers": 8, "Mode": "twopass", "Store": "dict"},
+	])
+	command = run(lambda_function_create_ec2, "inbound/medium.tsv")
+	assert ec2.InstanceTypes[-1] == "m5.2xlarge" and "--workers 8 --mode twopass" in command, command
+	results.append(f"SIZE_TIERS: inbound/medium.tsv on {ec2.InstanceTypes[-1]}")
+
+	# an out of order table is refused
+	os.environ["SIZE_TIERS"] = json.dumps([{"MaxBytes": GB, "InstanceType": "m5.large", "Workers": 2, "Mode": "onepass", "Store": "dict"}])
+	try:
+		run(lambda_function_create_ec2, "inbound/small.tsv")
+		raise AssertionError("a tier table without a last tier was used")
+	except ValueError:
+		results.append("SIZE_TIERS: a table without a tier for every size is refused")
+	del os.environ["SIZE_TIERS"]
+
+	# the always running host keeps its workers within its cores
+	os.environ["HOST_WORKERS"] = "2"
+	import lambda_function
+	importlib.reload(lambda_function)
+	instances = len(ec2.InstanceTypes)
+	command = run(lambda_function, "inbound/huge.tsv")
+	assert command.endswith("ProcessFile.py adobe-project/inbound/huge.tsv --workers 2 --mode onepass --store compact &"), command
+	assert len(ec2.InstanceTypes) == instances, "the fixed host Lambda created an instance"
+	results.append("HOST_WORKERS=2: inbound/huge.tsv on the fixed host with 2 workers")
+
+	sys.stdout = sys.__stdout__
+	print("\n".join(results))
+
+if __name__ == "__main__":
+	main()